@@ -1,8 +1,11 @@
 __version__ = "1.0.0rc1"
 
+from .cache import CacheConfig  # noqa
 from .drivers.base import Driver  # noqa
-from .drivers.postgres import Postgres  # noqa
+from .drivers.postgres import InsertMode, Postgres, PrefetchStrategy, ReplicaPolicy  # noqa
 from .exceptions import *  # noqa
-from .fields import Column, ForeignKeyRelationship, ReverseOneToOneRelationship, ReverseRelationship, f  # noqa
+from .fields import Bind, Column, ForeignKeyRelationship, ReverseOneToOneRelationship, ReverseRelationship, f  # noqa
+from .hedge import HedgeConfig  # noqa
+from .query import Page  # noqa
 from .table import Table  # noqa
 from .utils import with_returning  # noqa
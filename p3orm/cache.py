@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from time import monotonic
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def __repr__(self) -> str:
+        hits = self.hits
+        misses = self.misses
+        evictions = self.evictions
+
+        return f"<CacheStats {hits=} {misses=} {evictions=}>"
+
+
+@dataclass
+class CacheConfig:
+    """primary key cache of a table, set as `Table.__cache__` or passed to `Driver(cache={Table: ...})`"""
+
+    max_size: int = 1024
+    # seconds an entry is served for, None keeps it until it's evicted or written to
+    ttl: float | None = None
+
+
+class LRUCache[K, V]:
+    """
+    size bounded mapping that evicts the least recently used key, and with a `ttl` also keys older than `ttl`
+    seconds. several caches may share one `stats`.
+
+    every `pop` and `clear` moves the generation of the keys it drops on. a value read from elsewhere is only `put`
+    when the key's generation is the one taken before the read, so a value read before an invalidation isn't cached
+    after it
+    """
+
+    max_size: int
+    ttl: float | None
+    stats: CacheStats
+
+    _entries: OrderedDict[K, V]
+    _expires: dict[K, float]
+    # generations of the most recently dropped keys, the others are at `_floor`
+    _generations: OrderedDict[K, int]
+    _floor: int
+    _last_generation: int
+
+    def __init__(self, max_size: int, stats: CacheStats | None = None, ttl: float | None = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats = stats or CacheStats()
+        self._entries = OrderedDict()
+        self._expires = {}
+        self._generations = OrderedDict()
+        self._floor = 0
+        self._last_generation = 0
+
+    def get(self, key: K) -> V | None:
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.stats.misses += 1
+            return None
+
+        if self.ttl is not None and self._expires[key] <= monotonic():
+            self._entries.pop(key, None)
+            self._expires.pop(key, None)
+            self.stats.evictions += 1
+            self.stats.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return value
+
+    def generation(self, key: K) -> int:
+        return self._generations.get(key, self._floor)
+
+    def put(self, key: K, value: V, generation: int | None = None) -> None:
+        if generation is not None and self.generation(key) != generation:
+            return
+
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+
+        if self.ttl is not None:
+            self._expires[key] = monotonic() + self.ttl
+
+        while len(self._entries) > self.max_size:
+            evicted, _ = self._entries.popitem(last=False)
+            self._expires.pop(evicted, None)
+            self.stats.evictions += 1
+
+    def pop(self, key: K) -> V | None:
+        self._last_generation += 1
+        self._generations[key] = self._last_generation
+        self._generations.move_to_end(key)
+
+        # a key whose generation is forgotten falls back to the floor, which has to be past every generation it had
+        while len(self._generations) > self.max_size:
+            _, generation = self._generations.popitem(last=False)
+            self._floor = max(self._floor, generation)
+
+        self._expires.pop(key, None)
+        return self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._last_generation += 1
+        self._floor = self._last_generation
+        self._generations.clear()
+        self._entries.clear()
+        self._expires.clear()
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
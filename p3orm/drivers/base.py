@@ -2,6 +2,7 @@ from __future__ import annotations
 
 from typing import Type, TypeVar
 
+from p3orm.cache import CacheConfig, CacheStats
 from p3orm.table import Table
 
 T = TypeVar("T", bound=Table)
@@ -10,8 +11,12 @@ T = TypeVar("T", bound=Table)
 class Driver:
     tables: list[Type[Table]]
 
-    def __init__(self, tables: list[Type[Table]]) -> None:
+    def __init__(self, tables: list[Type[Table]], cache: dict[Type[Table], CacheConfig] | None = None) -> None:
+        """`cache` turns on the primary key cache of tables, taking precedence over their `__cache__`"""
         super().__init__()
         self.tables = tables
         for table in tables:
-            table._init_stuff(self)
+            table._init_stuff(self, (cache or {}).get(table))
+
+    def cache_stats(self) -> dict[Type[Table], CacheStats]:
+        return {table: memo_cache.stats for table in self.tables if (memo_cache := table.__memo__.cache) is not None}
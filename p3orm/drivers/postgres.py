@@ -1,28 +1,151 @@
 from __future__ import annotations
 
-from collections import defaultdict
+import asyncio
+import json
+import random
+import re
+from collections import ChainMap, defaultdict
+from contextlib import asynccontextmanager, contextmanager, nullcontext, suppress
+from contextvars import ContextVar
+from dataclasses import dataclass
+from enum import Enum
+from time import monotonic
 from types import TracebackType
-from typing import Any, Callable, Coroutine, DefaultDict, Self, Sequence, Type, TypeVar, cast
+from typing import (
+    Any,
+    AsyncContextManager,
+    AsyncGenerator,
+    AsyncIterator,
+    Callable,
+    Coroutine,
+    DefaultDict,
+    Generator,
+    Generic,
+    Iterable,
+    Iterator,
+    Literal,
+    Self,
+    Sequence,
+    Type,
+    TypeVar,
+    cast,
+    overload,
+)
+from weakref import WeakKeyDictionary
 
 import asyncpg
-from pypika import functions as fn
 from pypika.dialects import PostgreSQLQuery, PostgreSQLQueryBuilder
-from pypika.enums import Order
+from pypika.enums import Equality, Order
 from pypika.queries import QueryBuilder
-from pypika.terms import Criterion
+from pypika.terms import BasicCriterion, Criterion
 from pypika.terms import Field as PyPikaField
-from pypika.terms import Parameter
+from pypika.terms import Function, Term, Tuple, ValueWrapper
 
+from p3orm.cache import CacheStats, LRUCache
 from p3orm.drivers.base import Driver
 from p3orm.exceptions import P3ormException
-from p3orm.fields import DEFAULT, PormRelationship, RelationshipType
-from p3orm.table import DB_GENERATED, Table
-from p3orm.utils import cast_enum, get_base_type, is_field_enum, is_field_pydantic, parameterize
+from p3orm.fields import DEFAULT, Bind, PormField, PormRelationship, RelationshipType
+from p3orm.hedge import HedgeConfig, HedgeStats, LatencyWindow
+from p3orm.query import (
+    Page,
+    PrefetchTree,
+    PreparedQuery,
+    _column_name,
+    _instance_from_json,
+    compile_select,
+    decode_cursor,
+    encode_cursor,
+    hydrate_related,
+    json_row,
+    prefetch_plan,
+    projection,
+)
+from p3orm.table import (
+    DB_GENERATED,
+    UNLOADED_COLUMN,
+    IdentityMap,
+    Table,
+    _changed_fields,
+    _copy_instance,
+    _has_unloaded_columns,
+    _instance_pk,
+    _item_pk,
+    _loaded_every_column,
+    _mark_loaded,
+    _refresh_instance,
+)
+from p3orm.utils import _param, criterion_shape, get_base_type, is_optional, parameterize, parameterize_term
 
 T = TypeVar("T", bound="Table")
 U = TypeVar("U", bound="Table")
 RELATIONS_TYPE = Sequence[Sequence[U]]
 
+INVALIDATION_CHANNEL = "p3orm_invalidation"
+# postgres refuses NOTIFY payloads of 8000 bytes or more
+MAX_NOTIFY_PAYLOAD = 7900
+# wait before trying to listen again after the listening connection is lost, doubled on every failure up to the max
+RELISTEN_DELAY = 0.1
+RELISTEN_MAX_DELAY = 5.0
+
+# postgres' limit on bind parameters in a single statement
+MAX_QUERY_ARGS = 32767
+# most parent keys sent in one query when loading relationships
+RELATED_KEYS_CHUNK_SIZE = 10000
+
+
+class InsertMode(str, Enum):
+    values = "values"
+    copy = "copy"
+    unnest = "unnest"
+
+
+class PrefetchStrategy(str, Enum):
+    # one query per relationship, after the rows are fetched
+    select = "select"
+    # the relationships are aggregated to json in the same statement as the rows
+    join = "join"
+
+
+class ReplicaPolicy(str, Enum):
+    # replicas take turns
+    round_robin = "round_robin"
+    random = "random"
+    # the replica with the fewest connections in use
+    least_busy = "least_busy"
+
+
+@dataclass
+class ReadYourWrites:
+    """see `Postgres.read_your_writes`"""
+
+    # writes made in the scope, and how many of them `lsn` covers
+    writes: int = 0
+    synced: int = 0
+    # the primary's WAL position after those writes, replicas serve the scope once they've replayed up to it
+    lsn: int = 0
+
+
+_read_your_writes: ContextVar[ReadYourWrites | None] = ContextVar("p3orm_read_your_writes", default=None)
+
+
+@dataclass
+class OnConflict:
+    """the ON CONFLICT clause of an upsert"""
+
+    # conflict target, the columns of a unique index or constraint
+    columns: list[str]
+    # columns overwritten with the proposed row, none leaves the existing row as it is
+    update: list[str]
+
+    def sql(self) -> str:
+        target = ", ".join(_quote(column) for column in self.columns)
+
+        if not self.update:
+            return f" ON CONFLICT ({target}) DO NOTHING"
+
+        assignments = ", ".join(f"{_quote(column)} = EXCLUDED.{_quote(column)}" for column in self.update)
+        return f" ON CONFLICT ({target}) DO UPDATE SET {assignments}"
+
 
 # NOTE: just here for type hinting on Postgres.acquire()
 class ConnectionContext:
@@ -38,9 +161,73 @@ class ConnectionContext:
         self.connection = None  # type: ignore
 
 
+class StatementCache:
+    """per connection LRU of prepared statements keyed by sql text, so repeated queries skip parse and plan"""
+
+    size: int
+    stats: CacheStats
+
+    _statements: WeakKeyDictionary[asyncpg.Connection, LRUCache[str, asyncpg.prepared_stmt.PreparedStatement]]
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.stats = CacheStats()
+        self._statements = WeakKeyDictionary()
+
+    async def fetch(self, connection: asyncpg.Connection, query: str, query_args: list[Any]) -> list[asyncpg.Record]:
+        try:
+            return await (await self._statement(connection, query)).fetch(*query_args)
+
+        except (asyncpg.exceptions.InvalidCachedStatementError, asyncpg.exceptions.InvalidSQLStatementNameError):
+            # the schema changed underneath the statement or the session deallocated it, prepare it again once
+            return await (await self._statement(connection, query, renew=True)).fetch(*query_args)
+
+    async def execute(self, connection: asyncpg.Connection, query: str, query_args: list[Any]) -> str:
+        try:
+            statement = await self._statement(connection, query)
+            await statement.fetch(*query_args)
+
+        except (asyncpg.exceptions.InvalidCachedStatementError, asyncpg.exceptions.InvalidSQLStatementNameError):
+            statement = await self._statement(connection, query, renew=True)
+            await statement.fetch(*query_args)
+
+        return statement.get_statusmsg()
+
+    async def _statement(
+        self, connection: asyncpg.Connection, query: str, renew: bool = False
+    ) -> asyncpg.prepared_stmt.PreparedStatement:
+        # pool connections are handed out wrapped in a new proxy on every acquire, statements are prepared on and
+        # keyed by the real connection
+        raw_connection = getattr(connection, "_con", connection)
+
+        if (statements := self._statements.get(raw_connection)) is None:
+            statements = self._statements[raw_connection] = LRUCache(self.size, stats=self.stats)
+
+        if renew:
+            statements.pop(query)
+
+        if (statement := statements.get(query)) is None:
+            statement = await raw_connection.prepare(query)
+            statements.put(query, statement)
+
+        # asyncpg refuses statements from before the connection's last release to the pool, but the pool's reset
+        # doesn't deallocate them server side. a session reset that does is caught by the callers and prepared again
+        statement._con_release_ctr = raw_connection._pool_release_ctr
+
+        return statement
+
+
 class Executor:
     connection: asyncpg.Connection | None = None
     pool: asyncpg.Pool | None = None
+    statement_cache: StatementCache | None = None
+    # most pool connections a single fetch_related holds at once
+    prefetch_concurrency: int = 4
+    # instances loaded in this scope by (table, primary key), see `Postgres.transaction`
+    identity_map: IdentityMap | None = None
+    # see `Postgres.listen_invalidations`
+    invalidation_channel: str | None = None
+    notify_writes: bool = False
 
     def is_connected(self) -> bool:
         raise NotImplementedError
@@ -52,21 +239,16 @@ class Executor:
         if not self.is_connected():
             raise P3ormException("not connected")
 
-        records: list[asyncpg.Record]
-
-        if self.connection:
-            records = await self.connection.fetch(query, *query_args or [])
-
-        elif self.pool:
-            async with self.pool.acquire() as connection:
-                records = await connection.fetch(query, *query_args or [])
-
-        else:
-            raise P3ormException("not connected. driver has no pool or connection")
-
-        return records
+        async with self.acquire() as connection:
+            return await self._fetch(connection, query, query_args or [])
 
-    async def execute(self, table: Type[T], query: str | QueryBuilder, query_args: list[Any] | None = None) -> list[T]:
+    async def execute(
+        self, table: Type[T], query: str | QueryBuilder, query_args: list[Any] | None = None, *, refresh: bool = False
+    ) -> list[T]:
+        """
+        runs `query` and decodes the rows into `table` instances. with an identity map, rows already loaded are the
+        same instances as before, `refresh` overwrites their fields with the new rows (writes returning rows do)
+        """
         if isinstance(query, QueryBuilder):
             query = query.get_sql()
 
@@ -80,9 +262,46 @@ class Executor:
         query_args = query_args or []
 
         async with self.acquire() as connection:
-            records = await connection.fetch(query, *query_args)
+            records = await self._fetch(connection, query, query_args)
 
-        return [_turn_record_into_orm_instance(table, record) for record in records]
+        return _turn_records_into_orm_instances(table, records, self.identity_map, refresh)
+
+    async def _read(self, query: str, query_args: list[Any], *, primary: bool = False) -> list[asyncpg.Record]:
+        """
+        like `execute_raw` for queries that only read, which may go to a replica unless `primary`, see
+        `Postgres.connect_pool`
+        """
+        if not self.is_connected():
+            raise P3ormException("not connected")
+
+        return await self._fetch_read(query.replace(" IN ()", " IN (NULL)"), query_args, primary)
+
+    async def _fetch_read(self, query: str, query_args: list[Any], primary: bool = False) -> list[asyncpg.Record]:
+        async with self.acquire_read(primary=primary) as connection:
+            return await self._fetch(connection, query, query_args)
+
+    async def _select(
+        self, table: Type[T], query: str, query_args: list[Any], related: PrefetchTree | None, *, primary: bool = False
+    ) -> list[T]:
+        records = await self._read(query, query_args, primary=primary)
+        items = _turn_records_into_orm_instances(table, records, self.identity_map)
+
+        if related:
+            hydrate_related(table, related, items, records, self.identity_map)
+
+        return items
+
+    async def _fetch(self, connection: asyncpg.Connection, query: str, query_args: list[Any]) -> list[asyncpg.Record]:
+        if self.statement_cache:
+            return await self.statement_cache.fetch(connection, query, query_args)
+
+        return await connection.fetch(query, *query_args)
+
+    async def _execute(self, connection: asyncpg.Connection, query: str, query_args: list[Any]) -> str:
+        if self.statement_cache:
+            return await self.statement_cache.execute(connection, query, query_args)
+
+        return await connection.execute(query, *query_args)
 
     async def count(
         self,
@@ -93,13 +312,9 @@ class Executor:
         if criterion is not None and not isinstance(criterion, Criterion):
             raise P3ormException(f"{criterion=} must be instance of Criterion. did you wrap the field with `f()`?")
 
-        query = table.select(fn.Count("*"))
-        query_args = None
-        if criterion:
-            parameterized_criterion, query_args = parameterize(criterion)
-            query = query.where(parameterized_criterion)
+        query, query_args = compile_select(table, criterion, count=True)
 
-        res = await self.execute_raw(query, query_args)
+        res = await self._read(query, query_args)
 
         return res[0]["count"]
 
@@ -113,33 +328,29 @@ class Executor:
         by: PyPikaField | list[PyPikaField] | None = None,
         limit: int | None = None,
         offset: int | None = None,
+        only: Sequence[Any] | None = None,
+        defer: Sequence[Any] | None = None,
         prefetch: RELATIONS_TYPE | None = None,
+        prefetch_strategy: PrefetchStrategy = PrefetchStrategy.select,
     ) -> list[T]:
         if criterion is not None and not isinstance(criterion, Criterion):
             raise P3ormException(f"{criterion=} must be instance of Criterion. did you wrap the field with `f()`?")
 
-        query = table.select()
-
-        query_args = None
-        if criterion:
-            parameterized_criterion, query_args = parameterize(criterion)
-            query = query.where(parameterized_criterion)
-
-        if by:
-            query = query.orderby(
-                *(by if isinstance(by, list) else [by]),
-                **({"order": order} if order else {}),
-            )
-
-        if limit is not None:
-            query = query.limit(limit)
-
-        if offset is not None:
-            query = query.offset(offset)
+        related = _joined_prefetch(table, prefetch, prefetch_strategy)
+        query, query_args = compile_select(
+            table,
+            criterion,
+            order=order,
+            by=by,
+            limit=limit,
+            offset=offset,
+            columns=projection(table, only, defer),
+            related=related,
+        )
 
-        records = await self.execute(table, query, query_args)
+        records = await self._select(table, query, query_args, related)
 
-        if prefetch:
+        if prefetch and not related:
             await self.fetch_related(table, records, prefetch)
 
         return records
@@ -150,23 +361,32 @@ class Executor:
         table: Type[T],
         criterion: Criterion | None = None,
         *,
+        only: Sequence[Any] | None = None,
+        defer: Sequence[Any] | None = None,
         prefetch: RELATIONS_TYPE | None = None,
+        prefetch_strategy: PrefetchStrategy = PrefetchStrategy.select,
     ) -> T:
-        query: QueryBuilder = table.select()
-
-        query_args: list[Any] = []
-        if criterion:
-            paramaterized_criterion, query_args = parameterize(criterion)
-            query = query.where(paramaterized_criterion)
+        related = _joined_prefetch(table, prefetch, prefetch_strategy)
+        columns = projection(table, only, defer)
+        cache_key = self._cache_key(table, criterion) if not (related or columns) else None
 
-        query = query.limit(2)
+        if cache_key is not None and (cached := cast(LRUCache, table.__memo__.cache).get(cache_key)) is not None:
+            records = [_copy_instance(table, cached)]
+        else:
+            generation = cast(LRUCache, table.__memo__.cache).generation(cache_key) if cache_key is not None else 0
+            query, query_args = compile_select(table, criterion, limit=2, columns=columns, related=related)
+            # a replica may not have replayed the write that invalidated the key yet, what's cached is read from the
+            # primary
+            records = await self._select(table, query, query_args, related, primary=cache_key is not None)
 
-        records = await self.execute(table, query, query_args)
+            # not cached when the key was invalidated during the read, the row may be from before the write
+            if cache_key is not None and len(records) == 1:
+                cast(LRUCache, table.__memo__.cache).put(cache_key, _copy_instance(table, records[0]), generation)
 
         if len(records) != 1:
             raise P3ormException(f"expected one result in {table.__name__} where {criterion=}, found {len(records)}")
 
-        if prefetch:
+        if prefetch and not related:
             await self.fetch_related(table, records, prefetch)
 
         return records[0]
@@ -177,26 +397,161 @@ class Executor:
         table: Type[T],
         criterion: Criterion | None = None,
         *,
+        only: Sequence[Any] | None = None,
+        defer: Sequence[Any] | None = None,
         prefetch: RELATIONS_TYPE | None = None,
+        prefetch_strategy: PrefetchStrategy = PrefetchStrategy.select,
     ) -> T | None:
-        query = table.select()
-        query_args = None
-        if criterion:
-            parameterized_criterion, query_args = parameterize(criterion)
-            query = query.where(parameterized_criterion)
+        related = _joined_prefetch(table, prefetch, prefetch_strategy)
+        columns = projection(table, only, defer)
+        cache_key = self._cache_key(table, criterion) if not (related or columns) else None
 
-        query = query.limit(1)
+        if cache_key is not None and (cached := cast(LRUCache, table.__memo__.cache).get(cache_key)) is not None:
+            records = [_copy_instance(table, cached)]
+        else:
+            generation = cast(LRUCache, table.__memo__.cache).generation(cache_key) if cache_key is not None else 0
+            query, query_args = compile_select(table, criterion, limit=1, columns=columns, related=related)
+            # a replica may not have replayed the write that invalidated the key yet, what's cached is read from the
+            # primary
+            records = await self._select(table, query, query_args, related, primary=cache_key is not None)
 
-        records = await self.execute(table, query, query_args)
+            # not cached when the key was invalidated during the read, the row may be from before the write
+            if cache_key is not None and records:
+                cast(LRUCache, table.__memo__.cache).put(cache_key, _copy_instance(table, records[0]), generation)
 
         if len(records) == 0:
             return None
 
-        if prefetch:
+        if prefetch and not related:
             await self.fetch_related(table, records, prefetch)
 
         return records[0]
 
+    async def fetch_page(
+        self,
+        /,
+        table: Type[T],
+        criterion: Criterion | None = None,
+        *,
+        order: Order | None = None,
+        by: PyPikaField | list[PyPikaField] | None = None,
+        limit: int,
+        after: str | None = None,
+        only: Sequence[Any] | None = None,
+        defer: Sequence[Any] | None = None,
+        prefetch: RELATIONS_TYPE | None = None,
+    ) -> Page[T]:
+        """
+        keyset pagination: `after` (the previous page's `next`) becomes `WHERE (by..., pk...) > (...)`, so every
+        page costs the same however deep it is. `by` can't be a nullable column, the seek never matches NULL
+        """
+        if criterion is not None and not isinstance(criterion, Criterion):
+            raise P3ormException(f"{criterion=} must be instance of Criterion. did you wrap the field with `f()`?")
+
+        memo = table.__memo__
+        by_fields = (by if isinstance(by, list) else [by]) if by is not None else []
+
+        # the primary key breaks ties so the order is total and no row is skipped or repeated between pages
+        by_names = {field.name for field in by_fields}
+        keys = [*by_fields, *(pk._pypika_field for pk in memo.pk if pk.column_name not in by_names)]
+
+        if unknown := [key for key in keys if key.name not in memo.columns]:
+            raise P3ormException(f"can only page {table.__name__} by its own columns, got {unknown}")
+
+        # a page ending on NULL would seek past `(by) > (NULL)`, which matches nothing, and end the pages early
+        if nullable := [key.name for key in keys if is_optional(memo.columns[key.name]._data_type)]:
+            raise P3ormException(f"can't page {table.__name__} by nullable columns, got {nullable}")
+
+        columns = projection(table, only, defer)
+
+        if columns and (unloaded := [key.name for key in keys if key.name not in columns]):
+            raise P3ormException(f"can't page {table.__name__} by columns that aren't selected, got {unloaded}")
+
+        if after is not None:
+            values = decode_cursor(after)
+
+            if len(values) != len(keys):
+                raise P3ormException(f"page token doesn't match the ordering of {table.__name__}")
+
+            seek = Tuple(*keys) < Tuple(*values) if order == Order.desc else Tuple(*keys) > Tuple(*values)
+            criterion = seek if criterion is None else criterion & seek
+
+        # one extra row tells whether another page follows
+        query, query_args = compile_select(table, criterion, order=order, by=keys, limit=limit + 1, columns=columns)
+
+        items = await self._select(table, query, query_args, None)
+        next_token = None
+
+        if len(items) > limit:
+            items = items[:limit]
+            next_token = encode_cursor([getattr(items[-1], memo.columns[key.name]._field_name) for key in keys])
+
+        if prefetch:
+            await self.fetch_related(table, items, prefetch)
+
+        return Page(items=items, next=next_token)
+
+    async def fetch_iter(
+        self,
+        /,
+        table: Type[T],
+        criterion: Criterion | None = None,
+        *,
+        order: Order | None = None,
+        by: PyPikaField | list[PyPikaField] | None = None,
+        chunk_size: int = 1000,
+        only: Sequence[Any] | None = None,
+        defer: Sequence[Any] | None = None,
+        prefetch: RELATIONS_TYPE | None = None,
+    ) -> AsyncGenerator[T, None]:
+        """
+        streams rows through a server side cursor `chunk_size` at a time. wrap it in `contextlib.aclosing` when
+        stopping early so the cursor's connection is given back right away. in an identity map scope, rows already
+        in the map are the instances there, but streamed rows aren't added to it, it would hold all of them
+        """
+        if criterion is not None and not isinstance(criterion, Criterion):
+            raise P3ormException(f"{criterion=} must be instance of Criterion. did you wrap the field with `f()`?")
+
+        query, query_args = compile_select(table, criterion, order=order, by=by, columns=projection(table, only, defer))
+
+        # the cursor reads the next chunk while the current one is decoded and consumed. that needs a pool
+        # connection of its own, a shared connection must stay free for prefetching and for the caller's queries
+        read_ahead = self.pool is not None
+
+        async with self.acquire_read() as connection:
+            # server side cursors only live inside a transaction
+            async with nullcontext() if connection.is_in_transaction() else connection.transaction():
+                cursor = await connection.cursor(query, *query_args)
+                records = await cursor.fetch(chunk_size)
+                next_records: asyncio.Future[list[asyncpg.Record]] | None = None
+
+                try:
+                    while records:
+                        if read_ahead:
+                            next_records = asyncio.ensure_future(cursor.fetch(chunk_size))
+
+                        # what the chunk adds goes in the front map, dropped with the chunk
+                        identity_map = ChainMap({}, self.identity_map) if self.identity_map is not None else None
+                        items = _turn_records_into_orm_instances(table, records, cast(IdentityMap, identity_map))
+
+                        if prefetch:
+                            await _fetch_related(self, table, items, prefetch, cast(IdentityMap, identity_map))
+
+                        for item in items:
+                            yield item
+
+                        if next_records:
+                            records, next_records = await next_records, None
+                        else:
+                            records = await cursor.fetch(chunk_size)
+
+                finally:
+                    # let a read ahead finish before the transaction closes if iteration stopped early
+                    if next_records:
+                        with suppress(Exception):
+                            await next_records
+
+    @overload
     async def insert_one(
         self,
         /,
@@ -204,20 +559,61 @@ class Executor:
         item: T,
         *,
         prefetch: RELATIONS_TYPE | None = None,
+        returning: Literal[True, "minimal"] = True,
     ) -> T:
+        ...
+
+    @overload
+    async def insert_one(
+        self,
+        /,
+        table: Type[T],
+        item: T,
+        *,
+        prefetch: None = None,
+        returning: Literal[False],
+    ) -> int:
+        ...
+
+    async def insert_one(
+        self,
+        /,
+        table: Type[T],
+        item: T,
+        *,
+        prefetch: RELATIONS_TYPE | None = None,
+        returning: bool | Literal["minimal"] = True,
+    ) -> T | int:
+        """
+        `returning=False` only returns how many rows were inserted. "minimal" reads back just the primary key and
+        the columns the database generates, and sets them on `item`, which is returned
+        """
+        if prefetch and not returning:
+            raise P3ormException("prefetch needs the inserted row, it can't be used with returning=False")
+
+        _check_insertable(table, [item])
         columns, [params], query_args = _insert_vals(table, [item])
 
         query: PostgreSQLQueryBuilder = PostgreSQLQuery.into(table.__tablename__).columns(*columns)
         query = query.insert(*params)
-        query = query.returning("*")
 
-        [record] = await self.execute(table, query, query_args)
+        if not returning:
+            async with self.acquire() as connection:
+                count = _status_count(await self._execute(connection, query.get_sql(), query_args))
+
+            # without the row read back, a key the database generated isn't known and the whole table is invalidated
+            await self._invalidate(table, [item])
+            return count
+
+        [record] = await self._write_returning(table, query, query_args, [item], returning)
+        await self._invalidate(table, [record])
 
         if prefetch:
             await self.fetch_related(table, [record], prefetch)
 
         return record
 
+    @overload
     async def insert_many(
         self,
         /,
@@ -225,26 +621,189 @@ class Executor:
         items: list[T],
         *,
         prefetch: RELATIONS_TYPE | None = None,
+        mode: InsertMode = InsertMode.values,
+        chunk_size: int | None = None,
+        atomic: bool = True,
+        returning: Literal[True, "minimal"] = True,
     ) -> list[T]:
+        ...
+
+    @overload
+    async def insert_many(
+        self,
+        /,
+        table: Type[T],
+        items: list[T],
+        *,
+        prefetch: None = None,
+        mode: InsertMode = InsertMode.values,
+        chunk_size: int | None = None,
+        atomic: bool = True,
+        returning: Literal[False],
+    ) -> int:
+        ...
+
+    async def insert_many(
+        self,
+        /,
+        table: Type[T],
+        items: list[T],
+        *,
+        prefetch: RELATIONS_TYPE | None = None,
+        mode: InsertMode = InsertMode.values,
+        chunk_size: int | None = None,
+        atomic: bool = True,
+        returning: bool | Literal["minimal"] = True,
+    ) -> list[T] | int:
+        """
+        `returning=False` only returns how many rows were inserted. "minimal" reads back just the primary keys and
+        the columns the database generates, and sets them on `items`, which are returned
+        """
+        if prefetch and not returning:
+            raise P3ormException("prefetch needs the inserted rows, it can't be used with returning=False")
+
         if not items:
-            return []
+            return [] if returning else 0
 
-        columns, params_list, query_args = _insert_vals(table, items)
+        _check_insertable(table, items)
 
-        query: PostgreSQLQueryBuilder = PostgreSQLQuery.into(table.__tablename__).columns(*columns)
+        async with self.acquire() as connection:
+            if mode == InsertMode.copy:
+                inserted = await _copy_insert(self, connection, table, items, returning)
+            elif mode == InsertMode.unnest:
+                inserted = await _unnest_insert(self, connection, table, items, returning, chunk_size, atomic)
+            else:
+                inserted = await _values_insert(self, connection, table, items, returning, chunk_size, atomic)
+
+        if isinstance(inserted, int):
+            await self._invalidate(table, items)
+            return inserted
 
-        for params in params_list:
-            query = query.insert(*params)
+        await self._invalidate(table, inserted)
 
-        query = query.returning("*")
+        if prefetch:
+            await self.fetch_related(table, inserted, prefetch)
+
+        return inserted
+
+    @overload
+    async def upsert_many(
+        self,
+        /,
+        table: Type[T],
+        items: list[T],
+        conflict: Sequence[Any],
+        update: Sequence[Any] | Literal["all"] = "all",
+        *,
+        prefetch: RELATIONS_TYPE | None = None,
+        mode: InsertMode = InsertMode.values,
+        chunk_size: int | None = None,
+        atomic: bool = True,
+        returning: Literal[True, "minimal"] = True,
+    ) -> list[T]:
+        ...
+
+    @overload
+    async def upsert_many(
+        self,
+        /,
+        table: Type[T],
+        items: list[T],
+        conflict: Sequence[Any],
+        update: Sequence[Any] | Literal["all"] = "all",
+        *,
+        prefetch: None = None,
+        mode: InsertMode = InsertMode.values,
+        chunk_size: int | None = None,
+        atomic: bool = True,
+        returning: Literal[False],
+    ) -> int:
+        ...
+
+    async def upsert_many(
+        self,
+        /,
+        table: Type[T],
+        items: list[T],
+        conflict: Sequence[Any],
+        update: Sequence[Any] | Literal["all"] = "all",
+        *,
+        prefetch: RELATIONS_TYPE | None = None,
+        mode: InsertMode = InsertMode.values,
+        chunk_size: int | None = None,
+        atomic: bool = True,
+        returning: bool | Literal["minimal"] = True,
+    ) -> list[T] | int:
+        """
+        inserts `items`, and where a row with the same `conflict` fields already exists, overwrites its `update`
+        fields instead. "all" is every field but the conflict fields, the primary key and the ones the database
+        generates, an empty `update` leaves existing rows alone and they aren't returned. items with the same
+        conflict fields are merged, the last one wins. fields are given as `Table.field` or `f(Table.field)`.
+        `returning` is as in `insert_many`
+        """
+        if prefetch and not returning:
+            raise P3ormException("prefetch needs the upserted rows, it can't be used with returning=False")
+
+        if not conflict:
+            raise P3ormException("upsert_many needs the `conflict` fields of a unique index or constraint")
+
+        memo = table.__memo__
+        conflict_columns = [_column_name(table, field) for field in conflict]
+
+        if update == "all":
+            update_columns = [
+                column
+                for column, field in memo.columns.items()
+                if column not in conflict_columns and not (field.pk or field.db_gen)
+            ]
+        else:
+            update_columns = [_column_name(table, field) for field in update]
+
+        _check_insertable(table, items)
+
+        # postgres won't let one statement affect a row twice
+        by_key: dict[object, T] = {}
+        for item in items:
+            key = tuple(getattr(item, memo.columns[column]._field_name) for column in conflict_columns)
+            # a generated conflict field can't conflict, those items are always kept
+            by_key[object() if any(isinstance(value, DB_GENERATED) for value in key) else key] = item
+
+        items = list(by_key.values())
+        on_conflict = OnConflict(conflict_columns, update_columns)
+
+        if not items:
+            return [] if returning else 0
 
-        records = await self.execute(table, query, query_args)
+        async with self.acquire() as connection:
+            if mode == InsertMode.copy:
+                upserted = await _copy_insert(self, connection, table, items, returning, on_conflict)
+            elif mode == InsertMode.unnest:
+                upserted = await _unnest_insert(
+                    self, connection, table, items, returning, chunk_size, atomic, on_conflict
+                )
+            else:
+                upserted = await _values_insert(
+                    self, connection, table, items, returning, chunk_size, atomic, on_conflict
+                )
+
+        if isinstance(upserted, int):
+            # the rows aren't read back. the keys sent are the keys written only when they're what conflicts, a
+            # conflict on another unique column updates the existing row whatever key was sent
+            if set(conflict_columns) == {field.column_name for field in memo.pk}:
+                await self._invalidate(table, items)
+            else:
+                await self._invalidate_table(table)
+
+            return upserted
+
+        await self._invalidate(table, upserted)
 
         if prefetch:
-            await self.fetch_related(table, records, prefetch)
+            await self.fetch_related(table, upserted, prefetch)
 
-        return records
+        return upserted
 
+    @overload
     async def update_one(
         self,
         /,
@@ -252,73 +811,464 @@ class Executor:
         item: T,
         *,
         prefetch: RELATIONS_TYPE | None = None,
+        returning: Literal[True, "minimal"] = True,
     ) -> T:
+        ...
+
+    @overload
+    async def update_one(
+        self,
+        /,
+        table: Type[T],
+        item: T,
+        *,
+        prefetch: None = None,
+        returning: Literal[False],
+    ) -> int:
+        ...
+
+    async def update_one(
+        self,
+        /,
+        table: Type[T],
+        item: T,
+        *,
+        prefetch: RELATIONS_TYPE | None = None,
+        returning: bool | Literal["minimal"] = True,
+    ) -> T | int:
+        """
+        writes the fields of `item` changed since it was loaded, or all of them when it wasn't loaded from the
+        database. when nothing changed there's no query and `item` itself is returned. `returning=False` only
+        returns how many rows were updated. "minimal" reads back just the primary key and the columns the database
+        generates, and sets them on `item`, which is returned
+        """
+        if prefetch and not returning:
+            raise P3ormException("prefetch needs the updated row, it can't be used with returning=False")
+
+        changed = _changed_fields(table, item)
+
+        if changed is not None and not changed:
+            if prefetch:
+                await self.fetch_related(table, [item], prefetch)
+
+            return item if returning else 0
+
         query = table.update()
 
         for pk in table.__memo__.pk:
             query = query.where(pk._pypika_field == getattr(item, pk._field_name))
 
-        columns, [params], query_args = _insert_vals(table, [item])
+        [row] = _encode_rows(table, [item])
+        query_args: list[Any] = []
+
+        for field, value in zip(table.__memo__.fields.values(), row):
+            # columns left out of the select that loaded `item` keep what's stored, so do unchanged ones
+            if isinstance(value, UNLOADED_COLUMN) or (changed is not None and field._field_name not in changed):
+                continue
+
+            if isinstance(value, DB_GENERATED):
+                query = query.set(field.column_name, DEFAULT)
+            else:
+                query_args.append(value)
+                query = query.set(field.column_name, _param(len(query_args)))
+
+        if not returning:
+            async with self.acquire() as connection:
+                count = _status_count(await self._execute(connection, query.get_sql(), query_args))
 
-        for i, column in enumerate(columns):
-            query = query.set(column, params[i])
+            await self._invalidate(table, [item])
+            _mark_loaded(table, item)
 
-        query = query.returning("*")
+            return count
 
-        [record] = await self.execute(table, query, query_args)
+        [record] = await self._write_returning(table, query, query_args, [item], returning)
+        await self._invalidate(table, [item, record])
+
+        # `item` was written, so the next update of it compares against what it holds now
+        _mark_loaded(table, item)
 
         if prefetch:
             await self.fetch_related(table, [record], prefetch)
 
         return record
 
-    async def delete(
+    @overload
+    async def update_many(
         self,
         /,
         table: Type[T],
         items: list[T],
+        fields: Sequence[Any] | None = None,
+        *,
+        prefetch: RELATIONS_TYPE | None = None,
+        chunk_size: int | None = None,
+        atomic: bool = True,
+        returning: Literal[True] = True,
     ) -> list[T]:
-        if not items:
-            return []
+        ...
 
-        query = table.delete()
+    @overload
+    async def update_many(
+        self,
+        /,
+        table: Type[T],
+        items: list[T],
+        fields: Sequence[Any] | None = None,
+        *,
+        prefetch: None = None,
+        chunk_size: int | None = None,
+        atomic: bool = True,
+        returning: Literal[False],
+    ) -> int:
+        ...
 
-        for pk in table.__memo__.pk:
-            query = query.where(pk._pypika_field.isin([getattr(item, pk._field_name) for item in items]))
+    async def update_many(
+        self,
+        /,
+        table: Type[T],
+        items: list[T],
+        fields: Sequence[Any] | None = None,
+        *,
+        prefetch: RELATIONS_TYPE | None = None,
+        chunk_size: int | None = None,
+        atomic: bool = True,
+        returning: bool = True,
+    ) -> list[T] | int:
+        """
+        updates the rows of `items` by primary key, joined against all of their values in one statement (or one per
+        `chunk_size` rows). only `fields`, given as `Table.field` or `f(Table.field)`, are set when passed, the
+        primary key never is. like `update_one`, items loaded from the database only have their changed fields
+        written and are returned as they are when nothing changed. rows that no longer exist are left out of what's
+        returned
+        """
+        if prefetch and not returning:
+            raise P3ormException("prefetch needs the updated rows, it can't be used with returning=False")
 
-        query = query.returning("*")
+        if not items:
+            return [] if returning else 0
 
-        record = await self.execute(table, query)
+        columns = None if fields is None else {_column_name(table, field) for field in fields}
 
-        return record
+        async with self.acquire() as connection:
+            updated = await _bulk_update(self, connection, table, items, columns, returning, chunk_size, atomic)
 
-    async def fetch_related(self, /, table: Type[T], items: list[T], relations: RELATIONS_TYPE) -> list[T]:
-        if pool := self.pool:
-            connection = await self.pool.acquire()
+        await self._invalidate(table, items)
 
-        elif not (connection := self.connection):
-            raise P3ormException("not connected")
+        if isinstance(updated, int):
+            return updated
 
-        try:
-            await _fetch_related(table, items, relations, connection)
+        if prefetch:
+            await self.fetch_related(table, updated, prefetch)
 
-        finally:
-            if pool := self.pool:
-                await pool.release(connection)
+        return updated
 
-        return items
+    @overload
+    async def delete(self, /, table: Type[T], items: list[T], *, returning: Literal[True, "minimal"] = True) -> list[T]:
+        ...
 
-    def acquire(self) -> ConnectionContext | asyncpg.pool.PoolAcquireContext:
-        if self.connection:
-            return ConnectionContext(self.connection)
+    @overload
+    async def delete(self, /, table: Type[T], items: list[T], *, returning: Literal[False]) -> int:
+        ...
 
-        elif self.pool:
+    async def delete(
+        self,
+        /,
+        table: Type[T],
+        items: list[T],
+        *,
+        returning: bool | Literal["minimal"] = True,
+    ) -> list[T] | int:
+        """
+        `returning=False` only returns how many rows were deleted. "minimal" reads back just the primary keys and
+        returns the `items` whose rows were deleted
+        """
+        if not items:
+            return [] if returning else 0
+
+        query = table.delete()
+
+        for pk in table.__memo__.pk:
+            query = query.where(pk._pypika_field.isin([getattr(item, pk._field_name) for item in items]))
+
+        if not returning:
+            async with self.acquire() as connection:
+                count = _status_count(await self._execute(connection, query.get_sql(), []))
+
+            records = items
+
+        elif returning == "minimal":
+            records = await self.execute_raw(query.returning(*(pk.column_name for pk in table.__memo__.pk)))
+            deleted = {_instance_pk(table, record) for record in records}
+            records = [item for item in items if _item_pk(table, item) in deleted]
+
+        else:
+            records = await self.execute(table, query.returning("*"), refresh=True)
+
+        await self._invalidate(table, items)
+
+        # deleted rows leave the identity map, the instances handed back are the ones it held
+        if (identity_map := self.identity_map) is not None:
+            for record in records:
+                identity_map.pop((table, _item_pk(table, record)), None)
+
+        return records if returning else count
+
+    @overload
+    async def update_where(
+        self, /, table: Type[T], criterion: Criterion, set: dict[Any, Any], *, returning: Literal[False] = False
+    ) -> int:
+        ...
+
+    @overload
+    async def update_where(
+        self, /, table: Type[T], criterion: Criterion, set: dict[Any, Any], *, returning: Literal[True]
+    ) -> list[T]:
+        ...
+
+    async def update_where(
+        self, /, table: Type[T], criterion: Criterion, set: dict[Any, Any], *, returning: bool = False
+    ) -> list[T] | int:
+        """
+        updates every row matching `criterion` in one statement, without loading them first. `set` maps fields,
+        given as `Table.field` or `f(Table.field)`, to values or to expressions the database computes, e.g.
+        `{Post.views: f(Post.views) + 1}`. returns how many rows were updated, or the rows with `returning=True`
+        """
+        if not set:
+            raise P3ormException("update_where needs at least one field to `set`")
+
+        memo = table.__memo__
+        query = table.update()
+        query_args: list[Any] = []
+
+        for field, value in set.items():
+            column_name = _column_name(table, field)
+
+            if isinstance(value, Term):
+                query = query.set(column_name, parameterize_term(value, query_args))
+            else:
+                encoder = memo.encoders[memo.columns[column_name]._field_name]
+                query_args.append(value if encoder is None or not value else encoder(value))
+                query = query.set(column_name, _param(len(query_args)))
+
+        parameterized_criterion, _ = parameterize(criterion, query_args)
+        query = query.where(parameterized_criterion)
+
+        if returning:
+            items = await self.execute(table, query.returning("*"), query_args, refresh=True)
+            await self._invalidate(table, items)
+            return items
+
+        return await self._write_where(table, query, query_args)
+
+    @overload
+    async def delete_where(self, /, table: Type[T], criterion: Criterion, *, returning: Literal[False] = False) -> int:
+        ...
+
+    @overload
+    async def delete_where(self, /, table: Type[T], criterion: Criterion, *, returning: Literal[True]) -> list[T]:
+        ...
+
+    async def delete_where(self, /, table: Type[T], criterion: Criterion, *, returning: bool = False) -> list[T] | int:
+        """
+        deletes every row matching `criterion` in one statement, without loading them first. returns how many rows
+        were deleted, or the rows with `returning=True`
+        """
+        parameterized_criterion, query_args = parameterize(criterion)
+        query = table.delete().where(parameterized_criterion)
+
+        if not returning:
+            return await self._write_where(table, query, query_args)
+
+        items = await self.execute(table, query.returning("*"), query_args, refresh=True)
+        await self._invalidate(table, items)
+
+        if (identity_map := self.identity_map) is not None:
+            for item in items:
+                identity_map.pop((table, _item_pk(table, item)), None)
+
+        return items
+
+    async def _write_returning(
+        self,
+        table: Type[T],
+        query: PostgreSQLQueryBuilder,
+        query_args: list[Any],
+        items: list[T],
+        returning: Literal[True, "minimal"],
+    ) -> list[T]:
+        if returning != "minimal":
+            return await self.execute(table, query.returning("*"), query_args, refresh=True)
+
+        records = await self.execute_raw(
+            f"{query.get_sql()} RETURNING {_returning_columns(table, returning)}", query_args
+        )
+        return _returned_instances(self, table, items, records, returning)
+
+    async def _write_where(self, table: Type[T], query: PostgreSQLQueryBuilder, query_args: list[Any]) -> int:
+        memo = table.__memo__
+
+        if memo.cache is None and self.identity_map is None:
+            async with self.acquire() as connection:
+                return _status_count(await self._execute(connection, query.get_sql(), query_args))
+
+        # just the keys come back, to drop the rows from the cache and the identity map
+        records = await self.execute_raw(query.returning(*(pk.column_name for pk in memo.pk)), query_args)
+        keys = [_instance_pk(table, record) for record in records]
+
+        await self._invalidate_keys(table, keys)
+
+        if (identity_map := self.identity_map) is not None:
+            for key in keys:
+                identity_map.pop((table, key), None)
+
+        return len(records)
+
+    async def fetch_related(self, /, table: Type[T], items: list[T], relations: RELATIONS_TYPE) -> list[T]:
+        """
+        loads `relations` onto `items`. with a pool, independent paths are loaded at the same time on up to
+        `prefetch_concurrency` connections. on a single connection or in a transaction they're loaded in turn
+        """
+        if not self.pool and not self.connection:
+            raise P3ormException("not connected")
+
+        await _fetch_related(self, table, items, relations)
+
+        return items
+
+    def prepare(
+        self,
+        /,
+        table: Type[T],
+        criterion: Criterion | None = None,
+        *,
+        order: Order | None = None,
+        by: PyPikaField | list[PyPikaField] | None = None,
+        limit: int | Bind | None = None,
+        offset: int | Bind | None = None,
+        only: Sequence[Any] | None = None,
+        defer: Sequence[Any] | None = None,
+        prefetch: RELATIONS_TYPE | None = None,
+    ) -> PreparedQuery[T]:
+        return PreparedQuery(
+            self,
+            table,
+            criterion,
+            order=order,
+            by=by,
+            limit=limit,
+            offset=offset,
+            only=only,
+            defer=defer,
+            prefetch=prefetch,
+        )
+
+    def batch(self) -> Batch:
+        """
+        collects fetches and counts to send them as a single statement, for handlers that make several independent
+        reads. each call gives back a `BatchResult`, awaited for its value once the `async with` block is over
+        (awaiting one inside the block sends what's been collected so far):
+
+            async with db.batch() as batch:
+                company = batch.fetch_one(Company, f(Company.id) == 1)
+                employees = batch.fetch_all(Employee, f(Employee.company_id) == 1)
+                count = batch.count(Employee)
+
+            company, employees, count = await company, await employees, await count
+        """
+        return Batch(self)
+
+    def _cache_key(self, table: Type[T], criterion: Criterion | None) -> Any:
+        """the primary key that `criterion` looks up when it's `f(Table.pk) == value` on a cached table"""
+        memo = table.__memo__
+
+        if memo.cache is None or len(memo.pk) != 1:
+            return None
+
+        if (
+            isinstance(criterion, BasicCriterion)
+            and criterion.comparator == Equality.eq
+            and isinstance(criterion.left, PyPikaField)
+            and criterion.left.name == memo.pk[0].column_name
+            and isinstance(criterion.right, ValueWrapper)
+        ):
+            value = criterion.right.value
+
+            # the key has to be the one invalidation drops, the pk as its field's type. a uuid looked up by its string
+            # would otherwise be cached under the string and outlive updates to the row
+            try:
+                return value if isinstance(value, get_base_type(memo.pk[0]._data_type)) else _pk_from_json(table, value)
+            except (TypeError, ValueError):
+                return None
+
+        return None
+
+    async def _invalidate(self, table: Type[T], items: list[T]) -> list[Any]:
+        """drops the keys of `items` from the table's cache, and tells other processes to when listening"""
+        return await self._invalidate_keys(table, [_item_pk(table, item) for item in items])
+
+    async def _invalidate_keys(self, table: Type[T], keys: list[Any]) -> list[Any]:
+        if (cache := table.__memo__.cache) is None:
+            return []
+
+        # rows written without knowing their key could be any of the cached ones
+        if any(isinstance(value, DB_GENERATED) for key in keys for value in (key if type(key) is tuple else [key])):
+            await self._invalidate_table(table)
+            return []
+
+        keys = list(dict.fromkeys(keys))
+
+        for key in keys:
+            cache.pop(key)
+
+        await self._notify_invalidation(_invalidation_payloads(table, keys))
+
+        return keys
+
+    async def _invalidate_table(self, table: Type[T]) -> None:
+        """empties the table's cache, for writes that don't know which rows they touched"""
+        if (cache := table.__memo__.cache) is None:
+            return
+
+        cache.clear()
+        await self._notify_invalidation([json.dumps([table.__tablename__, None])])
+
+    async def _notify_invalidation(self, payloads: list[str]) -> None:
+        # in a transaction the notifications go out on commit, and not at all on rollback
+        if self.invalidation_channel and self.notify_writes:
+            await self.execute_raw(
+                "SELECT pg_notify($1, payload) FROM unnest($2::text[]) AS payload",
+                [self.invalidation_channel, payloads],
+            )
+
+    def acquire(self) -> AsyncContextManager[asyncpg.Connection]:
+        if self.connection:
+            return ConnectionContext(self.connection)
+
+        elif self.pool:
             return self.pool.acquire()
 
         raise P3ormException("not connected")
 
+    def acquire_read(self, *, primary: bool = False) -> AsyncContextManager[asyncpg.Connection]:
+        """a connection for queries that only read, see `Postgres.connect_pool`"""
+        return self.acquire()
+
 
 class Postgres(Driver, Executor):
+    # connection notifications arrive on, see `listen_invalidations`, and the task listening again once it's lost
+    _listener: asyncpg.Connection | None = None
+    _relisten: asyncio.Future[None] | None = None
+
+    # see `connect_pool`
+    replicas: tuple[asyncpg.Pool, ...] = ()
+    replica_policy: ReplicaPolicy = ReplicaPolicy.round_robin
+    _next_replica: int = 0
+    # the latest WAL position each replica was seen to have replayed
+    _replayed: dict[asyncpg.Pool, int]
+    _hedge: LatencyWindow | None = None
+    # hedged attempts that lost, referenced until their cancellation is through
+    _losers: set[asyncio.Future[list[asyncpg.Record]]]
+
     async def connect(
         self,
         dsn: str | None = None,
@@ -329,12 +1279,16 @@ class Postgres(Driver, Executor):
         host: str | None = None,
         port: int | None = None,
         init: Callable[[asyncpg.Connection], Coroutine[None, None, None]] | None = None,
+        statement_cache_size: int = 0,
         **asyncpg_kwargs: dict[Any, Any],
     ) -> None:
         if self.is_connected():
             raise P3ormException("already connected")
 
         self.pool = None
+        # statement_cache_size=0 (the default) never reuses prepared statements, which is what pgbouncer in
+        # transaction mode needs. asyncpg's own cache stays off either way, p3orm's keeps hit/miss stats
+        self.statement_cache = StatementCache(statement_cache_size) if statement_cache_size > 0 else None
         self.connection = cast(
             asyncpg.Connection,
             await asyncpg.connect(
@@ -364,13 +1318,32 @@ class Postgres(Driver, Executor):
         init: Callable[[asyncpg.Connection], Coroutine[None, None, None]] | None = None,
         min_size: int = 10,
         max_size: int = 10,
+        statement_cache_size: int = 0,
+        prefetch_concurrency: int = 4,
+        replicas: Sequence[str | dict[str, Any]] = (),
+        replica_policy: ReplicaPolicy = ReplicaPolicy.round_robin,
+        hedge: HedgeConfig | None = None,
         **asyncpg_kwargs: dict[Any, Any],
     ) -> None:
+        """
+        `replicas` are read only standbys, each a dsn or the connection arguments that differ from the primary's.
+        every one gets a pool of its own, and fetches, counts and prefetches are spread over them by
+        `replica_policy`. writes and transactions stay on the primary. reads don't wait for replication unless
+        they're in a `read_your_writes` scope.
+
+        with `hedge`, a read to a replica that hasn't answered by the `hedge.percentile` of recent read latencies
+        is sent to another replica (the primary if there's only one) as well. the first answer is used and the
+        other query is cancelled, see `hedge_stats`
+        """
         if self.is_connected():
             raise P3ormException("already connected")
 
         self.connection = None
-        self.pool = await asyncpg.create_pool(
+        self.prefetch_concurrency = prefetch_concurrency
+        # see Postgres.connect
+        self.statement_cache = StatementCache(statement_cache_size) if statement_cache_size > 0 else None
+
+        options: dict[str, Any] = dict(
             dsn=dsn,
             host=host,
             port=port,
@@ -381,13 +1354,37 @@ class Postgres(Driver, Executor):
             init=init,
             min_size=min_size,
             max_size=max_size,
-            **asyncpg_kwargs,  # type: ignore
+            **asyncpg_kwargs,
         )
+        self.pool = await asyncpg.create_pool(**options)
+
+        # what a replica's dsn says must not be overridden by the primary's explicit arguments
+        dsn_options = {"host": None, "port": None, "user": None, "password": None, "database": None}
+        self.replicas = tuple(
+            [
+                await asyncpg.create_pool(
+                    **options | ({"dsn": replica, **dsn_options} if isinstance(replica, str) else replica)
+                )
+                for replica in replicas
+            ]
+        )
+        self.replica_policy = replica_policy
+        self._replayed = {}
+        self._hedge = LatencyWindow(hedge) if hedge else None
+        self._losers = set()
 
     async def disconnect(self) -> None:
         if not self.is_connected():
             raise P3ormException("not connected")
 
+        if self.invalidation_channel:
+            await self.unlisten_invalidations()
+
+        if self._hedge:
+            # cancelled attempts give their connections back once the server has stopped their queries
+            await asyncio.gather(*self._losers, return_exceptions=True)
+            self._hedge = None
+
         if self.connection:
             await self.connection.close()
             self.connection = None
@@ -396,6 +1393,11 @@ class Postgres(Driver, Executor):
             await self.pool.close()
             self.pool = None
 
+        for replica in self.replicas:
+            await replica.close()
+
+        self.replicas = ()
+
     def is_connected(self) -> bool:
         if self.connection and not self.connection.is_closed():
             return True
@@ -405,8 +1407,251 @@ class Postgres(Driver, Executor):
 
         return False
 
-    def transaction(self) -> TransactionExecutor:
-        return TransactionExecutor(self)
+    async def listen_invalidations(self, channel: str = INVALIDATION_CHANNEL, *, notify_writes: bool = True) -> None:
+        """
+        keeps the primary key caches of every process listening on `channel` in step: writes through this driver
+        NOTIFY the keys they touch, and notifications from any process evict those keys here. pass
+        `notify_writes=False` when `install_invalidation_triggers` already covers the tables. with a pool, one of
+        its connections is held for listening
+        """
+        if self.invalidation_channel:
+            raise P3ormException(f"already listening on {self.invalidation_channel}")
+
+        if not self.pool and not self.connection:
+            raise P3ormException("not connected")
+
+        await self._listen(channel)
+        self.invalidation_channel = channel
+        self.notify_writes = notify_writes
+
+    async def unlisten_invalidations(self) -> None:
+        if not (channel := self.invalidation_channel):
+            raise P3ormException("not listening")
+
+        self.invalidation_channel = None
+        self.notify_writes = False
+
+        if (relisten := self._relisten) is not None:
+            self._relisten = None
+            relisten.cancel()
+            await asyncio.gather(relisten, return_exceptions=True)
+
+        # None once a lost listener is given back to the pool
+        if (listener := self._listener) is None:
+            return
+
+        self._listener = None
+        listener.remove_termination_listener(self._on_listener_lost)
+
+        if not listener.is_closed():
+            await listener.remove_listener(channel, self._on_invalidation)
+
+        if pool := self.pool:
+            await pool.release(listener)
+
+    async def _listen(self, channel: str) -> None:
+        listener = await self.pool.acquire() if self.pool else cast(asyncpg.Connection, self.connection)
+
+        try:
+            await listener.add_listener(channel, self._on_invalidation)
+        except BaseException:
+            if self.pool:
+                await self.pool.release(listener)
+            raise
+
+        listener.add_termination_listener(self._on_listener_lost)
+        self._listener = listener
+
+    def _on_listener_lost(self, connection: asyncpg.Connection) -> None:
+        # notifications sent while nobody listens are lost, so nothing cached can be trusted anymore
+        self._clear_caches()
+
+        # a driver on a single connection lost it altogether, a pool has others
+        if self.pool and (channel := self.invalidation_channel):
+            self._relisten = asyncio.ensure_future(self._listen_again(channel))
+
+    async def _listen_again(self, channel: str) -> None:
+        await cast(asyncpg.Pool, self.pool).release(self._listener)
+        self._listener = None
+        delay = RELISTEN_DELAY
+
+        while True:
+            try:
+                await self._listen(channel)
+                break
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RELISTEN_MAX_DELAY)
+
+        # nor can what was cached while reconnecting
+        self._clear_caches()
+        self._relisten = None
+
+    def _clear_caches(self) -> None:
+        for table in self.tables:
+            if (cache := table.__memo__.cache) is not None:
+                cache.clear()
+
+    def _on_invalidation(self, connection: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+        try:
+            tablename, keys = json.loads(payload)
+        except ValueError:
+            return
+
+        for table in self.tables:
+            if table.__tablename__ != tablename or (cache := table.__memo__.cache) is None:
+                continue
+
+            if keys is None:
+                cache.clear()
+            else:
+                for key in keys:
+                    cache.pop(_pk_from_json(table, key))
+
+    async def install_invalidation_triggers(
+        self, tables: list[Type[Table]] | None = None, channel: str = INVALIDATION_CHANNEL
+    ) -> None:
+        """
+        triggers that NOTIFY `channel` of the rows every insert, update and delete statement on the cached `tables`
+        touched, so writes made outside of p3orm reach `listen_invalidations` too
+        """
+        for table in tables or [table for table in self.tables if table.__memo__.cache is not None]:
+            for statement in _invalidation_trigger_sql(table, channel):
+                await self.execute_raw(statement)
+
+    def acquire(self) -> AsyncContextManager[asyncpg.Connection]:
+        # anything run on the primary may write, the next read of a `read_your_writes` scope has to see it
+        if (scope := _read_your_writes.get()) is not None:
+            scope.writes += 1
+
+        return super().acquire()
+
+    def acquire_read(self, *, primary: bool = False) -> AsyncContextManager[asyncpg.Connection]:
+        # reading from the primary isn't a write, so not `self.acquire`
+        if primary or not self.replicas:
+            return super().acquire()
+
+        return self._acquire_replica()
+
+    async def _fetch_read(self, query: str, query_args: list[Any], primary: bool = False) -> list[asyncpg.Record]:
+        if (hedge := self._hedge) is None or primary or not self.replicas:
+            return await super()._fetch_read(query, query_args, primary)
+
+        hedge.stats.reads += 1
+        replica = self._pick_replica()
+        attempts = [asyncio.ensure_future(self._attempt(replica, query, query_args))]
+
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=hedge.delay())
+
+            if not done:
+                hedge.stats.hedged += 1
+                attempts.append(asyncio.ensure_future(self._attempt(self._hedge_peer(replica), query, query_args)))
+
+            return await _first_answer(attempts, hedge.stats)
+
+        finally:
+            for attempt in attempts:
+                if not attempt.done():
+                    # asyncpg sends the server a cancel request for the query the task is waiting on
+                    attempt.cancel()
+                    self._losers.add(attempt)
+                    attempt.add_done_callback(self._losers.discard)
+
+    async def _attempt(self, replica: asyncpg.Pool | None, query: str, query_args: list[Any]) -> list[asyncpg.Record]:
+        # `replica=None` reads from the primary
+        hedge = cast(LatencyWindow, self._hedge)
+
+        async with self._acquire_replica(replica) if replica else cast(asyncpg.Pool, self.pool).acquire() as connection:
+            # waiting for a connection or for the replica to catch up isn't the query being slow
+            started = monotonic()
+
+            try:
+                records = await self._fetch(connection, query, query_args)
+            except asyncio.CancelledError:
+                # the slowest reads are the ones cancelled, leaving them out would pull the percentile down
+                hedge.record(monotonic() - started)
+                raise
+
+            hedge.record(monotonic() - started)
+
+        return records
+
+    def _hedge_peer(self, replica: asyncpg.Pool) -> asyncpg.Pool | None:
+        if len(self.replicas) == 1:
+            return None
+
+        return self.replicas[(self.replicas.index(replica) + 1) % len(self.replicas)]
+
+    def hedge_stats(self) -> HedgeStats | None:
+        return self._hedge.stats if self._hedge else None
+
+    @asynccontextmanager
+    async def _acquire_replica(self, replica: asyncpg.Pool | None = None) -> AsyncIterator[asyncpg.Connection]:
+        pool = cast(asyncpg.Pool, self.pool)
+        scope = _read_your_writes.get()
+
+        if scope is not None and scope.synced != scope.writes:
+            writes = scope.writes
+
+            async with pool.acquire() as connection:
+                scope.lsn = _parse_lsn(await connection.fetchval("SELECT pg_current_wal_lsn()::text"))
+
+            scope.synced = writes
+
+        replica = replica or self._pick_replica()
+
+        async with replica.acquire() as connection:
+            if scope is None or self._replayed.get(replica, 0) >= scope.lsn:
+                yield connection
+                return
+
+            # NULL when the server isn't a standby, there's nothing to wait for
+            replayed = await connection.fetchval("SELECT pg_last_wal_replay_lsn()::text")
+            self._replayed[replica] = _parse_lsn(replayed) if replayed is not None else MAX_LSN
+
+            if self._replayed[replica] >= scope.lsn:
+                yield connection
+                return
+
+        # the replica hasn't caught up with the scope's writes yet
+        async with pool.acquire() as connection:
+            yield connection
+
+    def _pick_replica(self) -> asyncpg.Pool:
+        if self.replica_policy == ReplicaPolicy.random:
+            return random.choice(self.replicas)
+
+        if self.replica_policy == ReplicaPolicy.least_busy:
+            return min(self.replicas, key=lambda replica: replica.get_size() - replica.get_idle_size())
+
+        self._next_replica = (self._next_replica + 1) % len(self.replicas)
+        return self.replicas[self._next_replica]
+
+    @contextmanager
+    def read_your_writes(self) -> Iterator[ReadYourWrites]:
+        """
+        reads in this scope, including from the tasks it starts, see every write made in it before them: a replica
+        serves them once it has replayed the primary's WAL up to those writes, the primary until then. a scope
+        opened inside another one is the outer scope
+        """
+        if (scope := _read_your_writes.get()) is not None:
+            yield scope
+            return
+
+        token = _read_your_writes.set(scope := ReadYourWrites())
+
+        try:
+            yield scope
+        finally:
+            _read_your_writes.reset(token)
+
+    def transaction(self, identity_map: bool = False) -> TransactionExecutor:
+        """
+        `identity_map=True` keeps one instance per row for the whole transaction: a row loaded again, by any fetch or
+        prefetch, is the instance loaded first instead of a newly decoded one
+        """
+        return TransactionExecutor(self, identity_map)
 
 
 class TransactionExecutor(Executor):
@@ -414,8 +1659,34 @@ class TransactionExecutor(Executor):
     connection: asyncpg.Connection
     transaction: asyncpg.connection.transaction.Transaction
 
-    def __init__(self, driver: Postgres):
+    # cached keys written in the transaction, and tables written without knowing the keys, see `_invalidate`
+    written: set[tuple[type, Any]]
+    cleared: set[type]
+
+    def __init__(self, driver: Postgres, identity_map: bool = False):
         self.driver = driver
+        self.statement_cache = driver.statement_cache
+        self.identity_map = {} if identity_map else None
+        self.invalidation_channel = driver.invalidation_channel
+        self.notify_writes = driver.notify_writes
+        self.written = set()
+        self.cleared = set()
+
+    def _cache_key(self, table: Type[T], criterion: Criterion | None) -> Any:
+        # the cache holds committed rows, reads in a transaction must see the transaction's own writes
+        return None
+
+    async def _invalidate_keys(self, table: Type[T], keys: list[Any]) -> list[Any]:
+        # a read outside the transaction can cache the old row again before the commit, so written keys are
+        # invalidated once more when the transaction ends
+        keys = await super()._invalidate_keys(table, keys)
+        self.written.update((table, key) for key in keys)
+
+        return keys
+
+    async def _invalidate_table(self, table: Type[T]) -> None:
+        await super()._invalidate_table(table)
+        self.cleared.add(table)
 
     async def __aenter__(self) -> Self:
         if self.driver.connection:
@@ -437,9 +1708,18 @@ class TransactionExecutor(Executor):
     ) -> None:
         if exc_type is None:
             await self.transaction.commit()
+
+            if (scope := _read_your_writes.get()) is not None:
+                scope.writes += 1
         else:
             await self.transaction.rollback()
 
+        for table, key in self.written:
+            cast(LRUCache, table.__memo__.cache).pop(key)
+
+        for table in self.cleared:
+            cast(LRUCache, table.__memo__.cache).clear()
+
         if self.driver.pool:
             await self.driver.pool.release(self.connection)
 
@@ -448,158 +1728,1153 @@ class TransactionExecutor(Executor):
         return driver.is_connected()
 
 
+class BatchResult(Generic[T]):
+    """the value of a `Batch` call, see `Executor.batch`"""
+
+    batch: Batch
+    # the statement it's sent in, once it has been
+    _sending: asyncio.Future[BaseException | None] | None
+    _value: Any
+    _error: BaseException | None
+
+    def __init__(self, batch: Batch) -> None:
+        self.batch = batch
+        self._sending = None
+        self._value = None
+        self._error = None
+
+    def __await__(self) -> Generator[Any, None, T]:
+        return self._wait().__await__()
+
+    async def _wait(self) -> T:
+        if self._sending is None:
+            self.batch._send_queued()
+
+        # an error of the statement is this result's error too, `result` raises it
+        await cast(asyncio.Future, self._sending)
+
+        return self.result()
+
+    def done(self) -> bool:
+        return self._sending is not None and self._sending.done()
+
+    def result(self) -> T:
+        if not self.done():
+            raise P3ormException("the batch hasn't run yet, await the result instead")
+
+        if self._error is not None:
+            raise self._error
+
+        return cast(T, self._value)
+
+
+class Batch:
+    """fetches collected by `Executor.batch`"""
+
+    executor: Executor
+    # (sql, arguments, turns the selected value into the result, result) of each call not sent yet
+    _queued: list[tuple[str, list[Any], Callable[[Any], Any], BatchResult[Any]]]
+
+    def __init__(self, executor: Executor) -> None:
+        self.executor = executor
+        self._queued = []
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: Type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        if exc_type is None:
+            await self.run()
+
+    def fetch_all(
+        self,
+        /,
+        table: Type[T],
+        criterion: Criterion | None = None,
+        *,
+        order: Order | None = None,
+        by: PyPikaField | list[PyPikaField] | None = None,
+        limit: int | None = None,
+        offset: int | None = None,
+        prefetch: RELATIONS_TYPE | None = None,
+    ) -> BatchResult[list[T]]:
+        # prefetches are always joined, loading them separately would take another round trip
+        related = prefetch_plan(table, prefetch) if prefetch else None
+        query, query_args = compile_select(
+            table, _criterion(criterion), order=order, by=by, limit=limit, offset=offset, related=related
+        )
+
+        return self._queue(_batched_rows(table, query), query_args, lambda value: self._items(table, related, value))
+
+    def fetch_one(
+        self, /, table: Type[T], criterion: Criterion | None = None, *, prefetch: RELATIONS_TYPE | None = None
+    ) -> BatchResult[T]:
+        related = prefetch_plan(table, prefetch) if prefetch else None
+        query, query_args = compile_select(table, _criterion(criterion), limit=2, related=related)
+
+        def one(value: str) -> T:
+            if len(items := self._items(table, related, value)) != 1:
+                raise P3ormException(f"expected one result in {table.__name__} where {criterion=}, found {len(items)}")
+
+            return items[0]
+
+        return self._queue(_batched_rows(table, query), query_args, one)
+
+    def fetch_first(
+        self,
+        /,
+        table: Type[T],
+        criterion: Criterion | None = None,
+        *,
+        order: Order | None = None,
+        by: PyPikaField | list[PyPikaField] | None = None,
+        prefetch: RELATIONS_TYPE | None = None,
+    ) -> BatchResult[T | None]:
+        related = prefetch_plan(table, prefetch) if prefetch else None
+        query, query_args = compile_select(table, _criterion(criterion), order=order, by=by, limit=1, related=related)
+
+        def first(value: str) -> T | None:
+            items = self._items(table, related, value)
+            return items[0] if items else None
+
+        return self._queue(_batched_rows(table, query), query_args, first)
+
+    def count(self, /, table: Type[Table], criterion: Criterion | None = None) -> BatchResult[int]:
+        query, query_args = compile_select(table, _criterion(criterion), count=True)
+
+        return self._queue(f"({query})", query_args, int)
+
+    async def run(self) -> None:
+        """sends the calls collected so far, `async with` does when the block ends"""
+        if (sending := self._send_queued()) is not None and (error := await sending) is not None:
+            raise error
+
+    def _send_queued(self) -> asyncio.Future[BaseException | None] | None:
+        if not (queued := self._queued):
+            return None
+
+        self._queued = []
+        sending = asyncio.ensure_future(self._send(queued))
+
+        for *_, result in queued:
+            result._sending = sending
+
+        return sending
+
+    async def _send(
+        self, queued: list[tuple[str, list[Any], Callable[[Any], Any], BatchResult[Any]]]
+    ) -> BaseException | None:
+        # the error a statement failed with is handed back rather than raised, it's each of its results' error
+        # one statement selecting a column per call, split only when the arguments outgrow a statement
+        statements: list[list[tuple[str, list[Any], Callable[[Any], Any], BatchResult[Any]]]] = [[]]
+        args_count = 0
+
+        for call in queued:
+            if statements[-1] and args_count + len(call[1]) > MAX_QUERY_ARGS:
+                statements.append([])
+                args_count = 0
+
+            statements[-1].append(call)
+            args_count += len(call[1])
+
+        for index, statement in enumerate(statements):
+            columns: list[str] = []
+            query_args: list[Any] = []
+
+            for query, call_args, _, _ in statement:
+                columns.append(f'{_shift_params(query, len(query_args))} "{len(columns)}"')
+                query_args += call_args
+
+            try:
+                [record] = await self.executor._read(f"SELECT {','.join(columns)}", query_args)
+            except Exception as e:
+                # calls in statements that weren't sent fail with it too
+                for unsent in statements[index:]:
+                    for *_, result in unsent:
+                        result._error = e
+
+                return e
+
+            for (_, _, finish, result), value in zip(statement, record.values()):
+                # a call that can't be finished fails alone, the others still get their values
+                try:
+                    result._value = finish(value)
+                except Exception as e:
+                    result._error = e
+
+        return None
+
+    def _queue(self, query: str, query_args: list[Any], finish: Callable[[Any], T]) -> BatchResult[T]:
+        result: BatchResult[T] = BatchResult(self)
+        self._queued.append((query, query_args, finish, result))
+
+        return result
+
+    def _items(self, table: Type[T], related: PrefetchTree | None, value: str | list[Any]) -> list[T]:
+        identity_map = self.executor.identity_map
+        # already decoded when a jsonb codec is set on the connection
+        rows = json.loads(value) if isinstance(value, str) else value
+        return [_instance_from_json(table, related or {}, row, identity_map) for row in rows]
+
+
+def _criterion(criterion: Criterion | None) -> Criterion | None:
+    if criterion is not None and not isinstance(criterion, Criterion):
+        raise P3ormException(f"{criterion=} must be instance of Criterion. did you wrap the field with `f()`?")
+
+    return criterion
+
+
+def _batched_rows(table: Type[T], query: str) -> str:
+    # the rows of `query` as one json array
+    alias = '"_p3orm_batch"'
+    row = json_row(table, alias)
+
+    # jsonb_agg takes its rows in whatever order it's handed them, the numbering keeps the order `query` has
+    return (
+        """(SELECT coalesce(jsonb_agg("row" ORDER BY "ordinality"),'[]') """
+        f'FROM (SELECT {row} "row",row_number() OVER () "ordinality" FROM ({query}) {alias}) "_p3orm_rows")'
+    )
+
+
+# string literals are skipped, a `$1` in them isn't a placeholder
+PARAM_PATTERN = re.compile(r"'(?:[^']|'')*'|\$(\d+)")
+
+
+def _shift_params(query: str, offset: int) -> str:
+    """renumbers the placeholders of `query` from `offset + 1`, for the statements a batch is made of"""
+    if not offset:
+        return query
+
+    return PARAM_PATTERN.sub(lambda m: f"${int(m[1]) + offset}" if m[1] else m[0], query)
+
+
+async def _first_answer(
+    attempts: list[asyncio.Future[list[asyncpg.Record]]], stats: HedgeStats
+) -> list[asyncpg.Record]:
+    # an attempt that failed leaves the read to the other one, the first attempt's error is raised if both fail
+    pending = set(attempts)
+
+    while pending:
+        _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+        for attempt in attempts:
+            if attempt.done() and attempt.exception() is None:
+                stats.wins += attempt is not attempts[0]
+                return attempt.result()
+
+    return attempts[0].result()
+
+
+# above any position a standby can report
+MAX_LSN = 2**64
+
+
+def _parse_lsn(lsn: str) -> int:
+    """a WAL position such as `16/B374D848` as an integer, so positions can be compared"""
+    high, low = lsn.split("/")
+    return int(high, 16) << 32 | int(low, 16)
+
+
+def _invalidation_payloads(table: Type[T], keys: list[Any]) -> list[str]:
+    """`[tablename, [key, ...]]` json messages that each fit in a NOTIFY, `[tablename, null]` clears the cache"""
+    payloads: list[str] = []
+    batch: list[str] = []
+    size = 0
+
+    for key in keys:
+        dumped = json.dumps(key, default=str)
+
+        if len(dumped) > MAX_NOTIFY_PAYLOAD // 2:
+            return [json.dumps([table.__tablename__, None])]
+
+        if size + len(dumped) > MAX_NOTIFY_PAYLOAD // 2:
+            payloads.append(f"[{json.dumps(table.__tablename__)},[{','.join(batch)}]]")
+            batch, size = [], 0
+
+        batch.append(dumped)
+        size += len(dumped) + 1
+
+    if batch:
+        payloads.append(f"[{json.dumps(table.__tablename__)},[{','.join(batch)}]]")
+
+    return payloads
+
+
+def _pk_from_json(table: Type[T], key: Any) -> Any:
+    # keys are json as postgres or `json.dumps(default=str)` write them, the pk's json decoder turns them back
+    memo = table.__memo__
+    decoders = [memo.json_decoders[field._field_name] for field in memo.pk]
+    values = [key] if len(decoders) == 1 else key
+
+    decoded = tuple(
+        decoder(value) if decoder and value is not None else value for decoder, value in zip(decoders, values)
+    )
+
+    return decoded[0] if len(decoded) == 1 else decoded
+
+
+def _invalidation_trigger_sql(table: Type[T], channel: str) -> list[str]:
+    """
+    statement triggers that NOTIFY the keys of every row a statement touched, read from its transition tables.
+    postgres only allows transition tables on single event triggers, so there's one per event
+    """
+    tablename = _quote(table.__tablename__)
+    function = _quote(f"p3orm_invalidate_{table.__tablename__}")
+    columns = [_quote(field.column_name) for field in table.__memo__.pk]
+    key = columns[0] if len(columns) == 1 else f"jsonb_build_array({', '.join(columns)})"
+
+    def keys(*rows: str) -> str:
+        return " UNION ".join(f"SELECT {key} AS key FROM {row}" for row in rows)
+
+    events = {
+        "INSERT": "NEW TABLE AS new_rows",
+        "UPDATE": "OLD TABLE AS old_rows NEW TABLE AS new_rows",
+        "DELETE": "OLD TABLE AS old_rows",
+    }
+
+    return [
+        f"""
+CREATE OR REPLACE FUNCTION {function}() RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+    message text;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT jsonb_agg(key) INTO message FROM ({keys("new_rows")}) AS keys;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT jsonb_agg(key) INTO message FROM ({keys("old_rows")}) AS keys;
+    ELSE
+        SELECT jsonb_agg(key) INTO message FROM ({keys("old_rows", "new_rows")}) AS keys;
+    END IF;
+
+    -- statements that touched no rows fire too
+    IF message IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    message := jsonb_build_array({_literal(table.__tablename__)}, message::jsonb)::text;
+
+    -- too many keys for one notification clear the whole cache
+    IF octet_length(message) > {MAX_NOTIFY_PAYLOAD} THEN
+        message := jsonb_build_array({_literal(table.__tablename__)}, NULL)::text;
+    END IF;
+
+    PERFORM pg_notify({_literal(channel)}, message);
+    RETURN NULL;
+END
+$$
+""",
+        # the row trigger of earlier versions
+        f"DROP TRIGGER IF EXISTS p3orm_invalidate ON {tablename}",
+        *(
+            statement
+            for event, referencing in events.items()
+            for statement in [
+                f"DROP TRIGGER IF EXISTS p3orm_invalidate_{event.lower()} ON {tablename}",
+                f"CREATE TRIGGER p3orm_invalidate_{event.lower()} AFTER {event} ON {tablename} "
+                f"REFERENCING {referencing} FOR EACH STATEMENT EXECUTE FUNCTION {function}()",
+            ]
+        ),
+    ]
+
+
+def _literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _encode_rows(table: Type[T], items: list[T]) -> list[list[Any]]:
+    memo = cast(Type[Table], table).__memo__
+    field_values = memo.field_values
+    encoders = list(memo.encoders.values())
+
+    return [
+        [
+            (
+                value
+                if encoder is None or isinstance(value, (DB_GENERATED, UNLOADED_COLUMN)) or not value
+                else encoder(value)
+            )
+            for value, encoder in zip(field_values(item), encoders)
+        ]
+        for item in items
+    ]
+
+
+def _check_insertable(table: Type[T], items: list[T]) -> None:
+    """an insert writes every column, an instance selected with `only` or `defer` doesn't have them all"""
+    memo = cast(Type[Table], table).__memo__
+
+    for item in items:
+        if _has_unloaded_columns(cast(Type[Table], table), item):
+            unloaded = [
+                field_name
+                for field_name, value in zip(memo.fields, memo.field_values(item))
+                if isinstance(value, UNLOADED_COLUMN)
+            ]
+            raise P3ormException(
+                f"can't insert {table.__name__} items missing the columns {unloaded} from their select"
+            )
+
+
 def _insert_vals(
     table: Type[T],
     items: list[T],
 ) -> tuple[list[str], list[list[Any]], list[Any]]:
-    columns = []
-    args = []
-    params: list[list[Any]] = [[] for _ in range(len(items))]
+    columns = [field.column_name for field in cast(Type[Table], table).__memo__.fields.values()]
+    args: list[Any] = []
+    params: list[list[Any]] = []
 
-    _table = cast(Type[Table], table)
-    for field_name, field in _table.__memo__.fields.items():
-        columns.append(field.column_name)
+    for row in _encode_rows(table, items):
+        row_params = []
+        for value in row:
+            if isinstance(value, DB_GENERATED):
+                row_params.append(DEFAULT)
+            else:
+                args.append(value)
+                row_params.append(_param(len(args)))
+        params.append(row_params)
 
-    for i, item in enumerate(items):
-        for field_name, field in _table.__memo__.fields.items():
-            value = getattr(item, field_name)
+    return columns, params, args
 
-            if isinstance(value, DB_GENERATED):
-                params[i].append(DEFAULT)
+
+def _group_by_generated(rows: list[list[Any]]) -> dict[tuple[bool, ...], list[int]]:
+    """
+    row indexes grouped by which values are left for the database to generate. statements that take every row
+    with the same columns (COPY, unnest) are run once per group
+    """
+    groups: dict[tuple[bool, ...], list[int]] = {}
+
+    for i, row in enumerate(rows):
+        groups.setdefault(tuple(isinstance(value, DB_GENERATED) for value in row), []).append(i)
+
+    return groups
+
+
+def _quote(identifier: str) -> str:
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def _status_count(status: str) -> int:
+    # e.g. "INSERT 0 3", "UPDATE 3", "COPY 3"
+    return int(status.rsplit(" ", 1)[-1])
+
+
+async def _values_insert(
+    executor: Executor,
+    connection: asyncpg.Connection,
+    table: Type[T],
+    items: list[T],
+    returning: bool | Literal["minimal"],
+    chunk_size: int | None,
+    atomic: bool,
+    conflict: OnConflict | None = None,
+) -> list[T] | int:
+    # every value is a bind parameter, so a statement can hold MAX_QUERY_ARGS // width rows at most
+    chunk_size = chunk_size or max(1, MAX_QUERY_ARGS // len(cast(Type[Table], table).__memo__.fields))
+    chunks = [items[i : i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+    transaction = connection.transaction() if atomic and len(chunks) > 1 else nullcontext()
+
+    async with transaction:
+        inserted: list[T] = []
+        count = 0
+
+        for chunk in chunks:
+            columns, params_list, query_args = _insert_vals(table, chunk)
+
+            query: PostgreSQLQueryBuilder = PostgreSQLQuery.into(table.__tablename__).columns(*columns)
+            for params in params_list:
+                query = query.insert(*params)
+
+            sql = query.get_sql() + (conflict.sql() if conflict else "")
+
+            # rows skipped by ON CONFLICT DO NOTHING aren't counted, so the count is read off of each statement
+            if not returning:
+                count += _status_count(await executor._execute(connection, sql, query_args))
                 continue
 
-            if value and is_field_pydantic(field):
-                value = value.model_dump_json()
-            elif value and is_field_enum(field):
-                value = cast_enum(field, value)
+            records = await executor._fetch(
+                connection, f"{sql} RETURNING {_returning_columns(table, returning, conflict)}", query_args
+            )
+            positions = list(range(len(chunk)))
 
-            params[i].append(Parameter(f"${len(args) + 1}"))
-            args.append(value)
+            if len(records) != len(chunk):
+                positions = _returned_indexes(table, records, _encode_rows(table, chunk), positions, conflict)
 
-    return columns, params, args
+            inserted += _returned_instances(executor, table, [chunk[i] for i in positions], records, returning)
+
+        return inserted if returning else count
+
+
+def _defaults_query(table: Type[T], count: int) -> PostgreSQLQueryBuilder:
+    columns = cast(Type[Table], table).__memo__.fields
+    query: PostgreSQLQueryBuilder = PostgreSQLQuery.into(table.__tablename__)
+
+    for _ in range(count):
+        query = query.insert(*[DEFAULT for _ in columns])
+
+    return query
+
+
+async def _column_types(connection: asyncpg.Connection, table: Type[T]) -> dict[str, str]:
+    memo = cast(Type[Table], table).__memo__
+
+    if not memo.column_types:
+        records = await connection.fetch(
+            "SELECT attname, format_type(atttypid, atttypmod) AS type FROM pg_attribute "
+            "WHERE attrelid = $1::regclass AND attnum > 0 AND NOT attisdropped",
+            _quote(table.__tablename__),
+        )
+        memo.column_types = {record["attname"]: record["type"] for record in records}
+
+    return memo.column_types
+
+
+async def _unnest_insert(
+    executor: Executor,
+    connection: asyncpg.Connection,
+    table: Type[T],
+    items: list[T],
+    returning: bool | Literal["minimal"],
+    chunk_size: int | None,
+    atomic: bool,
+    conflict: OnConflict | None = None,
+) -> list[T] | int:
+    columns = [field.column_name for field in cast(Type[Table], table).__memo__.fields.values()]
+    column_types = await _column_types(connection, table)
+
+    if array_columns := [column for column in columns if column_types[column].endswith("]")]:
+        raise P3ormException(f"unnest can't insert into array columns {array_columns}, use another InsertMode")
+
+    rows = _encode_rows(table, items)
+    chunk_size = chunk_size or len(rows)
+    chunks = [list(range(i, min(i + chunk_size, len(rows)))) for i in range(0, len(rows), chunk_size)]
+
+    inserted: list[T] = [None] * len(items)  # type: ignore
+    count = 0
+
+    async with connection.transaction() if atomic else nullcontext():
+        for chunk in chunks:
+            for generated, indexes in _group_by_generated([rows[i] for i in chunk]).items():
+                indexes = [chunk[i] for i in indexes]
+                group_columns = [column for column, skip in zip(columns, generated) if not skip]
+                query_args: list[Any] = []
+
+                if not group_columns:
+                    query = _defaults_query(table, len(indexes)).get_sql()
+                else:
+                    # one array per column, so the sql only depends on the table and never on the number of rows
+                    arrays = ", ".join(f"${i + 1}::{column_types[column]}[]" for i, column in enumerate(group_columns))
+                    query = (
+                        f"INSERT INTO {_quote(table.__tablename__)} ({', '.join(_quote(c) for c in group_columns)}) "
+                        f"SELECT * FROM unnest({arrays})"
+                    )
+                    query_args = [
+                        list(values) for values, skip in zip(zip(*(rows[i] for i in indexes)), generated) if not skip
+                    ]
+
+                if conflict:
+                    query += conflict.sql()
+
+                if not returning:
+                    count += _status_count(await executor._execute(connection, query, query_args))
+                    continue
+
+                records = await executor._fetch(
+                    connection, f"{query} RETURNING {_returning_columns(table, returning, conflict)}", query_args
+                )
+                positions = _returned_indexes(table, records, rows, indexes, conflict)
+
+                for i, instance in zip(
+                    positions,
+                    _returned_instances(executor, table, [items[i] for i in positions], records, returning),
+                ):
+                    inserted[i] = instance
+
+    return [item for item in inserted if item is not None] if returning else count
+
+
+async def _copy_insert(
+    executor: Executor,
+    connection: asyncpg.Connection,
+    table: Type[T],
+    items: list[T],
+    returning: bool | Literal["minimal"],
+    conflict: OnConflict | None = None,
+) -> list[T] | int:
+    columns = [field.column_name for field in cast(Type[Table], table).__memo__.fields.values()]
+    rows = _encode_rows(table, items)
+    inserted: list[T] = [None] * len(items)  # type: ignore
+    count = 0
+
+    tablename = _quote(table.__tablename__)
+    stage_name = f"_p3orm_copy_{table.__tablename__}"
+    stage = _quote(stage_name)
+    ordinal = _quote("_p3orm_ordinal")
+
+    async with connection.transaction():
+        for generated, indexes in _group_by_generated(rows).items():
+            group_columns = [column for column, skip in zip(columns, generated) if not skip]
+            quoted_columns = ", ".join(_quote(column) for column in group_columns)
+
+            if not group_columns:
+                # nothing to copy when every column is generated
+                query = _defaults_query(table, len(indexes)).get_sql() + (conflict.sql() if conflict else "")
+
+                if not returning:
+                    count += _status_count(await executor._execute(connection, query, []))
+                    continue
+
+                records = await executor._fetch(
+                    connection, f"{query} RETURNING {_returning_columns(table, returning, conflict)}", []
+                )
+
+            elif not returning and conflict is None:
+                status = await connection.copy_records_to_table(
+                    table.__tablename__,
+                    records=[tuple(value for value, skip in zip(rows[i], generated) if not skip) for i in indexes],
+                    columns=group_columns,
+                )
+                count += _status_count(status)
+                continue
+
+            else:
+                # COPY can't return rows or handle conflicts, so it fills a temp table that the real insert selects
+                # from in input order
+                await connection.execute(
+                    f"CREATE TEMP TABLE {stage} AS "
+                    f"SELECT {quoted_columns}, 0::bigint AS {ordinal} FROM {tablename} WITH NO DATA"
+                )
+                await connection.copy_records_to_table(
+                    stage_name,
+                    records=[(*(value for value, skip in zip(rows[i], generated) if not skip), i) for i in indexes],
+                    columns=[*group_columns, "_p3orm_ordinal"],
+                )
+                query = (
+                    f"INSERT INTO {tablename} ({quoted_columns}) "
+                    f"SELECT {quoted_columns} FROM {stage} ORDER BY {ordinal}{conflict.sql() if conflict else ''}"
+                )
+
+                if returning:
+                    records = await executor._fetch(
+                        connection, f"{query} RETURNING {_returning_columns(table, returning, conflict)}", []
+                    )
+                else:
+                    count += _status_count(await executor._execute(connection, query, []))
+
+                await connection.execute(f"DROP TABLE {stage}")
+
+                if not returning:
+                    continue
+
+            positions = _returned_indexes(table, records, rows, indexes, conflict)
+
+            for i, instance in zip(
+                positions, _returned_instances(executor, table, [items[i] for i in positions], records, returning)
+            ):
+                inserted[i] = instance
+
+    return [item for item in inserted if item is not None] if returning else count
+
+
+def _returned_indexes(
+    table: Type[T],
+    records: list[asyncpg.Record],
+    rows: list[list[Any]],
+    indexes: list[int],
+    conflict: OnConflict | None,
+) -> list[int]:
+    """
+    which of the `indexes` rows each returned record is. every row comes back in order, except the ones ON CONFLICT
+    DO NOTHING skipped, so a row is the next record when their conflict columns match. rows with a generated conflict
+    column can't conflict and always come back
+    """
+    if len(records) == len(indexes) or conflict is None:
+        return indexes
+
+    memo = cast(Type[Table], table).__memo__
+    columns = [field.column_name for field in memo.fields.values()]
+    positions = [columns.index(column) for column in conflict.columns]
+    # rows hold encoded values and records what the server sent, both are compared as the fields' python values
+    decoders = [memo.decoders[memo.columns[column]._field_name] for column in conflict.columns]
+
+    def key(values: Iterable[Any]) -> tuple[Any, ...]:
+        return tuple(
+            value if decoder is None or value is None else decoder(value) for value, decoder in zip(values, decoders)
+        )
+
+    returned: list[int] = []
+    records_left = iter(records)
+    record = next(records_left, None)
+
+    for i in indexes:
+        if record is None:
+            break
+
+        values = [rows[i][position] for position in positions]
+        generated = any(isinstance(value, DB_GENERATED) for value in values)
+
+        if generated or key(values) == key(record[column] for column in conflict.columns):
+            returned.append(i)
+            record = next(records_left, None)
+
+    return returned
+
+
+def _returning_columns(table: Type[T], returning: bool | Literal["minimal"], conflict: OnConflict | None = None) -> str:
+    """what a write reads back. "minimal" is the primary key and the columns the database generates"""
+    if returning != "minimal":
+        return "*"
+
+    return ", ".join(
+        _quote(field.column_name)
+        for field in cast(Type[Table], table).__memo__.fields.values()
+        if field.pk or field.db_gen or (conflict and field.column_name in conflict.columns)
+    )
+
+
+def _returned_instances(
+    executor: Executor,
+    table: Type[T],
+    items: list[T],
+    records: list[asyncpg.Record],
+    returning: bool | Literal["minimal"],
+) -> list[T]:
+    """
+    the rows a write read back as instances. with "minimal" they're merged into the `items` they were written from
+    instead, `records[i]` being the row of `items[i]`
+    """
+    if returning != "minimal":
+        return _turn_records_into_orm_instances(table, records, executor.identity_map, refresh=True)
+
+    memo = cast(Type[Table], table).__memo__
+    merged: list[T] = []
+
+    for item, record in zip(items, records):
+        _refresh_instance(table, item, memo.record_decoder(record.keys())(record))
+        merged.append(item)
+
+        if executor.identity_map is not None:
+            executor.identity_map.setdefault((table, _item_pk(table, item)), item)
+
+    return merged
+
+
+async def _bulk_update(
+    executor: Executor,
+    connection: asyncpg.Connection,
+    table: Type[T],
+    items: list[T],
+    columns: set[str] | None,
+    returning: bool,
+    chunk_size: int | None,
+    atomic: bool,
+) -> list[T] | int:
+    fields = list(cast(Type[Table], table).__memo__.fields.values())
+    column_types = await _column_types(connection, table)
+    keys = [i for i, field in enumerate(fields) if field.pk]
+
+    rows = _encode_rows(table, items)
+
+    if any(isinstance(row[i], DB_GENERATED) for row in rows for i in keys):
+        raise P3ormException(f"can't update {table.__name__} rows without their primary key")
+
+    # the last of several items for the same row wins. rows are sent, and locked, in primary key order so concurrent
+    # bulk updates of overlapping rows queue behind each other instead of deadlocking
+    by_key = {tuple(row[i] for i in keys): (row, item) for row, item in zip(rows, items)}
+
+    # statements are shared by rows with the same columns to set, to leave for the database or to leave alone.
+    # unchanged fields of items loaded from the database are left alone
+    groups: dict[tuple[type | None, ...], list[list[Any]]] = {}
+    unchanged: dict[Any, T] = {}
+
+    for key in sorted(by_key):
+        row, item = by_key[key]
+        changed = _changed_fields(table, item)
+        shape = tuple(
+            _update_kind(field, value, changed)
+            for field, value in zip(fields, row)
+            if not field.pk and (columns is None or field.column_name in columns)
+        )
+
+        if all(kind is UNLOADED_COLUMN for kind in shape):
+            unchanged[_item_pk(table, item)] = item
+        else:
+            groups.setdefault(shape, []).append(row)
+
+    updatable = [field for field in fields if not field.pk and (columns is None or field.column_name in columns)]
+    pk_columns = [fields[i].column_name for i in keys]
+    statements: list[tuple[str, list[Any]]] = []
+
+    for shape, group in groups.items():
+        set_indexes = [fields.index(field) for field, kind in zip(updatable, shape) if kind is None]
+        default_columns = [field.column_name for field, kind in zip(updatable, shape) if kind is DB_GENERATED]
+        set_columns = [fields[i].column_name for i in set_indexes]
+
+        values = [[row[i] for i in keys + set_indexes] for row in group]
+
+        if any(column_types[column].endswith("]") for column in pk_columns + set_columns):
+            # unnest would flatten array columns, so these rows are sent as a VALUES list instead
+            size = chunk_size or max(1, MAX_QUERY_ARGS // len(values[0]))
+
+            for i in range(0, len(values), size):
+                chunk = values[i : i + size]
+                query = _update_query(table, pk_columns, set_columns, default_columns, column_types, len(chunk))
+                statements.append((query, [value for row in chunk for value in row]))
+
+        else:
+            # one array per column, so the sql only depends on the columns and never on the number of rows
+            size = chunk_size or len(values)
+            query = _update_query(table, pk_columns, set_columns, default_columns, column_types, None)
+
+            for i in range(0, len(values), size):
+                statements.append((query, [list(column) for column in zip(*values[i : i + size])]))
+
+    updated: list[T] = []
+    count = 0
+
+    async with connection.transaction() if atomic and len(statements) > 1 else nullcontext():
+        for query, query_args in statements:
+            if not returning:
+                count += _status_count(await executor._execute(connection, query, query_args))
+                continue
+
+            records = await executor._fetch(
+                connection, f"{query} RETURNING {_quote(table.__tablename__)}.*", query_args
+            )
+            updated += _turn_records_into_orm_instances(table, records, executor.identity_map, refresh=True)
+
+    # the written fields of the items that were written are what's stored now
+    written = {field._field_name for field in updatable}
+
+    for row, item in by_key.values():
+        if _item_pk(table, item) not in unchanged:
+            _mark_loaded(table, item, written)
+
+    if not returning:
+        return count
+
+    # handed back in the order of `items`, with the ones there was nothing to write for as they are
+    by_pk = unchanged | {_item_pk(table, item): item for item in updated}
+    return [by_pk[pk] for pk in dict.fromkeys(_item_pk(table, item) for item in items) if pk in by_pk]
+
+
+def _update_kind(field: PormField, value: Any, changed: set[str] | None) -> type | None:
+    """None to set `value`, DB_GENERATED to set the column's default, UNLOADED_COLUMN to leave it alone"""
+    if isinstance(value, (DB_GENERATED, UNLOADED_COLUMN)):
+        return type(value)
+
+    if changed is not None and field._field_name not in changed:
+        return UNLOADED_COLUMN
+
+    return None
+
+
+def _update_query(
+    table: Type[T],
+    pk_columns: list[str],
+    set_columns: list[str],
+    default_columns: list[str],
+    column_types: dict[str, str],
+    rows: int | None,
+) -> str:
+    """
+    UPDATE joined against the new values, as unnest arrays or with `rows` as a VALUES list. the rows are locked in
+    primary key order first, an UPDATE ... FROM alone locks them in whatever order the join produces them
+    """
+    tablename = _quote(table.__tablename__)
+    columns = pk_columns + set_columns
+
+    if rows is None:
+        source = f"SELECT * FROM unnest({', '.join(f'${i + 1}::{column_types[c]}[]' for i, c in enumerate(columns))})"
+    else:
+        source = "VALUES " + ", ".join(
+            f"({', '.join(f'${r * len(columns) + i + 1}::{column_types[c]}' for i, c in enumerate(columns))})"
+            for r in range(rows)
+        )
+
+    keys = ", ".join(_quote(column) for column in pk_columns)
+    assignments = [f"{_quote(column)} = _p3orm_rows.{_quote(column)}" for column in set_columns]
+    assignments += [f"{_quote(column)} = DEFAULT" for column in default_columns]
+    join = " AND ".join(f"{tablename}.{_quote(column)} = _p3orm_rows.{_quote(column)}" for column in pk_columns)
+
+    return (
+        f"WITH _p3orm_rows ({', '.join(_quote(column) for column in columns)}) AS ({source}), "
+        f"_p3orm_locked AS MATERIALIZED (SELECT {keys} FROM {tablename} "
+        f"WHERE ({keys}) IN (SELECT {keys} FROM _p3orm_rows) ORDER BY {keys} FOR UPDATE) "
+        f"UPDATE {tablename} SET {', '.join(assignments)} "
+        f"FROM _p3orm_rows JOIN _p3orm_locked USING ({keys}) WHERE {join}"
+    )
+
+
+def _joined_prefetch(
+    table: Type[T], prefetch: RELATIONS_TYPE | None, strategy: PrefetchStrategy
+) -> PrefetchTree | None:
+    return prefetch_plan(table, prefetch) if prefetch and strategy == PrefetchStrategy.join else None
+
+
+FETCH_TYPE = Callable[[str, list[Any]], Coroutine[None, None, list[asyncpg.Record]]]
+
+# the load setting a relationship on an item, by (id(item), relationship)
+type Claims = dict[tuple[int, PormRelationship[Any]], asyncio.Future[None]]
 
 
 async def _fetch_related(
-    table: Type[T], items: list[T], relations: RELATIONS_TYPE, connection: asyncpg.Connection
+    executor: Executor,
+    table: Type[T],
+    items: list[T],
+    relations: RELATIONS_TYPE,
+    identity_map: IdentityMap | None = None,
 ) -> list[T]:
-    FETCHED = []
+    plan = prefetch_plan(table, relations)
+    # every related row loaded by this call, by (table, primary key), so a row reached through several paths is
+    # decoded once and shared. inside an identity map scope that's the identity map, or `identity_map` when given
+    if identity_map is None:
+        identity_map = executor.identity_map
+
+    loaded: IdentityMap = {} if identity_map is None else identity_map
+    # the load of each (item, relationship) this call makes, so an item reached through several paths is loaded once.
+    # what was loaded before this call is always loaded again
+    claims: Claims = {}
+
+    if not executor.pool:
+        connection = cast(asyncpg.Connection, executor.connection)
+
+        async def fetch(query: str, query_args: list[Any]) -> list[asyncpg.Record]:
+            return await executor._fetch(connection, query, query_args)
+
+        # a single connection runs one query at a time, and a transaction's reads must stay on its connection
+        await _load_plan(table, items, plan, fetch, loaded, claims, concurrent=False)
+
+        return items
 
-    for relationships in relations:
-        await _load_relationships(table, items, relationships, connection, FETCHED)
+    semaphore = asyncio.Semaphore(executor.prefetch_concurrency)
+
+    async def fetch(query: str, query_args: list[Any]) -> list[asyncpg.Record]:
+        async with semaphore:
+            return await executor._read(query, query_args)
+
+    await _load_plan(table, items, plan, fetch, loaded, claims, concurrent=True)
 
     return items
 
 
-async def _load_relationships(
+async def _load_plan(
     table: Type[T],
     items: list[T],
-    relationships: Sequence[PormRelationship],
-    connection: asyncpg.Connection,
-    FETCHED: list[str],
+    plan: PrefetchTree,
+    fetch: FETCH_TYPE,
+    loaded: IdentityMap,
+    claims: Claims,
+    concurrent: bool,
 ) -> None:
-    for relationship in relationships:
-        items = await _load_relationship_for_items(table, items, relationship, connection, FETCHED)
-        table = relationship._data_type  # type: ignore
+    async def load(relationship: PormRelationship, subplan: PrefetchTree) -> None:
+        related_items = await _load_relationship_for_items(table, items, relationship, fetch, loaded, claims)
+
+        if subplan:
+            foreign_table = get_base_type(relationship._data_type)
+            await _load_plan(foreign_table, related_items, subplan, fetch, loaded, claims, concurrent)
+
+    if not concurrent:
+        for relationship, subplan in plan.items():
+            await load(relationship, subplan)
+
+        return
+
+    # sibling relationships don't depend on each other
+    loads = [asyncio.ensure_future(load(relationship, subplan)) for relationship, subplan in plan.items()]
+
+    try:
+        await asyncio.gather(*loads)
+    except BaseException:
+        for task in loads:
+            task.cancel()
+
+        # the other paths give back their connections and cancel their claims, which stops paths waiting on them,
+        # before the error goes up
+        await asyncio.gather(*loads, return_exceptions=True)
+        raise
 
 
 def _turn_record_into_orm_instance(table: Type[T], record: asyncpg.Record) -> T:
-    field_map = {}
-    for column_name, value in record.items():
-        if column_name not in table.__memo__.columns:
-            continue
-
-        field = table.__memo__.columns[column_name]
-
-        if value and is_field_pydantic(field):
-            field_type = get_base_type(field._data_type)
-            field_map[column_name] = field_type.model_validate_json(value)
-        elif value and is_field_enum(field):
-            field_map[column_name] = cast_enum(field, value)
-        else:
-            field_map[column_name] = value
+    return table.__memo__.record_decoder(record.keys())(record)
+
+
+def _turn_records_into_orm_instances(
+    table: Type[T], records: list[asyncpg.Record], identity_map: IdentityMap | None = None, refresh: bool = False
+) -> list[T]:
+    if not records:
+        return []
+
+    # every record of a result set has the same shape, so resolve the decode plan once
+    decode = table.__memo__.record_decoder(records[0].keys())
 
-    return table(**field_map)
+    # rows selected without their primary key can't be identified
+    if identity_map is None or not {pk.column_name for pk in table.__memo__.pk} <= set(records[0].keys()):
+        return [decode(record) for record in records]
+
+    items = []
+
+    for record in records:
+        key = (table, _instance_pk(table, record))
+
+        if (item := identity_map.get(key)) is None:
+            item = identity_map[key] = decode(record)
+
+        elif refresh or _has_unloaded_columns(table, item):
+            _refresh_instance(table, item, decode(record))
+
+        items.append(item)
+
+    return items
 
 
 async def _load_relationship_for_items(
     table: Type[T],
     items: list[T],
     relationship: PormRelationship[U],
-    connection: asyncpg.Connection,
-    FETCHED: list[str],
+    fetch: FETCH_TYPE,
+    loaded: IdentityMap,
+    claims: Claims,
 ) -> list[U]:
-    # short circuit here to avoid doing an IN on an empty list
-    if not items:
-        return []
+    """
+    sets `relationship` on every item not claimed by another path of this prefetch, returns the related items of all
+    of `items`
+    """
+    claim: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+    pending: list[T] = []
+    # loads of items shared with another path, which may still be running
+    others: dict[int, asyncio.Future[None]] = {}
+
+    for item in items:
+        if (other := claims.setdefault((id(item), relationship), claim)) is claim:
+            pending.append(item)
+        else:
+            others.setdefault(id(other), other)
 
-    foreign_table = cast(Type[U], get_base_type(relationship._data_type))
+    try:
+        await _set_relationship(table, pending, relationship, fetch, loaded)
+    except BaseException:
+        # paths waiting on this load stop too
+        claim.cancel()
+        raise
+
+    claim.set_result(None)
+
+    for other in others.values():
+        await other
+
+    # the next hop continues from the related items of every item, each of them once
+    unique: dict[int, U] = {}
+    for item in items:
+        value = getattr(item, relationship._field_name)
 
+        for related_item in value if relationship.is_plural() else [value] if value else []:
+            unique.setdefault(id(related_item), related_item)
+
+    return list(unique.values())
+
+
+async def _set_relationship(
+    table: Type[T],
+    items: list[T],
+    relationship: PormRelationship[U],
+    fetch: FETCH_TYPE,
+    loaded: IdentityMap,
+) -> None:
+    """sets `relationship` on `items` from one query per chunk of their keys"""
+    foreign_table = cast(Type[U], get_base_type(relationship._data_type))
+    foreign_memo = foreign_table.__memo__
     self_field = table.__memo__.columns[relationship.self_column]
 
-    relationship_id = (
-        f"{table.__tablename__}.{relationship.self_column}:{foreign_table.__tablename__}.{relationship.foreign_column}"
-    )
+    if any(isinstance(getattr(item, self_field._field_name), UNLOADED_COLUMN) for item in items):
+        raise P3ormException(
+            f"can't load {table.__name__}.{relationship._field_name} without {self_field._field_name}, it was left out"
+            " of the select"
+        )
 
-    if relationship_id in FETCHED:
-        fetched_related_items: list[U] = []
-        if relationship.is_plural():
-            [
-                fetched_related_items.extend(getattr(item, relationship._field_name))
-                for item in items
-                if getattr(item, relationship._field_name)
-            ]
-        else:
-            fetched_related_items = [
-                getattr(item, relationship._field_name) for item in items if getattr(item, relationship._field_name)
-            ]
-        return fetched_related_items
-    else:
-        FETCHED.append(relationship_id)
+    # every key once, NULL never matches anything
+    self_keys = list(dict.fromkeys(key for item in items if (key := getattr(item, self_field._field_name)) is not None))
+
+    related_by_key: DefaultDict[Any, list[U]] = defaultdict(list)
+
+    # a foreign key to the related table's primary key can be answered from rows loaded through another path,
+    # unless they came from a select that left columns out
+    [foreign_pk] = foreign_memo.pk if len(foreign_memo.pk) == 1 else [None]
+    if foreign_pk and foreign_pk.column_name == relationship.foreign_column and not relationship.criterion:
+        missing_keys = []
+
+        for key in self_keys:
+            related_item = loaded.get((foreign_table, key))
+
+            if related_item is not None and _loaded_every_column(foreign_table, related_item):
+                related_by_key[key].append(related_item)
+            else:
+                missing_keys.append(key)
+
+        self_keys = missing_keys
+
+    if self_keys:
+        query, query_args = _related_query(foreign_table, relationship)
+        records: list[asyncpg.Record] = []
 
-    self_keys = [getattr(item, self_field._field_name) for item in items]
+        # the keys go in as one array parameter, chunked so a huge prefetch doesn't become one huge statement
+        for i in range(0, len(self_keys), RELATED_KEYS_CHUNK_SIZE):
+            records += await fetch(query, [self_keys[i : i + RELATED_KEYS_CHUNK_SIZE], *query_args])
 
-    join_condition = PyPikaField(relationship.foreign_column).isin(self_keys)
-    if relationship.criterion:
-        join_condition &= relationship.criterion
+        if records:
+            decode = foreign_memo.record_decoder(records[0].keys())
 
-    parameterized_criterion, query_args = parameterize(join_condition)
-    query: PostgreSQLQueryBuilder = foreign_table.select().distinct().where(parameterized_criterion)
+            for record in records:
+                pk = _instance_pk(foreign_table, record)
 
-    records = await connection.fetch(query.get_sql(), *query_args or [])
-    related_items: list[U] = []
+                if (related_item := loaded.get((foreign_table, pk))) is None:
+                    related_item = loaded[(foreign_table, pk)] = decode(record)
+
+                elif not _loaded_every_column(foreign_table, related_item):
+                    _refresh_instance(foreign_table, related_item, decode(record))
+
+                related_by_key[record[relationship.foreign_column]].append(related_item)
 
     # TODO: set related relationship to item on related items
-    if relationship.relationship_type in (RelationshipType.foreign_key, RelationshipType.reverse_one):
-        related_item_map: dict[Any, U] = {
-            record[relationship.foreign_column]: _turn_record_into_orm_instance(foreign_table, record)
-            for record in records
-        }
+    for item in items:
+        related_items = related_by_key.get(getattr(item, self_field._field_name), [])
 
-        related_items = list(related_item_map.values())
+        if relationship.is_plural():
+            setattr(item, relationship._field_name, related_items)
+        else:
+            setattr(item, relationship._field_name, related_items[0] if related_items else None)
+
+
+def _related_query(foreign_table: Type[U], relationship: PormRelationship[U]) -> tuple[str, list[Any]]:
+    """`SELECT * FROM foreign WHERE "foreign_column" = ANY($1) AND <criterion>`, cached like `compile_select`"""
+    query_args: list[Any] = [None]
+    # several rows may match a reverse one to one, ordered by key the first one is the same every time
+    ordered = relationship.relationship_type == RelationshipType.reverse_one
+    key = (
+        "related",
+        relationship.foreign_column,
+        criterion_shape(relationship.criterion, query_args) if relationship.criterion else None,
+        ordered,
+    )
 
-        for item in items:
-            setattr(
-                item,
-                relationship._field_name,
-                related_item_map.get(getattr(item, self_field._field_name), None),
-            )
+    if (sql := foreign_table.__memo__.queries.get(key)) is None:
+        condition = PyPikaField(relationship.foreign_column) == Function("ANY", _param(1))
 
-    else:
-        related_items_map: DefaultDict[Any, list[U]] = defaultdict(list)
-        [
-            related_items_map[record.get(relationship.foreign_column)].append(  # type: ignore
-                _turn_record_into_orm_instance(foreign_table, record)
-            )
-            for record in records
-        ]
+        if relationship.criterion:
+            parameterized_criterion, _ = parameterize(relationship.criterion, [None])
+            condition &= parameterized_criterion
 
-        for item in items:
-            setattr(
-                item,
-                relationship._field_name,
-                related_items_map.get(getattr(item, self_field._field_name), []),
-            )
+        query = foreign_table.select().where(condition)
+
+        if ordered:
+            query = query.orderby(*(field._pypika_field for field in foreign_table.__memo__.pk))
 
-        related_items = [ri for ris in related_items_map.values() for ri in ris]
+        sql = query.get_sql()
+        foreign_table.__memo__.queries.put(key, sql)
 
-    return related_items
+    return sql, query_args[1:]
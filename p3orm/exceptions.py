@@ -12,3 +12,7 @@ class MisingPrimaryKeyException(P3ormException):
 
 class UnloadedRelationshipException(P3ormException):
     ...
+
+
+class UnloadedColumnException(P3ormException):
+    ...
@@ -24,6 +24,19 @@ class _DEFAULT(Parameter):
 DEFAULT = _DEFAULT()
 
 
+class Bind(Parameter):
+    """
+    named slot in the criterion of a prepared query, e.g. `db.prepare(Company, f(Company.id) == Bind("id"))`,
+    filled in with keyword arguments on every call
+    """
+
+    name: str
+
+    def __init__(self, name: str) -> None:
+        super().__init__(f":{name}")
+        self.name = name
+
+
 class PormField:
     pk: bool
     db_gen: bool
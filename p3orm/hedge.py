@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+from collections import deque
+from dataclasses import dataclass
+
+# latencies needed before the percentile is trusted, until then reads are hedged after `max_delay`
+MIN_SAMPLES = 20
+
+
+@dataclass
+class HedgeStats:
+    reads: int = 0
+    # reads that sent a second attempt, and how many of those the second attempt answered first
+    hedged: int = 0
+    wins: int = 0
+
+    @property
+    def rate(self) -> float:
+        return self.hedged / self.reads if self.reads else 0.0
+
+    def __repr__(self) -> str:
+        reads = self.reads
+        hedged = self.hedged
+        wins = self.wins
+
+        return f"<HedgeStats {reads=} {hedged=} {wins=}>"
+
+
+@dataclass
+class HedgeConfig:
+    """hedged reads, passed to `Postgres.connect_pool(hedge=...)`"""
+
+    # a read still running after this share of recent reads have finished is sent to a second pool too
+    percentile: float = 0.95
+    # bounds on the wait before the second attempt, in seconds
+    min_delay: float = 0.002
+    max_delay: float = 1.0
+    # how many recent reads the percentile is taken over
+    window: int = 1000
+
+
+class LatencyWindow:
+    """latencies of the last `config.window` reads, and the hedging delay they make for"""
+
+    config: HedgeConfig
+    stats: HedgeStats
+
+    _samples: deque[float]
+    _delay: float
+    # samples recorded since `_delay` was last worked out
+    _stale: int
+
+    def __init__(self, config: HedgeConfig) -> None:
+        self.config = config
+        self.stats = HedgeStats()
+        self._samples = deque(maxlen=config.window)
+        self._delay = config.max_delay
+        self._stale = 0
+
+    def record(self, latency: float) -> None:
+        self._samples.append(latency)
+        self._stale += 1
+
+        # sorting the window on every read would cost more than the reads, a tenth of it moves the percentile enough
+        if len(self._samples) >= MIN_SAMPLES and self._stale * 10 >= len(self._samples):
+            self._stale = 0
+            ordered = sorted(self._samples)
+            percentile = ordered[min(int(len(ordered) * self.config.percentile), len(ordered) - 1)]
+            self._delay = min(max(percentile, self.config.min_delay), self.config.max_delay)
+
+    def delay(self) -> float:
+        return self._delay
@@ -0,0 +1,473 @@
+from __future__ import annotations
+
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from dataclasses import dataclass
+from datetime import date, datetime, time
+from decimal import Decimal
+from enum import Enum
+from itertools import count as count_from
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Generic,
+    Hashable,
+    Iterator,
+    Sequence,
+    Type,
+    TypeVar,
+    cast,
+    get_args,
+    get_origin,
+)
+from uuid import UUID
+
+from pypika import functions as fn
+from pypika.enums import Order
+from pypika.terms import Criterion
+from pypika.terms import Field as PyPikaField
+from pypika.terms import LiteralValue
+
+from p3orm.exceptions import P3ormException
+from p3orm.fields import Bind, PormField, PormRelationship, RelationshipType
+from p3orm.table import IdentityMap, _has_unloaded_columns, _instance_pk, _refresh_instance
+from p3orm.utils import _param, _term_shape, criterion_shape, get_base_type, parameterize
+
+if TYPE_CHECKING:
+    from p3orm.drivers.postgres import RELATIONS_TYPE, Executor
+    from p3orm.table import Table
+
+T = TypeVar("T", bound="Table")
+
+
+def compile_select(
+    table: Type[T],
+    criterion: Criterion | None = None,
+    *,
+    count: bool = False,
+    order: Order | None = None,
+    by: PyPikaField | list[PyPikaField] | None = None,
+    limit: int | Bind | None = None,
+    offset: int | Bind | None = None,
+    columns: tuple[str, ...] | None = None,
+    related: PrefetchTree | None = None,
+) -> tuple[str, list[Any]]:
+    """
+    sql and arguments for a select on `table`. the sql is cached on the table keyed by the shape of the query,
+    so repeating a query with different values only walks the criterion and skips building and rendering it.
+    `columns` restricts the select list, see `projection`. `related` adds a json column per relationship, see
+    `prefetch_tree`
+    """
+    query_args: list[Any] = []
+    by_fields = (by if isinstance(by, list) else [by]) if by is not None else []
+
+    key = (
+        count,
+        criterion_shape(criterion, query_args) if criterion is not None else None,
+        order,
+        tuple(_term_shape(field) for field in by_fields),
+        limit is not None,
+        offset is not None,
+        columns,
+        _related_shape(related, query_args) if related else None,
+    )
+
+    if (sql := table.__memo__.queries.get(key)) is None:
+        build_args: list[Any] = []
+
+        if count:
+            query = table.select(fn.Count("*"))
+        elif columns:
+            query = table.from_().select(*(PyPikaField(column) for column in columns))
+        else:
+            query = table.select()
+
+        if criterion is not None:
+            parameterized_criterion, _ = parameterize(criterion, build_args)
+            query = query.where(parameterized_criterion)
+
+        if related:
+            aliases = count_from(1)
+            query = query.select(
+                *(
+                    LiteralValue(f'{subquery} "{JSON_KEY_PREFIX}{relationship._field_name}"')
+                    for relationship, subquery in _related_json(
+                        table, f'"{table.__tablename__}"', related, build_args, aliases
+                    )
+                )
+            )
+
+        if by_fields:
+            query = query.orderby(*by_fields, **({"order": order} if order else {}))
+
+        # limit and offset are bound too, so paging through results reuses the same sql
+        param_index = len(build_args)
+
+        if limit is not None:
+            param_index += 1
+            query = query.limit(_param(param_index))
+
+        if offset is not None:
+            param_index += 1
+            query = query.offset(_param(param_index))
+
+        sql = query.get_sql()
+        table.__memo__.queries.put(key, sql)
+
+    if limit is not None:
+        query_args.append(limit)
+
+    if offset is not None:
+        query_args.append(offset)
+
+    return sql, query_args
+
+
+# prefetch paths merged on their common prefixes, `{Company.employees: {Employee.company: {}}}`
+type PrefetchTree = dict[PormRelationship[Any], PrefetchTree]
+
+# relationships loaded in the same statement come back in json columns and keys named after the relationship
+JSON_KEY_PREFIX = "_p3orm."
+# what a field of a json or jsonb column can be typed as, when it isn't a pydantic model
+JSON_COLUMN_TYPES = (str, dict, list, Any, object)
+
+
+def prefetch_tree(relations: RELATIONS_TYPE) -> PrefetchTree:
+    tree: PrefetchTree = {}
+
+    for relationships in relations:
+        node = tree
+        for relationship in relationships:
+            node = node.setdefault(relationship, {})
+
+    return tree
+
+
+def prefetch_plan(table: Type[T], relations: RELATIONS_TYPE) -> PrefetchTree:
+    """`prefetch_tree` of `relations`, built once per table and prefetch spec"""
+    key = tuple(tuple(relationships) for relationships in relations)
+
+    if (plan := table.__memo__.prefetch_plans.get(key)) is None:
+        plan = prefetch_tree(relations)
+        table.__memo__.prefetch_plans.put(key, plan)
+
+    return plan
+
+
+def _related_shape(tree: PrefetchTree, query_args: list[Any]) -> Hashable:
+    # walks relationship criteria in the same order as `_related_json` so the arguments line up
+    return tuple(
+        (
+            relationship,
+            criterion_shape(relationship.criterion, query_args) if relationship.criterion else None,
+            _related_shape(subtree, query_args),
+        )
+        for relationship, subtree in tree.items()
+    )
+
+
+def _related_json(
+    table: Type[Table], parent: str, tree: PrefetchTree, query_args: list[Any], aliases: Iterator[int]
+) -> list[tuple[PormRelationship[Any], str]]:
+    """
+    a correlated subquery per relationship of `parent` (the quoted table or alias of `table`), turning the related
+    rows into json: an object (or null) for single relationships, an array for plural ones
+    """
+    subqueries = []
+
+    for relationship, subtree in tree.items():
+        foreign_table = cast(Type["Table"], get_base_type(relationship._data_type))
+        alias = f'"_p3orm_{next(aliases)}"'
+
+        condition = f'{alias}."{relationship.foreign_column}"={parent}."{relationship.self_column}"'
+        if relationship.criterion:
+            parameterized_criterion, _ = parameterize(relationship.criterion, query_args)
+            condition += " AND " + parameterized_criterion.get_sql(quote_char='"')
+
+        nested = [
+            f"'{JSON_KEY_PREFIX}{nested._field_name}',{subquery}"
+            for nested, subquery in _related_json(foreign_table, alias, subtree, query_args, aliases)
+        ]
+
+        row = json_row(foreign_table, alias, nested)
+        source = f'FROM "{foreign_table.__tablename__}" {alias} WHERE {condition}'
+
+        if relationship.is_plural():
+            subqueries.append((relationship, f"(SELECT coalesce(jsonb_agg({row}),'[]') {source})"))
+        else:
+            order = ""
+
+            # several rows may match a reverse one to one, the one with the lowest key is taken like `_related_query`
+            # takes it
+            if relationship.relationship_type == RelationshipType.reverse_one:
+                order = " ORDER BY " + ",".join(f'{alias}."{field.column_name}"' for field in foreign_table.__memo__.pk)
+
+            subqueries.append((relationship, f"(SELECT {row} {source}{order} LIMIT 1)"))
+
+    return subqueries
+
+
+def json_row(table: Type[Table], alias: str, extra: list[str] | None = None) -> str:
+    """
+    a row of `table` (as `alias`) as a json object, decoded like a record would be: json numbers are floats, so
+    numerics are carried as strings to keep their precision, and json and jsonb columns as their text, which is how
+    asyncpg reads them. `extra` are more `'key',value` pairs to add
+    """
+    memo = table.__memo__
+    pairs: list[str] = []
+
+    for field in memo.fields.values():
+        column = f'{alias}."{field.column_name}"'
+        base_type = get_base_type(field._data_type)
+        decoded = memo.json_decoders[field._field_name] is not None
+
+        if base_type is Decimal:
+            pairs.append(f"'{field.column_name}',{column}::text")
+
+        # and numeric arrays as arrays of strings
+        elif (get_origin(base_type) or base_type) in (list, set) and get_args(base_type)[:1] == (Decimal,):
+            pairs.append(f"'{field.column_name}',{column}::text[]")
+
+        elif (get_origin(base_type) or base_type) in JSON_COLUMN_TYPES and not decoded:
+            pairs.append(
+                f"'{field.column_name}',CASE WHEN pg_typeof({column}) IN ('json'::regtype,'jsonb'::regtype) "
+                f"THEN to_jsonb({column}::text) ELSE to_jsonb({column}) END"
+            )
+
+    pairs += extra or []
+
+    return f"to_jsonb({alias})" + (f"||jsonb_build_object({','.join(pairs)})" if pairs else "")
+
+
+def hydrate_related(
+    table: Type[T],
+    tree: PrefetchTree,
+    items: list[T],
+    records: list[Any],
+    identity_map: IdentityMap | None = None,
+) -> None:
+    """sets the relationships selected with `compile_select(related=...)` from each record onto its instance"""
+    for relationship, subtree in tree.items():
+        key = f"{JSON_KEY_PREFIX}{relationship._field_name}"
+        foreign_table = cast(Type["Table"], get_base_type(relationship._data_type))
+
+        for item, record in zip(items, records):
+            value = record[key]
+            setattr(
+                item,
+                relationship._field_name,
+                _from_json(
+                    foreign_table,
+                    relationship,
+                    subtree,
+                    # already decoded when a jsonb codec is set on the connection
+                    json.loads(value) if isinstance(value, str) else value,
+                    identity_map,
+                ),
+            )
+
+
+def _from_json(
+    table: Type[Table],
+    relationship: PormRelationship[Any],
+    tree: PrefetchTree,
+    value: Any,
+    identity_map: IdentityMap | None,
+) -> Any:
+    if value is None:
+        return None
+
+    if relationship.is_plural():
+        return [_instance_from_json(table, tree, row, identity_map) for row in value]
+
+    return _instance_from_json(table, tree, value, identity_map)
+
+
+def _instance_from_json(
+    table: Type[Table], tree: PrefetchTree, row: dict[str, Any], identity_map: IdentityMap | None
+) -> Any:
+    if identity_map is None:
+        item = table.__memo__.json_decoder(row)
+
+    elif (item := identity_map.get(key := (table, _instance_pk(table, row)))) is None:
+        item = identity_map[key] = table.__memo__.json_decoder(row)
+
+    elif _has_unloaded_columns(table, item):
+        _refresh_instance(table, item, table.__memo__.json_decoder(row))
+
+    for relationship, subtree in tree.items():
+        foreign_table = cast(Type["Table"], get_base_type(relationship._data_type))
+        value = row[f"{JSON_KEY_PREFIX}{relationship._field_name}"]
+        setattr(item, relationship._field_name, _from_json(foreign_table, relationship, subtree, value, identity_map))
+
+    return item
+
+
+def projection(table: Type[T], only: Sequence[Any] | None, defer: Sequence[Any] | None) -> tuple[str, ...] | None:
+    """
+    columns to select for `only` or `defer`, given as `Table.field` or `f(Table.field)`, in table order.
+    the primary key is always selected so the instances can still be updated and have relationships loaded
+    """
+    if only is None and defer is None:
+        return None
+
+    if only is not None and defer is not None:
+        raise P3ormException("pass either `only` or `defer`, not both")
+
+    memo = table.__memo__
+    names = {_column_name(table, field) for field in (only if only is not None else defer)}  # type: ignore
+
+    return tuple(
+        column_name
+        for column_name, field in memo.columns.items()
+        if field.pk or (column_name in names) == (only is not None)
+    )
+
+
+def _column_name(table: Type[T], field: Any) -> str:
+    columns = table.__memo__.columns
+
+    if isinstance(field, PormField) and columns.get(field.column_name) is field:
+        return field.column_name
+
+    if isinstance(field, PyPikaField) and field.name in columns and columns[field.name]._pypika_field is field:
+        return field.name
+
+    raise P3ormException(f"expected a field of {table.__name__}, got {field!r}")
+
+
+class PreparedQuery(Generic[T]):
+    """a query on `table` compiled once, whose `Bind` slots are filled in with keyword arguments on every call"""
+
+    executor: Executor
+    table: Type[T]
+    prefetch: RELATIONS_TYPE | None
+
+    _all: tuple[str, list[Any]]
+    _one: tuple[str, list[Any]]
+    _first: tuple[str, list[Any]]
+    _count: tuple[str, list[Any]]
+
+    def __init__(
+        self,
+        executor: Executor,
+        table: Type[T],
+        criterion: Criterion | None = None,
+        *,
+        order: Order | None = None,
+        by: PyPikaField | list[PyPikaField] | None = None,
+        limit: int | Bind | None = None,
+        offset: int | Bind | None = None,
+        only: Sequence[Any] | None = None,
+        defer: Sequence[Any] | None = None,
+        prefetch: RELATIONS_TYPE | None = None,
+    ) -> None:
+        if criterion is not None and not isinstance(criterion, Criterion):
+            raise P3ormException(f"{criterion=} must be instance of Criterion. did you wrap the field with `f()`?")
+
+        self.executor = executor
+        self.table = table
+        self.prefetch = prefetch
+
+        columns = projection(table, only, defer)
+
+        self._all = compile_select(table, criterion, order=order, by=by, limit=limit, offset=offset, columns=columns)
+        self._one = compile_select(table, criterion, limit=2, columns=columns)
+        self._first = compile_select(table, criterion, order=order, by=by, limit=1, columns=columns)
+        self._count = compile_select(table, criterion, count=True)
+
+    async def fetch_all(self, **binds: Any) -> list[T]:
+        sql, query_args = self._all
+        records = await self.executor._select(self.table, sql, _bind(query_args, binds), None)
+
+        if self.prefetch:
+            await self.executor.fetch_related(self.table, records, self.prefetch)
+
+        return records
+
+    async def fetch_one(self, **binds: Any) -> T:
+        sql, query_args = self._one
+        records = await self.executor._select(self.table, sql, _bind(query_args, binds), None)
+
+        if len(records) != 1:
+            raise P3ormException(f"expected one result in {self.table.__name__} where {binds=}, found {len(records)}")
+
+        if self.prefetch:
+            await self.executor.fetch_related(self.table, records, self.prefetch)
+
+        return records[0]
+
+    async def fetch_first(self, **binds: Any) -> T | None:
+        sql, query_args = self._first
+        records = await self.executor._select(self.table, sql, _bind(query_args, binds), None)
+
+        if len(records) == 0:
+            return None
+
+        if self.prefetch:
+            await self.executor.fetch_related(self.table, records, self.prefetch)
+
+        return records[0]
+
+    async def count(self, **binds: Any) -> int:
+        sql, query_args = self._count
+        res = await self.executor._read(sql, _bind(query_args, binds))
+
+        return res[0]["count"]
+
+
+def _bind(query_args: list[Any], binds: dict[str, Any]) -> list[Any]:
+    try:
+        return [binds[arg.name] if isinstance(arg, Bind) else arg for arg in query_args]
+    except KeyError as e:
+        raise P3ormException(f"no value passed for Bind({e.args[0]!r})")
+
+
+@dataclass
+class Page(Generic[T]):
+    items: list[T]
+    # opaque token to pass as `after` for the following page, None on the last page
+    next: str | None
+
+
+# json can't carry these types, so they're tagged with a one letter key and restored when the token is read
+_CURSOR_TAGS: dict[str, tuple[type, Callable[[Any], Any], Callable[[Any], Any]]] = {
+    "dt": (datetime, datetime.isoformat, datetime.fromisoformat),
+    "d": (date, date.isoformat, date.fromisoformat),
+    "t": (time, time.isoformat, time.fromisoformat),
+    "u": (UUID, str, UUID),
+    "n": (Decimal, str, Decimal),
+    "b": (bytes, bytes.hex, bytes.fromhex),
+}
+
+
+def _tag_cursor_value(value: Any) -> Any:
+    if isinstance(value, Enum):
+        value = value.value
+
+    for tag, (data_type, dump, _) in _CURSOR_TAGS.items():
+        if isinstance(value, data_type):
+            return {tag: dump(value)}
+
+    return value
+
+
+def _untag_cursor_value(value: Any) -> Any:
+    if isinstance(value, dict):
+        [(tag, dumped)] = value.items()
+        return _CURSOR_TAGS[tag][2](dumped)
+
+    return value
+
+
+def encode_cursor(values: list[Any]) -> str:
+    dumped = json.dumps([_tag_cursor_value(value) for value in values], separators=(",", ":"))
+    return urlsafe_b64encode(dumped.encode()).decode()
+
+
+def decode_cursor(token: str) -> list[Any]:
+    try:
+        return [_untag_cursor_value(value) for value in json.loads(urlsafe_b64decode(token.encode()))]
+    except (ValueError, KeyError, TypeError):
+        raise P3ormException(f"invalid page token {token=}")
@@ -2,26 +2,56 @@ from __future__ import annotations
 
 import dataclasses
 import typing
+from copy import copy, deepcopy
 from dataclasses import dataclass
-from typing import TYPE_CHECKING, Any, Callable, ClassVar, Generator, Generic, Type, TypeVar, get_args
+from operator import attrgetter
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    ClassVar,
+    Collection,
+    Generator,
+    Generic,
+    Hashable,
+    Iterable,
+    Type,
+    TypeVar,
+    get_args,
+)
 
 from pypika.dialects import PostgreSQLQueryBuilder
 from pypika.terms import Field as PyPikaField
 
+from p3orm.cache import CacheConfig, LRUCache
 from p3orm.exceptions import (
     MisingPrimaryKeyException,
     MissingTablename,
     P3ormException,
+    UnloadedColumnException,
     UnloadedRelationshipException,
 )
 from p3orm.fields import PormField, PormRelationship, RelationshipType
-from p3orm.utils import is_optional
+from p3orm.utils import (
+    get_field_decoder,
+    get_field_encoder,
+    get_field_json_decoder,
+    is_field_container,
+    is_field_pydantic,
+    is_optional,
+)
 
 if TYPE_CHECKING:
     from p3orm import Driver
+    from p3orm.query import PrefetchTree
 
 T = TypeVar("T", bound="Table")
 
+COMPILED_QUERY_CACHE_SIZE = 256
+
+# instances by (table, primary key)
+type IdentityMap = dict[tuple[type, Any], Any]
+
 
 class TableMemo:
     table: Type[Table]
@@ -32,8 +62,29 @@ class TableMemo:
     factory: Type[Any]
     record_t_kwarg_map: dict[str, str]
     record_kwarg_map: dict[str, str]
+    decoders: dict[str, Callable[[Any], Any] | None]
+    record_decoders: dict[tuple[str, ...], Callable[[Any], Any]]
+    encoders: dict[str, Callable[[Any], Any] | None]
+    json_decoders: dict[str, Callable[[Any], Any] | None]
+    json_decoder: Callable[[dict[str, Any]], Any]
+    # decode what pydantic fields were loaded with again, see `_changed_fields`
+    loaded_decoders: dict[str, Callable[[Any], Any] | None]
+    # fields holding lists, dicts or sets, copied when loaded so changes made in place are seen
+    containers: set[str]
+    field_values: Callable[[Any], tuple[Any, ...]]
+    queries: LRUCache[Hashable, str]
+    prefetch_plans: LRUCache[Hashable, PrefetchTree]
+    column_types: dict[str, str]
+    # instances by primary key, only for tables with a cache configured
+    cache: LRUCache[Any, Any] | None
     driver: Driver
 
+    def record_decoder(self, columns: Iterable[str]) -> Callable[[Any], Any]:
+        columns = tuple(columns)
+        if (decoder := self.record_decoders.get(columns)) is None:
+            decoder = self.record_decoders[columns] = _compile_record_decoder(self, columns)
+        return decoder
+
 
 TABLES: dict[Type[Table], TableMemo] = {}
 
@@ -60,6 +111,36 @@ class UNLOADED_RELATIONSHIP(Generic[T]):
         return False
 
 
+@dataclass(eq=False)
+class UNLOADED_COLUMN(Generic[T]):
+    """
+    stands in for a field left out of a select with `only` or `defer`. using it, even to test or compare it, raises
+    instead of passing silently
+    """
+
+    name: str
+    data_type: Type[T]
+
+    def _unloaded(self, *_: Any) -> Any:
+        raise UnloadedColumnException(f"column {self.name=} not loaded, select it with `only` or drop it from `defer`")
+
+    def __getattr__(self, attr: str) -> Any:
+        # copy, pickle and friends probe for dunders, those still get the usual AttributeError
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+
+        self._unloaded()
+
+    __str__ = __iter__ = __len__ = __getitem__ = __contains__ = _unloaded  # type: ignore
+    __bool__ = __eq__ = __ne__ = __hash__ = _unloaded  # type: ignore
+
+    def __repr__(self) -> str:
+        name = self.name
+        type = self.data_type
+
+        return f"<UNLOADED COLUMN {name=} {type=}>"
+
+
 @dataclass
 class DB_GENERATED(Generic[T]):
     name: str
@@ -114,6 +195,235 @@ def create_dataclass(
     )
 
 
+# builds `decode(record) -> instance` for one result shape (the ordered column names of a record).
+# the per-field type inspection already happened in `_init_stuff`, so the generated function just
+# unpacks the record positionally and calls the factory with keyword arguments, e.g.
+#
+#   def decode(record):
+#       [v0, v1, v2, _] = record.values()
+#       f1 = d1(v1) if v1 else v1
+#       item = factory(id=v0, kind=f1, meta=d2(v2) if v2 else v2, notes=u_notes)
+#       item._p3orm_loaded = (v0, f1, v2, u_notes)
+#       return item
+#
+# fields missing from the shape (left out with `only` or `defer`) are set to a shared `UNLOADED_COLUMN`.
+# `_p3orm_loaded` is what `_changed_fields` compares against, see `_loaded_value`
+def _compile_record_decoder(memo: TableMemo, columns: tuple[str, ...]) -> Callable[[Any], Any]:
+    namespace: dict[str, Any] = {"factory": memo.factory, "copy": copy}
+    targets: list[str] = []
+    statements: list[str] = []
+    kwargs: dict[str, str] = {}
+    loaded: dict[str, str] = {}
+
+    for i, column_name in enumerate(columns):
+        field = memo.columns.get(column_name)
+
+        if field is None or field._field_name in kwargs:
+            targets.append("_")
+            continue
+
+        targets.append(f"v{i}")
+
+        if (decoder := memo.decoders[field._field_name]) is None:
+            kwargs[field._field_name] = f"v{i}"
+        elif memo.loaded_decoders[field._field_name] is not None:
+            namespace[f"d{i}"] = decoder
+            kwargs[field._field_name] = f"d{i}(v{i}) if v{i} else v{i}"
+        else:
+            namespace[f"d{i}"] = decoder
+            statements.append(f"f{i} = d{i}(v{i}) if v{i} else v{i}")
+            kwargs[field._field_name] = f"f{i}"
+
+        loaded[field._field_name] = _loaded_value(memo, field._field_name, f"v{i}", kwargs[field._field_name])
+
+    for field_name, field in memo.fields.items():
+        if field_name not in kwargs:
+            namespace[f"u_{field_name}"] = UNLOADED_COLUMN(name=field_name, data_type=field._data_type)
+            kwargs[field_name] = loaded[field_name] = f"u_{field_name}"
+
+    source = (
+        "def decode(record):\n"
+        f"    [{', '.join(targets)}] = record.values()\n"
+        + "".join(f"    {statement}\n" for statement in statements)
+        + f"    item = factory({', '.join(f'{name}={value}' for name, value in kwargs.items())})\n"
+        f"    item._p3orm_loaded = ({''.join(f'{loaded[name]}, ' for name in memo.fields)})\n"
+        "    return item\n"
+    )
+    exec(source, namespace)  # noqa: S102
+
+    return namespace["decode"]
+
+
+# builds `decode(row) -> instance` for a row turned into a json object by `to_jsonb`, which always has every
+# column, e.g.
+#
+#   def decode(row):
+#       v0 = row["id"]
+#       f1 = d1(v1) if (v1 := row["created_at"]) is not None else None
+#       item = factory(id=v0, created_at=f1)
+#       item._p3orm_loaded = (v0, f1)
+#       return item
+def _compile_json_decoder(memo: TableMemo) -> Callable[[dict[str, Any]], Any]:
+    namespace: dict[str, Any] = {"factory": memo.factory, "copy": copy}
+    statements: list[str] = []
+    kwargs: list[str] = []
+    loaded: list[str] = []
+
+    for i, (field_name, field) in enumerate(memo.fields.items()):
+        if (decoder := memo.json_decoders[field_name]) is None:
+            statements.append(f"v{i} = f{i} = row[{field.column_name!r}]")
+        else:
+            namespace[f"d{i}"] = decoder
+            statements.append(f"f{i} = d{i}(v{i}) if (v{i} := row[{field.column_name!r}]) is not None else None")
+
+        kwargs.append(f"{field_name}=f{i}")
+        loaded.append(_loaded_value(memo, field_name, f"v{i}", f"f{i}"))
+
+    source = (
+        "def decode(row):\n"
+        + "".join(f"    {statement}\n" for statement in statements)
+        + f"    item = factory({', '.join(kwargs)})\n"
+        f"    item._p3orm_loaded = ({''.join(f'{value}, ' for value in loaded)})\n"
+        "    return item\n"
+    )
+    exec(source, namespace)  # noqa: S102
+
+    return namespace["decode"]
+
+
+def _loaded_value(memo: TableMemo, field_name: str, raw: str, decoded: str) -> str:
+    # pydantic models are kept as the json they were decoded from and only decoded again to compare, lists, dicts
+    # and sets are copied (shallowly) so changing them in place still shows. everything else is kept as is
+    if memo.loaded_decoders[field_name] is not None:
+        return raw
+
+    if field_name in memo.containers:
+        return f"copy({decoded})"
+
+    return decoded
+
+
+def _instance_pk(table: Type[Table], row: Any) -> Any:
+    """primary key of a record or json row, the value itself for a single column key"""
+    if len(pk := table.__memo__.pk) == 1:
+        return row[pk[0].column_name]
+
+    return tuple(row[field.column_name] for field in pk)
+
+
+def _item_pk(table: Type[Table], item: Any) -> Any:
+    """primary key of an instance, like `_instance_pk`"""
+    if len(pk := table.__memo__.pk) == 1:
+        return getattr(item, pk[0]._field_name)
+
+    return tuple(getattr(item, field._field_name) for field in pk)
+
+
+def _copy_instance(table: Type[Table], item: Any) -> Any:
+    """
+    new instance with the columns of `item`, relationships unloaded. lists, dicts, sets and pydantic models are
+    copied deeply, so changing them in place on one of the instances doesn't show on the other
+    """
+    memo = table.__memo__
+    values = {
+        field_name: (
+            deepcopy(value)
+            if (field_name in memo.containers or memo.loaded_decoders[field_name] is not None)
+            and not isinstance(value, (DB_GENERATED, UNLOADED_COLUMN))
+            else value
+        )
+        for field_name, value in zip(memo.fields, memo.field_values(item))
+    }
+    instance = memo.factory(**values)
+
+    if (loaded := getattr(item, "_p3orm_loaded", None)) is not None:
+        instance._p3orm_loaded = loaded
+
+    return instance
+
+
+def _has_unloaded_columns(table: Type[Table], item: Any) -> bool:
+    return any(isinstance(value, UNLOADED_COLUMN) for value in table.__memo__.field_values(item))
+
+
+def _loaded_every_column(table: Type[Table], item: Any) -> bool:
+    """whether `item` was loaded with all of its columns, values set on it since don't count"""
+    if (loaded := getattr(item, "_p3orm_loaded", None)) is None:
+        return not _has_unloaded_columns(table, item)
+
+    return not any(isinstance(value, UNLOADED_COLUMN) for value in loaded)
+
+
+def _refresh_instance(table: Type[Table], item: Any, fresh: Any) -> None:
+    # relationships stay as they were loaded, columns the fresh row doesn't have stay as they were
+    for field_name, value in zip(table.__memo__.fields, table.__memo__.field_values(fresh)):
+        if not isinstance(value, UNLOADED_COLUMN):
+            setattr(item, field_name, value)
+
+    if (fresh_loaded := getattr(fresh, "_p3orm_loaded", None)) is None:
+        return
+
+    if (loaded := getattr(item, "_p3orm_loaded", None)) is None:
+        item._p3orm_loaded = fresh_loaded
+    else:
+        item._p3orm_loaded = tuple(
+            before if isinstance(after, UNLOADED_COLUMN) else after for before, after in zip(loaded, fresh_loaded)
+        )
+
+
+def _mark_loaded(table: Type[Table], item: Any, fields: Collection[str] | None = None) -> None:
+    """
+    takes what `item` holds now as what it was loaded with once it's been written, so the next update compares
+    against what's stored. only `fields` are taken when given, the others keep comparing against the old values
+    """
+    memo = table.__memo__
+    loaded: list[Any] = []
+    before = getattr(item, "_p3orm_loaded", None)
+
+    for i, (field_name, value) in enumerate(zip(memo.fields, memo.field_values(item))):
+        if fields is not None and field_name not in fields:
+            value = (
+                before[i]
+                if before is not None
+                else UNLOADED_COLUMN(name=field_name, data_type=memo.fields[field_name]._data_type)
+            )
+        elif isinstance(value, (DB_GENERATED, UNLOADED_COLUMN)):
+            pass
+        elif value and memo.loaded_decoders[field_name] is not None:
+            value = memo.encoders[field_name](value)  # type: ignore
+        elif isinstance(value, (list, dict, set)):
+            value = copy(value)
+
+        loaded.append(value)
+
+    item._p3orm_loaded = tuple(loaded)
+
+
+def _changed_fields(table: Type[Table], item: Any) -> set[str] | None:
+    """
+    fields of `item` set to something other than what it was loaded with. None when it wasn't loaded from the
+    database, so there's nothing to compare against
+    """
+    if (loaded := getattr(item, "_p3orm_loaded", None)) is None:
+        return None
+
+    memo = table.__memo__
+    changed: set[str] = set()
+
+    for field_name, value, before, decoder in zip(
+        memo.fields, memo.field_values(item), loaded, memo.loaded_decoders.values()
+    ):
+        if isinstance(value, UNLOADED_COLUMN):
+            continue
+
+        if isinstance(before, UNLOADED_COLUMN):
+            changed.add(field_name)
+        elif value is not before and value != (decoder(before) if decoder is not None and before else before):
+            changed.add(field_name)
+
+    return changed
+
+
 """
 def create_factory(
     class_name: str,
@@ -135,6 +445,7 @@ def create_factory(
 class Table(metaclass=TableMeta):
     __tablename__: ClassVar[str]
     __meta__: ClassVar[bool] = False
+    __cache__: ClassVar[CacheConfig | None] = None
 
     __memo__: ClassVar[TableMemo]
 
@@ -155,7 +466,7 @@ class Table(metaclass=TableMeta):
         yield cls.__validate
 
     @classmethod
-    def _init_stuff(cls, driver: Driver) -> TableMemo:
+    def _init_stuff(cls, driver: Driver, cache: CacheConfig | None = None) -> TableMemo:
         memo = TableMemo()
         memo.table = cls
         memo.driver = driver
@@ -164,6 +475,16 @@ class Table(metaclass=TableMeta):
         memo.columns = {}
         memo.record_t_kwarg_map = {}
         memo.record_kwarg_map = {}
+        memo.decoders = {}
+        memo.record_decoders = {}
+        memo.encoders = {}
+        memo.json_decoders = {}
+        memo.loaded_decoders = {}
+        memo.containers = set()
+        memo.queries = LRUCache(COMPILED_QUERY_CACHE_SIZE)
+        memo.prefetch_plans = LRUCache(COMPILED_QUERY_CACHE_SIZE)
+        memo.column_types = {}
+        memo.cache = LRUCache(config.max_size, ttl=config.ttl) if (config := cache or cls.__cache__) else None
         memo.pk = []
 
         type_hints = typing.get_type_hints(cls)
@@ -184,6 +505,15 @@ class Table(metaclass=TableMeta):
                     memo.columns[field.column_name] = field
                     memo.record_kwarg_map[field.column_name] = field_name
                     memo.record_t_kwarg_map[f"{cls.__tablename__}.{field.column_name}"] = field_name
+                    memo.decoders[field_name] = get_field_decoder(field)
+                    memo.encoders[field_name] = get_field_encoder(field)
+                    memo.json_decoders[field_name] = get_field_json_decoder(field)
+                    memo.loaded_decoders[field_name] = (
+                        memo.json_decoders[field_name] if is_field_pydantic(field) else None
+                    )
+
+                    if is_field_container(field):
+                        memo.containers.add(field_name)
 
                     if field.pk:
                         memo.pk.append(field)
@@ -200,6 +530,13 @@ class Table(metaclass=TableMeta):
         if len(memo.pk) == 0:
             raise MisingPrimaryKeyException(f"{cls.__name__} must have at least 1 column to uniquely identify rows")
 
+        # reads every field of an instance in one call, always as a tuple in `memo.fields` order
+        if len(memo.fields) > 1:
+            memo.field_values = attrgetter(*memo.fields)
+        else:
+            [only_field] = memo.fields
+            memo.field_values = lambda item: (getattr(item, only_field),)
+
         # tack on the model factory
         factory_fields: list[str | tuple[str, type] | tuple[str, type, dataclasses.Field]] = []
         for field_name, field in memo.fields.items():
@@ -231,7 +568,11 @@ class Table(metaclass=TableMeta):
                 )
             )
 
-        memo.factory = create_dataclass(cls.__name__, factory_fields)
+        # instances also get a `_p3orm_loaded` slot, outside of the dataclass fields, for what they were loaded with.
+        # instances made by hand don't have it set
+        dataclass_type = create_dataclass(cls.__name__, factory_fields)
+        memo.factory = type(cls.__name__, (dataclass_type,), {"__slots__": ("_p3orm_loaded",)})
+        memo.json_decoder = _compile_json_decoder(memo)
 
         TABLES[cls] = memo
         cls.__memo__ = memo
@@ -241,5 +582,5 @@ class Table(metaclass=TableMeta):
         if _is_meta_table(cls):
             return
 
-        if not cls.__tablename__:
+        if not getattr(cls, "__tablename__", None):
             raise MissingTablename(f"{cls} is missing a __tablename__ property")
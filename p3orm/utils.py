@@ -1,12 +1,25 @@
+from datetime import date, datetime, time, timezone
+from decimal import Decimal
 from enum import Enum
+from functools import cache
 from types import NoneType, UnionType
-from typing import Any, Type, cast, get_args, get_origin
+from typing import Any, Callable, Hashable, Type, cast, get_args, get_origin
+from uuid import UUID
 
 import asyncpg
-from pypika import Criterion, NullValue, Parameter
+from pypika import Criterion, Field, NullValue, Parameter
 from pypika.enums import Comparator
 from pypika.queries import QueryBuilder
-from pypika.terms import BasicCriterion, ComplexCriterion, ContainsCriterion, RangeCriterion, ValueWrapper
+from pypika.terms import (
+    ArithmeticExpression,
+    BasicCriterion,
+    ComplexCriterion,
+    ContainsCriterion,
+    RangeCriterion,
+    Term,
+    Tuple,
+    ValueWrapper,
+)
 
 try:
     from pydantic import BaseModel
@@ -15,7 +28,7 @@ try:
 except ImportError:
     PydanticBaseModel = None
 
-from p3orm.fields import PormField
+from p3orm.fields import Bind, PormField
 
 
 def is_optional(t: Type) -> bool:
@@ -39,6 +52,11 @@ def is_field_pydantic(field: PormField) -> bool:
     return False
 
 
+def is_field_container(field: PormField) -> bool:
+    base_type = get_base_type(field._data_type)
+    return (get_origin(base_type) or base_type) in (list, dict, set)
+
+
 def is_field_enum(field: PormField) -> bool:
     base_type = get_base_type(field._data_type)
 
@@ -67,11 +85,105 @@ def cast_enum(field: PormField, value: str) -> bool:
     raise ValueError(f"Could not cast {value} to {base_type}")
 
 
+def get_enum_caster(field: PormField) -> Callable[[Any], Any]:
+    base_type = get_base_type(field._data_type)
+
+    if isinstance(base_type, type(Enum)):
+        return base_type
+
+    def _cast(value: Any) -> Any:
+        return cast_enum(field, value)
+
+    return _cast
+
+
+def get_field_decoder(field: PormField) -> Callable[[Any], Any] | None:
+    """resolve once how a database value is turned into this field's python value (None means identity)"""
+    if is_field_pydantic(field):
+        return get_base_type(field._data_type).model_validate_json
+
+    if is_field_enum(field):
+        return get_enum_caster(field)
+
+    return None
+
+
+def get_field_encoder(field: PormField) -> Callable[[Any], Any] | None:
+    """resolve once how this field's python value is turned into a database value (None means passthrough)"""
+    if is_field_pydantic(field):
+        return get_base_type(field._data_type).model_dump_json
+
+    if is_field_enum(field):
+        return get_enum_caster(field)
+
+    return None
+
+
+def _datetime_from_json(value: str) -> datetime:
+    # to_jsonb writes timestamptz in the session's time zone, asyncpg hands them over in utc
+    parsed = datetime.fromisoformat(value)
+    return parsed.astimezone(timezone.utc) if parsed.tzinfo else parsed
+
+
+def _bytes_from_json(value: str) -> bytes:
+    # bytea comes out as its hex escape, `\x0102`
+    return bytes.fromhex(value[2:])
+
+
+# types that json can't carry, so to_jsonb writes them as strings
+JSON_DECODERS: dict[type, Callable[[Any], Any]] = {
+    datetime: _datetime_from_json,
+    date: date.fromisoformat,
+    time: time.fromisoformat,
+    UUID: UUID,
+    Decimal: Decimal,
+    float: float,
+    bytes: _bytes_from_json,
+}
+
+
+def _json_array_decoder(t: Type) -> Callable[[Any], Any] | None:
+    """decodes the items of an array carried in json like asyncpg decodes them, None when they're kept as is"""
+    if (get_origin(t) or t) not in (list, set) or not (args := get_args(t)):
+        return None
+
+    item_type = get_base_type(args[0])
+
+    if (decode_item := JSON_DECODERS.get(item_type) or _json_array_decoder(item_type)) is None:
+        return None
+
+    # arrays come out of a record as lists whatever the field is typed as
+    def _decode(value: list[Any]) -> list[Any]:
+        return [decode_item(item) if item is not None else None for item in value]
+
+    return _decode
+
+
+def get_field_json_decoder(field: PormField) -> Callable[[Any], Any] | None:
+    """like `get_field_decoder`, for a value read out of a row turned into json by postgres"""
+    if is_field_pydantic(field):
+        model = get_base_type(field._data_type)
+
+        # json columns are nested as objects, text columns holding json stay strings
+        def _validate(value: Any) -> Any:
+            return model.model_validate_json(value) if isinstance(value, str) else model.model_validate(value)
+
+        return _validate
+
+    if is_field_enum(field):
+        return get_enum_caster(field)
+
+    base_type = get_base_type(field._data_type)
+    return JSON_DECODERS.get(base_type) or _json_array_decoder(base_type)
+
+
 class PormComparator(Comparator):
     empty = " "
     in_ = " IN "
 
 
+# placeholders are immutable, so every `$n` is built once and shared between queries
+@cache
 def _param(index: int) -> Parameter:
     return Parameter(f"${index}")
 
@@ -84,20 +196,42 @@ def with_returning(query: QueryBuilder, returning: str = "*") -> str:
     return f"{query.get_sql()} RETURNING {returning}"
 
 
-def _parameterize(criterion: Criterion, query_args: list[Any], param_index: int = 0) -> tuple[Criterion, list[Any]]:
+def _criterion_value(term: Term) -> Any:
+    # a Bind stays in the arguments as a slot, PreparedQuery fills it in on every call
+    return term if isinstance(term, Bind) else cast(ValueWrapper, term).value
+
+
+def _criterion_values(term: Term) -> list[Any]:
+    if isinstance(term, Tuple):
+        return [_criterion_value(value) for value in term.values]
+
+    return [_criterion_value(term)]
+
+
+def _is_parameterizable(term: Term) -> bool:
+    # row values like `Tuple(a, b) > Tuple(1, 2)` are bound one placeholder per value
+    if isinstance(term, Tuple):
+        return all(isinstance(value, (ValueWrapper, Bind)) for value in term.values)
+
+    return isinstance(term, (ValueWrapper, Bind))
+
+
+# placeholders are numbered from the arguments collected so far, so `query_args` may already hold values
+def _parameterize(criterion: Criterion, query_args: list[Any]) -> tuple[Criterion, list[Any]]:
     if isinstance(criterion, ComplexCriterion):
-        left, query_args = _parameterize(cast(Criterion, criterion.left), query_args, param_index)
-        right, query_args = _parameterize(cast(Criterion, criterion.right), query_args, param_index + len(query_args))
+        left, query_args = _parameterize(cast(Criterion, criterion.left), query_args)
+        right, query_args = _parameterize(cast(Criterion, criterion.right), query_args)
         return ComplexCriterion(criterion.comparator, left, right, criterion.alias), query_args
 
-    elif isinstance(criterion, BasicCriterion):
-        query_args.append(cast(ValueWrapper, criterion.right).value)
-        param_index += 1
+    elif isinstance(criterion, BasicCriterion) and _is_parameterizable(criterion.right):
+        criterion_args = _criterion_values(criterion.right)
+        params = [_param(len(query_args) + i + 1) for i in range(len(criterion_args))]
+        query_args += criterion_args
         return (
             BasicCriterion(
                 criterion.comparator,
                 criterion.left,
-                _param(param_index),
+                Tuple(*params) if isinstance(criterion.right, Tuple) else params[0],
                 criterion.alias,
             ),
             query_args,
@@ -105,11 +239,8 @@ def _parameterize(criterion: Criterion, query_args: list[Any], param_index: int
 
     elif isinstance(criterion, ContainsCriterion):
         criterion_args = [i.value if not isinstance(i, NullValue) else None for i in criterion.container.values]
+        params = [f"${len(query_args) + i + 1}" for i in range(len(criterion_args))]
         query_args += criterion_args
-        params = []
-        for _ in range(len(criterion_args)):
-            param_index += 1
-            params.append(f"${param_index}")
         return (
             BasicCriterion(
                 PormComparator.in_,
@@ -121,11 +252,9 @@ def _parameterize(criterion: Criterion, query_args: list[Any], param_index: int
         )
 
     elif isinstance(criterion, RangeCriterion):
-        query_args += [criterion.start.value, criterion.end.value]
-        param_index += 1
-        start_param = _param(param_index)
-        param_index += 1
-        end_param = _param(param_index)
+        query_args += [_criterion_value(criterion.start), _criterion_value(criterion.end)]
+        start_param = _param(len(query_args) - 1)
+        end_param = _param(len(query_args))
         # There are several RangeCriterion, create a new one with the same subclass
         return criterion.__class__(criterion.term, start_param, end_param, criterion.alias), query_args
 
@@ -137,3 +266,69 @@ def parameterize[T](criterion: Criterion, query_args: list[T] | None = None) ->
         query_args = []
 
     return _parameterize(criterion, query_args)
+
+
+def parameterize_term(term: Term, query_args: list[Any]) -> Term:
+    """
+    like `parameterize`, for an expression computed by the database such as `Field("visits") + 1`, which
+    renders as `"visits"+$1`. function arguments are rendered as they are, a bare `$n` passed to a function that
+    takes any type can't be typed by postgres
+    """
+    if isinstance(term, ValueWrapper):
+        query_args.append(term.value)
+        return _param(len(query_args))
+
+    if isinstance(term, ArithmeticExpression):
+        return ArithmeticExpression(
+            term.operator,
+            parameterize_term(term.left, query_args),
+            parameterize_term(term.right, query_args),
+            alias=term.alias,
+        )
+
+    if isinstance(term, Criterion):
+        return parameterize(term, query_args)[0]
+
+    return term
+
+
+def _term_shape(term: Term) -> Hashable:
+    if type(term) is Field:
+        return (term.name, term.table.get_table_name() if term.table else None, term.alias)
+
+    if type(term) is Tuple:
+        return tuple(_term_shape(value) for value in term.values)
+
+    return term.get_sql(quote_char='"')
+
+
+def criterion_shape(criterion: Criterion, query_args: list[Any]) -> Hashable:
+    """
+    the structure of `criterion` with its values left out, which is all the sql `parameterize` renders depends on.
+    the values are appended to `query_args` in the same order `parameterize` numbers its placeholders
+    """
+    if isinstance(criterion, ComplexCriterion):
+        return (
+            ComplexCriterion,
+            criterion.comparator,
+            criterion.alias,
+            criterion_shape(cast(Criterion, criterion.left), query_args),
+            criterion_shape(cast(Criterion, criterion.right), query_args),
+        )
+
+    elif isinstance(criterion, BasicCriterion) and _is_parameterizable(criterion.right):
+        values = _criterion_values(criterion.right)
+        query_args += values
+        return (BasicCriterion, criterion.comparator, criterion.alias, _term_shape(criterion.left), len(values))
+
+    elif isinstance(criterion, ContainsCriterion):
+        values = criterion.container.values
+        query_args += [i.value if not isinstance(i, NullValue) else None for i in values]
+        return (ContainsCriterion, criterion.alias, _term_shape(criterion.term), len(values))
+
+    elif isinstance(criterion, RangeCriterion):
+        query_args += [_criterion_value(criterion.start), _criterion_value(criterion.end)]
+        return (criterion.__class__, criterion.alias, _term_shape(criterion.term))
+
+    # anything else is rendered as is by `parameterize`, values included
+    return criterion.get_sql(quote_char='"')
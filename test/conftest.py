@@ -0,0 +1,2 @@
+# there's no sqlite driver since the driver rewrite, its tests still use the old table api
+collect_ignore = ["sqlite"]
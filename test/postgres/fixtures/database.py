@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, AsyncIterator
+
+import pytest
+
+from p3orm import Column, ForeignKeyRelationship, Postgres, ReverseRelationship, Table
+
+if TYPE_CHECKING:
+    from psycopg import Connection
+
+from test.postgres.fixtures.helpers import _get_connection_kwargs, create_base
+
+
+class Company(Table):
+    __tablename__ = "company"
+
+    id: int = Column(pk=True, db_gen=True)
+    name: str = Column()
+    created_at: datetime = Column(db_gen=True)
+    some_property: str | None = Column(column_name="column_name")
+
+    employees: list[Employee] = ReverseRelationship(self_column="id", foreign_column="company_id")
+
+
+class Employee(Table):
+    __tablename__ = "employee"
+
+    id: int = Column(pk=True, db_gen=True)
+    name: str = Column()
+    company_id: int | None = Column()
+    created_at: datetime = Column(db_gen=True)
+
+    company: Company = ForeignKeyRelationship(self_column="company_id", foreign_column="id")
+
+
+class OrgChart(Table):
+    __tablename__ = "org_chart"
+
+    id: int = Column(pk=True, db_gen=True)
+    manager_id: int = Column()
+    report_id: int = Column()
+
+    manager: Employee = ForeignKeyRelationship(self_column="manager_id", foreign_column="id")
+    report: Employee = ForeignKeyRelationship(self_column="report_id", foreign_column="id")
+
+
+@pytest.fixture(scope="function")
+def dsn(postgresql: Connection) -> dict[str, Any]:
+    """connection arguments of a database holding the base tables and data"""
+    create_base(postgresql)
+
+    return _get_connection_kwargs(postgresql)
+
+
+@pytest.fixture(scope="function")
+async def db(dsn: dict[str, Any]) -> AsyncIterator[Postgres]:
+    """a driver of the base tables connected to `dsn`"""
+    driver = Postgres(tables=[Company, Employee, OrgChart])
+    await driver.connect(**dsn)
+
+    yield driver
+
+    if driver.is_connected():
+        await driver.disconnect()
@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+from enum import Enum
+
+from pydantic import BaseModel
+from pypika import Field
+
+from p3orm import Column, ForeignKeyRelationship, Postgres, Table
+
+
+class Widget(Table):
+    __tablename__ = "widget"
+
+    id: int = Column(pk=True, db_gen=True)
+    name: str = Column()
+    color: str | None = Column()
+
+
+class Part(Table):
+    __tablename__ = "part"
+
+    id: int = Column(pk=True, db_gen=True)
+    widget_id: int | None = Column()
+    red_widget: Widget | None = ForeignKeyRelationship(
+        self_column="widget_id", foreign_column="id", criterion=Field("color") == "red"
+    )
+
+
+class Kind(str, Enum):
+    one = "one"
+    two = "two"
+
+
+class Settings(BaseModel):
+    retries: int
+
+
+class Thing(Table):
+    __tablename__ = "thing"
+
+    id: int = Column(pk=True, db_gen=True)
+    kind: Kind = Column()
+    settings: Settings | None = Column()
+    label: str | None = Column(column_name="label_column")
+
+
+# never connected, the tables above only have their queries compiled and their rows decoded
+models = Postgres(tables=[Widget, Part, Thing])
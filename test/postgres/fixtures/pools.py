@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Type
+
+from p3orm import HedgeConfig, Postgres, Table
+from p3orm.hedge import LatencyWindow
+
+
+class FakeConnection:
+    def __init__(self, pool: FakePool) -> None:
+        self.pool = pool
+
+    async def fetch(self, query: str, *args: Any) -> list[dict[str, Any]]:
+        pool = self.pool
+        pool.queries.append(query)
+
+        try:
+            await asyncio.sleep(pool.delay)
+        except asyncio.CancelledError:
+            pool.cancelled += 1
+            raise
+
+        if pool.error is not None:
+            raise pool.error
+
+        return pool.rows
+
+    async def fetchval(self, query: str, *args: Any) -> Any:
+        # pg_current_wal_lsn() on a primary, pg_last_wal_replay_lsn() on a replica
+        self.pool.queries.append(query)
+        return self.pool.lsn
+
+    def is_in_transaction(self) -> bool:
+        return False
+
+
+class FakePool:
+    """
+    stands in for an asyncpg pool: records the queries run on its connections and answers them with `rows` after
+    `delay` seconds, or with `error`
+    """
+
+    def __init__(
+        self,
+        rows: list[dict[str, Any]] | None = None,
+        *,
+        delay: float = 0.0,
+        error: Exception | None = None,
+        lsn: str | None = None,
+    ) -> None:
+        self.rows = rows or []
+        self.delay = delay
+        self.error = error
+        self.lsn = lsn
+        self.queries: list[str] = []
+        self.cancelled = 0
+        self.in_use = 0
+        self._closed = False
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[FakeConnection]:
+        self.in_use += 1
+
+        try:
+            yield FakeConnection(self)
+        finally:
+            self.in_use -= 1
+
+    def get_size(self) -> int:
+        return 10
+
+    def get_idle_size(self) -> int:
+        return 10 - self.in_use
+
+    async def close(self) -> None:
+        self._closed = True
+
+
+def replicated(
+    tables: list[Type[Table]], primary: FakePool, *replicas: FakePool, hedge: HedgeConfig | None = None
+) -> Postgres:
+    """a driver reading from fake `replicas` as if `connect_pool` had made them"""
+    db = Postgres(tables=tables)
+    db.pool = primary  # type: ignore
+    db.replicas = replicas  # type: ignore
+    db._replayed = {}
+    db._hedge = LatencyWindow(hedge) if hedge else None
+    db._losers = set()
+
+    return db
@@ -1,23 +1,51 @@
 from __future__ import annotations
 
+import asyncio
+import json
 from typing import TYPE_CHECKING
 
+import asyncpg
 import pytest
 from asyncpg import Connection, Pool
 
-from p3orm.core import postgres
-from p3orm.exceptions import AlreadyConnected, NotConnected
+from p3orm import CacheConfig, Column, Postgres, Table, f
+from p3orm.drivers.postgres import (
+    INVALIDATION_CHANNEL,
+    MAX_NOTIFY_PAYLOAD,
+    _invalidation_payloads,
+    _parse_lsn,
+    _pk_from_json,
+)
+from p3orm.exceptions import P3ormException
 
-from test.fixtures.tables import Company
+from test.postgres.fixtures.database import Company, dsn
 from test.postgres.fixtures.helpers import _get_connection_kwargs, create_base
+from test.postgres.fixtures.models import Widget
+from test.postgres.fixtures.pools import FakePool, replicated
 
 if TYPE_CHECKING:
-    from psycopg2 import connection
+    import psycopg
+
+
+class Gauge(Table):
+    __tablename__ = "gauge"
+    __cache__ = CacheConfig()
+
+    id: int = Column(pk=True)
+    reading: int = Column()
+
+
+class CachedCompany(Table):
+    __tablename__ = "company"
+    __cache__ = CacheConfig()
+
+    id: int = Column(pk=True, db_gen=True)
+    name: str = Column()
 
 
 @pytest.mark.asyncio
-async def test_connection(postgresql: connection):
-    db = postgres()
+async def test_connection(postgresql: psycopg.Connection):
+    db = Postgres(tables=[Company])
     await db.connect(**_get_connection_kwargs(postgresql))
 
     assert db.is_connected() == True
@@ -33,8 +61,8 @@ async def test_connection(postgresql: connection):
 
 
 @pytest.mark.asyncio
-async def test_pool(postgresql: connection):
-    db = postgres()
+async def test_pool(postgresql: psycopg.Connection):
+    db = Postgres(tables=[Company])
     await db.connect_pool(**_get_connection_kwargs(postgresql))
 
     assert db.is_connected() == True
@@ -49,26 +77,282 @@ async def test_pool(postgresql: connection):
 
 
 @pytest.mark.asyncio
-async def test_cant_connect_with_both(postgresql: connection):
-    db = postgres()
+async def test_cant_connect_with_both(postgresql: psycopg.Connection):
+    db = Postgres(tables=[Company])
     await db.connect(**_get_connection_kwargs(postgresql))
 
-    with pytest.raises(AlreadyConnected):
+    with pytest.raises(P3ormException):
         await db.connect_pool(**_get_connection_kwargs(postgresql))
 
     await db.disconnect()
 
     await db.connect_pool(**_get_connection_kwargs(postgresql))
 
-    with pytest.raises(AlreadyConnected):
+    with pytest.raises(P3ormException):
         await db.connect(**_get_connection_kwargs(postgresql))
 
     await db.disconnect()
 
 
 @pytest.mark.asyncio
-async def test_exception_when_not_connected(postgresql: connection):
+async def test_exception_when_not_connected(postgresql: psycopg.Connection):
     create_base(postgresql)
 
-    with pytest.raises(NotConnected):
-        await Company.fetch_all()
+    db = Postgres(tables=[Company])
+
+    with pytest.raises(P3ormException):
+        await db.fetch_all(Company)
+
+
+@pytest.mark.asyncio
+async def test_statement_cache_reuses_statements_and_evicts_the_least_recent(dsn):
+    db = Postgres(tables=[Company])
+    await db.connect(**dsn, statement_cache_size=2)
+    stats = db.statement_cache.stats
+
+    try:
+        await db.fetch_one(Company, f(Company.id) == 1)
+        await db.fetch_one(Company, f(Company.id) == 2)
+        assert (stats.hits, stats.misses) == (1, 1)
+
+        await db.fetch_all(Company, f(Company.name) == "Company 1")
+        await db.fetch_all(Company, f(Company.some_property) == "yeet")
+        assert stats.evictions == 1
+
+        # the fetch_one statement was the least recently used
+        await db.fetch_one(Company, f(Company.id) == 3)
+        assert (stats.hits, stats.misses, stats.evictions) == (1, 4, 2)
+    finally:
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_statement_cache_prepares_again_after_a_schema_change(dsn):
+    db = Postgres(tables=[Company])
+    await db.connect(**dsn, statement_cache_size=10)
+
+    try:
+        assert len(await db.fetch_all(Company)) == 4
+
+        await db.execute_raw("ALTER TABLE company ADD COLUMN extra int")
+
+        assert len(await db.fetch_all(Company)) == 4
+    finally:
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_statement_cache_prepares_again_after_the_session_is_reset(dsn):
+    db = Postgres(tables=[Company])
+    await db.connect_pool(**dsn, min_size=1, max_size=1, statement_cache_size=10)
+    stats = db.statement_cache.stats
+
+    try:
+        # the statement outlives the connection's release to the pool
+        assert len(await db.fetch_all(Company)) == 4
+        assert len(await db.fetch_all(Company)) == 4
+        assert (stats.hits, stats.misses) == (1, 1)
+
+        # what a pooler or `DISCARD ALL` does to a session handed to another client
+        async with db.acquire() as connection:
+            await connection.execute("DEALLOCATE ALL")
+
+        assert len(await db.fetch_all(Company)) == 4
+    finally:
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_replica_pools_take_the_connection_arguments_their_dsn_leaves_out(monkeypatch):
+    created: list[dict] = []
+
+    async def create_pool(**kwargs):
+        created.append(kwargs)
+        return FakePool()
+
+    monkeypatch.setattr(asyncpg, "create_pool", create_pool)
+
+    db = Postgres(tables=[Gauge])
+    await db.connect_pool(
+        host="primary",
+        port=5432,
+        user="app",
+        password="secret",
+        database="app",
+        min_size=2,
+        replicas=["postgresql://reader@replica-1/app_ro", {"host": "replica-2"}],
+    )
+
+    [primary, from_dsn, from_dict] = created
+    assert from_dsn == primary | {
+        "dsn": "postgresql://reader@replica-1/app_ro",
+        "host": None,
+        "port": None,
+        "user": None,
+        "password": None,
+        "database": None,
+    }
+    assert from_dict == primary | {"host": "replica-2"}
+
+
+@pytest.mark.asyncio
+async def test_reads_go_to_replicas_and_writes_to_the_primary():
+    primary = FakePool()
+    replicas = [FakePool([{"count": 3}]), FakePool([{"count": 3}])]
+    db = replicated([Gauge], primary, *replicas)
+
+    assert await db.count(Gauge) == 3
+    assert await db.count(Gauge) == 3
+    await db.execute_raw("UPDATE gauge SET reading=0")
+
+    assert [len(replica.queries) for replica in replicas] == [1, 1]
+    assert primary.queries == ["UPDATE gauge SET reading=0"]
+
+
+@pytest.mark.asyncio
+async def test_cached_rows_are_read_from_the_primary():
+    primary = FakePool([{"id": 1, "reading": 5}])
+    replica = FakePool([{"id": 1, "reading": 4}])
+    db = replicated([Gauge], primary, replica)
+
+    assert (await db.fetch_one(Gauge, f(Gauge.id) == 1)).reading == 5
+    assert (await db.fetch_one(Gauge, f(Gauge.id) == 1)).reading == 5
+    assert len(primary.queries) == 1
+    assert replica.queries == []
+
+
+@pytest.mark.asyncio
+async def test_read_your_writes_reads_from_the_primary_until_a_replica_catches_up():
+    primary = FakePool([{"count": 1}], lsn="0/200")
+    replica = FakePool([{"count": 0}], lsn="0/100")
+    db = replicated([Gauge], primary, replica)
+
+    with db.read_your_writes() as scope:
+        # nothing written in the scope yet, so the replica is read without checking it
+        assert await db.count(Gauge) == 0
+        assert replica.queries[-1].startswith("SELECT COUNT")
+
+        await db.execute_raw("INSERT INTO gauge VALUES (1, 1)")
+        assert await db.count(Gauge) == 1
+        assert scope.lsn == _parse_lsn("0/200")
+
+        replica.lsn = "0/300"
+        assert await db.count(Gauge) == 0
+
+        with db.read_your_writes() as inner:
+            assert inner is scope
+
+    # outside of the scope the replica serves reads however far behind it is
+    replica.lsn = "0/0"
+    assert await db.count(Gauge) == 0
+
+
+def test_wal_positions_compare_as_integers():
+    assert _parse_lsn("0/16B3748") == 0x16B3748
+    assert _parse_lsn("1/0") > _parse_lsn("0/FFFFFFFF")
+
+
+async def _cache_companies(db: Postgres) -> None:
+    for key in (1, 2, 3):
+        await db.fetch_one(CachedCompany, f(CachedCompany.id) == key)
+
+
+def _cached_companies() -> set[int]:
+    return {key for key in (1, 2, 3) if CachedCompany.__memo__.cache.get(key) is not None}
+
+
+@pytest.mark.asyncio
+async def test_triggers_invalidate_every_row_a_statement_touched(dsn):
+    db = Postgres(tables=[CachedCompany])
+    await db.connect_pool(**dsn, min_size=1, max_size=2)
+    await db.install_invalidation_triggers()
+    await db.listen_invalidations(notify_writes=False)
+    writer = await asyncpg.connect(**dsn)
+    heard: list[str] = []
+    await writer.add_listener(INVALIDATION_CHANNEL, lambda *args: heard.append(args[-1]))
+
+    try:
+        await _cache_companies(db)
+
+        await writer.execute("UPDATE company SET name = 'renamed' WHERE id <= 2")
+        await writer.execute("UPDATE company SET name = 'renamed' WHERE id > 100")
+        await asyncio.sleep(0.1)
+
+        # one notification for the statement, none for the one that touched nothing
+        [[tablename, keys]] = [json.loads(payload) for payload in heard]
+        assert (tablename, sorted(keys)) == ("company", [1, 2])
+        assert _cached_companies() == {3}
+
+        await _cache_companies(db)
+        await writer.execute("DELETE FROM company WHERE id = 3")
+        await asyncio.sleep(0.1)
+
+        assert _cached_companies() == {1, 2}
+    finally:
+        await writer.close()
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_inserts_without_returning_notify_other_processes(dsn):
+    db = Postgres(tables=[CachedCompany])
+    await db.connect_pool(**dsn, min_size=1, max_size=2)
+    await db.listen_invalidations()
+    other = await asyncpg.connect(**dsn)
+    heard: list[str] = []
+    await other.add_listener(INVALIDATION_CHANNEL, lambda *args: heard.append(args[-1]))
+
+    try:
+        await _cache_companies(db)
+
+        await db.insert_one(CachedCompany, CachedCompany(id=10, name="Company 10"), returning=False)
+        assert _cached_companies() == {1, 2, 3}
+
+        # the generated key isn't read back, so every cached row goes
+        await db.insert_many(CachedCompany, [CachedCompany(name="Company 11")], returning=False)
+        assert _cached_companies() == set()
+
+        await asyncio.sleep(0.1)
+    finally:
+        await other.close()
+        await db.disconnect()
+
+    assert [json.loads(payload) for payload in heard] == [["company", [10]], ["company", None]]
+
+
+@pytest.mark.asyncio
+async def test_a_lost_listener_clears_the_caches_and_listens_again(dsn):
+    db = Postgres(tables=[CachedCompany])
+    await db.connect_pool(**dsn, min_size=1, max_size=2)
+    await db.install_invalidation_triggers()
+    await db.listen_invalidations(notify_writes=False)
+    writer = await asyncpg.connect(**dsn)
+
+    try:
+        await _cache_companies(db)
+        lost = db._listener
+
+        await writer.execute("SELECT pg_terminate_backend($1)", lost.get_server_pid())
+        await asyncio.sleep(0.5)
+
+        # notifications sent while the listener was down can't have been heard
+        assert _cached_companies() == set()
+        assert db._listener is not None and db._listener is not lost
+
+        await _cache_companies(db)
+        await writer.execute("UPDATE company SET name = 'renamed' WHERE id = 1")
+        await asyncio.sleep(0.1)
+
+        assert _cached_companies() == {2, 3}
+    finally:
+        await writer.close()
+        await db.disconnect()
+
+
+def test_invalidation_payloads_are_chunked_under_the_notify_limit():
+    payloads = _invalidation_payloads(Widget, list(range(5000)))
+
+    assert len(payloads) > 1
+    assert all(len(payload.encode()) < MAX_NOTIFY_PAYLOAD for payload in payloads)
+    assert [_pk_from_json(Widget, key) for payload in payloads for key in json.loads(payload)[1]] == list(range(5000))
+    assert _invalidation_payloads(Widget, ["x" * MAX_NOTIFY_PAYLOAD]) == ['["widget", null]']
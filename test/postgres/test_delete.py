@@ -2,17 +2,86 @@ from __future__ import annotations
 
 import pytest
 
-from test.fixtures.tables import Company
-from test.postgres.fixtures.helpers import create_base_and_connect
+from p3orm import f
+
+from test.postgres.fixtures.database import Company, db, dsn
 
 
 @pytest.mark.asyncio
-async def test_delete_one(create_base_and_connect):
-    fetched = await Company.delete_where(Company.id == 2)
+async def test_delete_one(db):
+    fetched = await db.delete_where(Company, f(Company.id) == 2, returning=True)
 
     assert len(fetched) == 1
     assert fetched[0].id == 2
 
-    refetched = await Company.fetch_first(Company.id == 2)
+    refetched = await db.fetch_first(Company, f(Company.id) == 2)
 
     assert refetched == None
+
+
+@pytest.mark.asyncio
+async def test_delete_where_counts_deleted_rows(db):
+    assert await db.delete_where(Company, f(Company.id) > 2) == 2
+    assert [company.id for company in await db.fetch_all(Company, by=f(Company.id))] == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_delete_returns_the_deleted_rows(db):
+    companies = await db.fetch_all(Company, f(Company.id).isin([2, 3]), by=f(Company.id))
+    companies[0].name = "Renamed"
+
+    deleted = await db.delete(Company, companies)
+
+    # the rows as they were in the database, not the items passed in
+    assert [company.name for company in deleted] == ["Company 2", "Company 3"]
+    assert all(company is not item for company, item in zip(deleted, companies))
+    assert companies[0].name == "Renamed"
+    assert await db.count(Company) == 2
+
+
+@pytest.mark.asyncio
+async def test_delete_minimal_returns_the_items_whose_rows_were_deleted(db):
+    companies = await db.fetch_all(Company, f(Company.id).isin([2, 3]), by=f(Company.id))
+    await db.delete_where(Company, f(Company.id) == 3)
+
+    deleted = await db.delete(Company, companies, returning="minimal")
+
+    assert len(deleted) == 1
+    assert deleted[0] is companies[0]
+    assert await db.count(Company) == 2
+
+
+@pytest.mark.asyncio
+async def test_delete_without_returning_counts_deleted_rows(db):
+    companies = await db.fetch_all(Company, f(Company.id).isin([2, 3]), by=f(Company.id))
+    await db.delete_where(Company, f(Company.id) == 3)
+
+    assert await db.delete(Company, companies, returning=False) == 1
+    assert [company.name for company in companies] == ["Company 2", "Company 3"]
+    assert await db.count(Company) == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("returning", [True, "minimal", False])
+async def test_delete_drops_rows_from_the_identity_map(db, returning):
+    async with db.transaction(identity_map=True) as tx:
+        companies = await tx.fetch_all(Company, f(Company.id).isin([2, 3]), by=f(Company.id))
+
+        await tx.delete(Company, companies[:1], returning=returning)
+
+        assert list(tx.identity_map) == [(Company, 3)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("returning", [True, False])
+async def test_delete_where_drops_rows_from_the_identity_map(db, returning):
+    async with db.transaction(identity_map=True) as tx:
+        await tx.fetch_all(Company, f(Company.id).isin([2, 3]))
+
+        deleted = await tx.delete_where(Company, f(Company.id) == 2, returning=returning)
+
+        if returning:
+            assert [company.id for company in deleted] == [2]
+        else:
+            assert deleted == 1
+        assert list(tx.identity_map) == [(Company, 3)]
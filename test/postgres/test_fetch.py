@@ -1,19 +1,36 @@
 from __future__ import annotations
 
+import asyncio
+from contextlib import aclosing
 from datetime import datetime
+from decimal import Decimal
+from typing import Any
+from uuid import uuid4
 
 import pytest
+from asyncpg.cursor import Cursor
+from pypika import Criterion, Order
 
-from p3orm import Order
-from p3orm.exceptions import MultipleResultsReturned, NoResultsReturned
+from p3orm import Column, Postgres, Table, f
+from p3orm.drivers.postgres import _batched_rows, _shift_params, _turn_records_into_orm_instances
+from p3orm.exceptions import P3ormException, UnloadedColumnException
+from p3orm.query import compile_select, decode_cursor, encode_cursor, json_row, projection
+from p3orm.table import UNLOADED_COLUMN
 
-from test.fixtures.tables import Company, Employee
-from test.postgres.fixtures.helpers import create_base_and_connect
+from test.postgres.fixtures.database import Company, Employee, db, dsn
+from test.postgres.fixtures.models import Thing, Widget
+from test.postgres.fixtures.pools import FakePool, replicated
+
+
+class Reading(Table):
+    __tablename__ = "reading"
+
+    id: int = Column(pk=True)
 
 
 @pytest.mark.asyncio
-async def test_fetch_all(create_base_and_connect):
-    companies = await Company.fetch_all()
+async def test_fetch_all(db):
+    companies = await db.fetch_all(Company)
 
     assert len(companies) == 4
     assert [c.id for c in companies] == [1, 2, 3, 4]
@@ -22,16 +39,16 @@ async def test_fetch_all(create_base_and_connect):
 
 
 @pytest.mark.asyncio
-async def test_fetch_complex_criterion(create_base_and_connect):
-    companies = await Company.fetch_all((Company.id == 1) | (Company.id == 2))
+async def test_fetch_complex_criterion(db):
+    companies = await db.fetch_all(Company, (f(Company.id) == 1) | (f(Company.id) == 2))
 
     assert len(companies) == 2
     assert {c.id for c in companies} == {1, 2}
 
 
 @pytest.mark.asyncio
-async def test_fetch_all_filtering(create_base_and_connect):
-    companies = await Company.fetch_all(Company.id < 3)
+async def test_fetch_all_filtering(db):
+    companies = await db.fetch_all(Company, f(Company.id) < 3)
 
     assert len(companies) == 2
     assert [c.id for c in companies] == [1, 2]
@@ -40,8 +57,8 @@ async def test_fetch_all_filtering(create_base_and_connect):
 
 
 @pytest.mark.asyncio
-async def test_fetch_first_of_many(create_base_and_connect):
-    company = await Company.fetch_first(Company.id < 3)
+async def test_fetch_first_of_many(db):
+    company = await db.fetch_first(Company, f(Company.id) < 3)
 
     assert company.id == 1
     assert company.name == "Company 1"
@@ -49,8 +66,8 @@ async def test_fetch_first_of_many(create_base_and_connect):
 
 
 @pytest.mark.asyncio
-async def test_fetch_first_of_one(create_base_and_connect):
-    company = await Company.fetch_first(Company.id == 1)
+async def test_fetch_first_of_one(db):
+    company = await db.fetch_first(Company, f(Company.id) == 1)
 
     assert company.id == 1
     assert company.name == "Company 1"
@@ -58,59 +75,59 @@ async def test_fetch_first_of_one(create_base_and_connect):
 
 
 @pytest.mark.asyncio
-async def test_fetch_one(create_base_and_connect):
-    assert await Company.fetch_one(Company.id == 1) == await Company.fetch_first(Company.id == 1)
+async def test_fetch_one(db):
+    assert await db.fetch_one(Company, f(Company.id) == 1) == await db.fetch_first(Company, f(Company.id) == 1)
 
 
 @pytest.mark.asyncio
-async def test_fetch_one_fails_with_multiple(create_base_and_connect):
-    with pytest.raises(MultipleResultsReturned):
-        await Company.fetch_one(Company.id != 1)
+async def test_fetch_one_fails_with_multiple(db):
+    with pytest.raises(P3ormException):
+        await db.fetch_one(Company, f(Company.id) != 1)
 
 
 @pytest.mark.asyncio
-async def test_fetch_one_fails_with_none(create_base_and_connect):
-    with pytest.raises(NoResultsReturned):
-        await Company.fetch_one(Company.id == 100)
+async def test_fetch_one_fails_with_none(db):
+    with pytest.raises(P3ormException):
+        await db.fetch_one(Company, f(Company.id) == 100)
 
 
 @pytest.mark.asyncio
-async def test_fetch_first_returns_none(create_base_and_connect):
-    result = await Company.fetch_first(Company.id == 100)
+async def test_fetch_first_returns_none(db):
+    result = await db.fetch_first(Company, f(Company.id) == 100)
 
     assert result == None
 
 
 @pytest.mark.asyncio
-async def test_fetch_all_returns_empty(create_base_and_connect):
-    results = await Company.fetch_all(Company.id == 100)
+async def test_fetch_all_returns_empty(db):
+    results = await db.fetch_all(Company, f(Company.id) == 100)
 
     assert results == []
 
 
 @pytest.mark.asyncio
-async def test_fetch_one_prefetch(create_base_and_connect):
-    company_with_employees = await Company.fetch_one(Company.id == 1, prefetch=[[Company.employees]])
+async def test_fetch_one_prefetch(db):
+    company_with_employees = await db.fetch_one(Company, f(Company.id) == 1, prefetch=[[Company.employees]])
 
-    employees = await Employee.fetch_all(Employee.company_id == company_with_employees.id)
+    employees = await db.fetch_all(Employee, f(Employee.company_id) == company_with_employees.id)
 
     assert sorted(company_with_employees.employees, key=lambda e: e.id) == sorted(employees, key=lambda e: e.id)
 
 
 @pytest.mark.asyncio
-async def test_fetch_first_prefetch(create_base_and_connect):
-    company_with_employees = await Company.fetch_first(Company.id == 1, prefetch=[[Company.employees]])
+async def test_fetch_first_prefetch(db):
+    company_with_employees = await db.fetch_first(Company, f(Company.id) == 1, prefetch=[[Company.employees]])
 
-    employees = await Employee.fetch_all(Employee.company_id == company_with_employees.id)
+    employees = await db.fetch_all(Employee, f(Employee.company_id) == company_with_employees.id)
 
     assert sorted(company_with_employees.employees, key=lambda e: e.id) == sorted(employees, key=lambda e: e.id)
 
 
 @pytest.mark.asyncio
-async def test_fetch_all_prefetch(create_base_and_connect):
-    companies_with_employees = await Company.fetch_all(prefetch=[[Company.employees]])
+async def test_fetch_all_prefetch(db):
+    companies_with_employees = await db.fetch_all(Company, prefetch=[[Company.employees]])
 
-    first_company_employees = await Employee.fetch_all(Employee.company_id == 1)
+    first_company_employees = await db.fetch_all(Employee, f(Employee.company_id) == 1)
 
     first_company = [c for c in companies_with_employees if c.id == 1][0]
 
@@ -124,8 +141,8 @@ async def test_fetch_all_prefetch(create_base_and_connect):
 
 
 @pytest.mark.asyncio
-async def test_order(create_base_and_connect):
-    companies = await Company.fetch_all(Company.id.between(1, 3), order=Company.id, by=Order.desc)
+async def test_order(db):
+    companies = await db.fetch_all(Company, f(Company.id).between(1, 3), by=f(Company.id), order=Order.desc)
 
     assert len(companies) == 3
     assert companies[0].id == 3
@@ -134,7 +151,246 @@ async def test_order(create_base_and_connect):
 
 
 @pytest.mark.asyncio
-async def test_limit(create_base_and_connect):
-    companies = await Company.fetch_all(limit=2)
+async def test_limit(db):
+    companies = await db.fetch_all(Company, limit=2)
 
     assert len(companies) == 2
+
+
+async def _pages(db: Postgres, criterion: Criterion | None = None, **kwargs: Any) -> list[list[int]]:
+    pages = []
+    after = None
+
+    while True:
+        page = await db.fetch_page(Company, criterion, after=after, **kwargs)
+        pages.append([company.id for company in page.items])
+
+        if (after := page.next) is None:
+            return pages
+
+
+@pytest.mark.asyncio
+async def test_fetch_page_walks_every_row_once(db):
+    await db.insert_many(Company, [Company(name=f"Company {i}") for i in range(5, 9)])
+
+    assert await _pages(db, limit=3) == [[1, 2, 3], [4, 5, 6], [7, 8]]
+    assert await _pages(db, f(Company.id) > 2, limit=3) == [[3, 4, 5], [6, 7, 8]]
+
+
+@pytest.mark.asyncio
+async def test_fetch_page_breaks_ties_on_the_primary_key(db):
+    await db.insert_many(Company, [Company(name="Company 2"), Company(name="Company 2")])
+
+    # ordered by (name, id): company 2's three rows span the first two pages
+    assert await _pages(db, by=f(Company.name), limit=2) == [[1, 2], [5, 6], [3, 4]]
+    assert await _pages(db, by=f(Company.name), order=Order.desc, limit=2) == [[4, 3], [6, 5], [2, 1]]
+
+
+@pytest.mark.asyncio
+async def test_fetch_page_refuses_nullable_columns(db):
+    with pytest.raises(P3ormException):
+        await db.fetch_page(Company, by=f(Company.some_property), limit=2)
+
+
+@pytest.mark.asyncio
+async def test_fetch_prefetch_needs_the_relationship_column(db):
+    with pytest.raises(P3ormException, match="company_id"):
+        await db.fetch_all(Employee, defer=[f(Employee.company_id)], prefetch=[[Employee.company]])
+
+
+@pytest.mark.asyncio
+async def test_batch_fetch_all_keeps_the_order(db):
+    async with db.batch() as batch:
+        ascending = batch.fetch_all(Employee, by=f(Employee.id), order=Order.asc)
+        descending = batch.fetch_all(Employee, by=f(Employee.id), order=Order.desc)
+
+    assert [employee.id for employee in ascending.result()] == [1, 2, 3, 4, 5, 6]
+    assert [employee.id for employee in descending.result()] == [6, 5, 4, 3, 2, 1]
+
+
+@pytest.mark.asyncio
+async def test_batch_call_that_fails_to_finish_fails_alone():
+    # each call is a column of the one row the batch selects
+    db = replicated([Reading], FakePool(), FakePool([{"0": 2, "1": "not a count"}]))
+
+    async with db.batch() as batch:
+        counted = batch.count(Reading)
+        failed = batch.count(Reading)
+
+    assert counted.result() == 2
+
+    with pytest.raises(ValueError):
+        failed.result()
+
+
+@pytest.fixture
+def cursor_fetches(monkeypatch) -> list[int]:
+    """the chunk sizes cursors are asked for"""
+    fetches: list[int] = []
+    fetch = Cursor.fetch
+
+    async def spy(self, n, *, timeout=None):
+        fetches.append(n)
+        return await fetch(self, n, timeout=timeout)
+
+    monkeypatch.setattr(Cursor, "fetch", spy)
+
+    return fetches
+
+
+@pytest.mark.asyncio
+async def test_fetch_iter_reads_the_next_chunk_ahead_on_a_pool(dsn, cursor_fetches):
+    driver = Postgres(tables=[Company, Employee])
+    await driver.connect_pool(**dsn, min_size=1, max_size=2)
+
+    try:
+        rows = driver.fetch_iter(Employee, by=f(Employee.id), chunk_size=2)
+
+        async with aclosing(rows):
+            first = await anext(rows)
+            await asyncio.sleep(0)
+
+            # the second chunk is on its way while the first one is consumed
+            assert first.id == 1
+            assert len(cursor_fetches) == 2
+
+            assert [employee.id async for employee in rows] == [2, 3, 4, 5, 6]
+    finally:
+        await driver.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_fetch_iter_reads_chunk_by_chunk_on_a_connection(db, cursor_fetches):
+    rows = db.fetch_iter(Employee, by=f(Employee.id), chunk_size=4)
+
+    async with aclosing(rows):
+        assert (await anext(rows)).id == 1
+        assert len(cursor_fetches) == 1
+
+        assert [employee.id async for employee in rows] == [2, 3, 4, 5, 6]
+
+    assert cursor_fetches == [4, 4, 4]
+
+
+@pytest.mark.asyncio
+async def test_fetch_iter_gives_the_connection_back_when_stopped_early(dsn):
+    driver = Postgres(tables=[Company, Employee])
+    await driver.connect_pool(**dsn, min_size=2, max_size=2)
+
+    try:
+        rows = driver.fetch_iter(Employee, chunk_size=2)
+
+        async with aclosing(rows):
+            async for _ in rows:
+                assert driver.pool.get_idle_size() == 1
+                break
+
+        assert driver.pool.get_idle_size() == 2
+    finally:
+        await driver.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_fetch_iter_closes_its_transaction_when_stopped_early(db):
+    rows = db.fetch_iter(Employee, chunk_size=2)
+
+    async with aclosing(rows):
+        async for _ in rows:
+            assert db.connection.is_in_transaction()
+            break
+
+    assert not db.connection.is_in_transaction()
+    assert await db.count(Employee) == 6
+
+
+@pytest.mark.asyncio
+async def test_fetch_iter_does_not_keep_streamed_rows_in_the_identity_map(db):
+    async with db.transaction(identity_map=True) as tx:
+        employee = await tx.fetch_one(Employee, f(Employee.id) == 1)
+
+        streamed = [item async for item in tx.fetch_iter(Employee, chunk_size=2, prefetch=[[Employee.company]])]
+
+        assert len(streamed) == 6
+        assert any(item is employee for item in streamed)
+        assert employee.company.id == 1
+        assert list(tx.identity_map) == [(Employee, 1)]
+
+
+def test_page_cursor_round_trips_values():
+    values = [1, "name", None, datetime(2024, 1, 2, 3, 4, 5), Decimal("1.50"), uuid4()]
+
+    assert decode_cursor(encode_cursor(values)) == values
+
+    with pytest.raises(P3ormException):
+        decode_cursor("not a token")
+
+
+def test_projection_selects_only_requested_columns_and_pk():
+    Widget.__memo__.queries.clear()
+
+    only_sql, _ = compile_select(Widget, columns=projection(Widget, [Widget.color], None))
+    defer_sql, _ = compile_select(Widget, columns=projection(Widget, None, [f(Widget.color)]))
+
+    assert only_sql == 'SELECT "id","color" FROM "widget"'
+    assert defer_sql == 'SELECT "id","name" FROM "widget"'
+    assert len(Widget.__memo__.queries) == 2
+
+    with pytest.raises(P3ormException):
+        projection(Widget, [Widget.color], [Widget.name])
+
+
+def test_unselected_fields_are_unloaded():
+    widget = Widget.__memo__.record_decoder(["id", "color"])({"id": 1, "color": "red"})
+
+    assert widget.color == "red"
+    assert isinstance(widget.name, UNLOADED_COLUMN)
+
+    with pytest.raises(UnloadedColumnException):
+        widget.name.upper()
+
+
+def test_unloaded_fields_raise_when_tested_or_compared():
+    widget = Widget.__memo__.record_decoder(["id", "color"])({"id": 1, "color": "red"})
+    loaded = Widget.__memo__.record_decoder(["id", "name", "color"])({"id": 1, "name": "gear", "color": "red"})
+
+    with pytest.raises(UnloadedColumnException):
+        bool(widget.name)
+
+    with pytest.raises(UnloadedColumnException):
+        widget.name == "gear"
+
+    with pytest.raises(UnloadedColumnException):
+        widget == loaded
+
+
+def test_batched_queries_are_renumbered_around_string_literals():
+    assert _shift_params('SELECT 1 WHERE "a"=$1 AND "b"=\'$1\' LIMIT $2', 3) == (
+        'SELECT 1 WHERE "a"=$4 AND "b"=\'$1\' LIMIT $5'
+    )
+    assert _shift_params("\"a\"='it''s $1' OR \"a\"=$10", 1) == "\"a\"='it''s $1' OR \"a\"=$11"
+
+
+def test_batched_rows_are_aggregated_into_json():
+    query, query_args = compile_select(Widget, f(Widget.name) == "a", limit=1)
+    row = json_row(Widget, '"_p3orm_batch"')
+
+    assert _batched_rows(Widget, query) == (
+        """(SELECT coalesce(jsonb_agg("row" ORDER BY "ordinality"),'[]') """
+        f'FROM (SELECT {row} "row",row_number() OVER () "ordinality" '
+        f'FROM ({query}) "_p3orm_batch") "_p3orm_rows")'
+    )
+    assert query_args == ["a", 1]
+
+
+def test_identity_map_reuses_and_refreshes_instances():
+    identity_map: dict = {}
+    row = {"id": 1, "kind": "one", "settings": None, "label_column": "a"}
+
+    [first] = _turn_records_into_orm_instances(Thing, [row], identity_map)
+    [second] = _turn_records_into_orm_instances(Thing, [{**row, "label_column": "b"}], identity_map)
+    assert first is second
+    assert first.label == "a"
+
+    [refreshed] = _turn_records_into_orm_instances(Thing, [{**row, "label_column": "b"}], identity_map, refresh=True)
+    assert refreshed is first
+    assert first.label == "b"
@@ -1,48 +1,103 @@
 from __future__ import annotations
 
+import asyncio
+import json
+from decimal import Decimal
+from typing import Any
+from uuid import UUID
+
+import asyncpg
 import pytest
+from pypika import Field
+
+from p3orm import Column, ForeignKeyRelationship, Postgres, PrefetchStrategy, ReverseOneToOneRelationship, Table, f
+from p3orm.drivers.postgres import _related_query
+from p3orm.query import compile_select, json_row, prefetch_plan, prefetch_tree
+
+from test.postgres.fixtures.database import Company, Employee, OrgChart, db, dsn
+from test.postgres.fixtures.models import Part, Widget
+
+
+class Profile(Table):
+    __tablename__ = "profile"
+
+    id: int = Column(pk=True, db_gen=True)
+    company_id: int = Column()
+    settings: dict[str, Any] = Column()
+    tags: Any = Column()
+    members: list[UUID] | None = Column()
+    scores: list[Decimal] | None = Column()
+
+
+class FailingEmployee(Table):
+    __tablename__ = "employee"
+
+    id: int = Column(pk=True, db_gen=True)
+    company_id: int | None = Column()
 
-from test.fixtures.tables import Company, Employee, OrgChart
-from test.postgres.fixtures.helpers import create_base_and_connect
+    # loading it fails on the server
+    company: Company = ForeignKeyRelationship(
+        self_column="company_id", foreign_column="id", criterion=Field("id") / 0 == 1
+    )
+
+
+class FailingChart(Table):
+    __tablename__ = "org_chart"
+
+    id: int = Column(pk=True, db_gen=True)
+    manager_id: int = Column()
+    report_id: int = Column()
+
+    manager: FailingEmployee = ForeignKeyRelationship(self_column="manager_id", foreign_column="id")
+    report: FailingEmployee = ForeignKeyRelationship(self_column="report_id", foreign_column="id")
+
+
+class ProfiledCompany(Table):
+    __tablename__ = "company"
+
+    id: int = Column(pk=True, db_gen=True)
+    name: str = Column()
+
+    profile: Profile | None = ReverseOneToOneRelationship(self_column="id", foreign_column="company_id")
 
 
 @pytest.mark.asyncio
-async def test_fetch_related_foreign_key(create_base_and_connect):
-    employee = await Employee.fetch_one(Employee.id == 1)
-    [employee_with_company] = await Employee.fetch_related([employee], [[Employee.company]])
+async def test_fetch_related_foreign_key(db):
+    employee = await db.fetch_one(Employee, f(Employee.id) == 1)
+    [employee_with_company] = await db.fetch_related(Employee, [employee], [[Employee.company]])
 
-    company = await Company.fetch_one(Company.id == employee_with_company.company_id)
+    company = await db.fetch_one(Company, f(Company.id) == employee_with_company.company_id)
 
     assert employee_with_company.company == company
 
 
 @pytest.mark.asyncio
-async def test_fetch_related_reverse_relation(create_base_and_connect):
-    company = await Company.fetch_one(Company.id == 1)
-    [company_with_employees] = await Company.fetch_related([company], [[Company.employees]])
+async def test_fetch_related_reverse_relation(db):
+    company = await db.fetch_one(Company, f(Company.id) == 1)
+    [company_with_employees] = await db.fetch_related(Company, [company], [[Company.employees]])
 
-    employees = await Employee.fetch_all(Employee.company_id == company.id)
+    employees = await db.fetch_all(Employee, f(Employee.company_id) == company.id)
 
     assert sorted(company_with_employees.employees, key=lambda e: e.id) == sorted(employees, key=lambda e: e.id)
 
 
 @pytest.mark.asyncio
-async def test_fetch_related_clears_unloaded_relationships(create_base_and_connect):
-    company = await Company.fetch_one(Company.id == 2)
-    [company_without_employees] = await Company.fetch_related([company], [[Company.employees]])
+async def test_fetch_related_clears_unloaded_relationships(db):
+    company = await db.fetch_one(Company, f(Company.id) == 2)
+    [company_without_employees] = await db.fetch_related(Company, [company], [[Company.employees]])
 
     assert company_without_employees.employees == []
 
-    employee = await Employee.fetch_one(Employee.id == 6)
-    [employee_without_company] = await Employee.fetch_related([employee], [[Employee.company]])
+    employee = await db.fetch_one(Employee, f(Employee.id) == 6)
+    [employee_without_company] = await db.fetch_related(Employee, [employee], [[Employee.company]])
 
     assert employee_without_company.company == None
 
 
 @pytest.mark.asyncio
-async def test_fetch_nested_relationship(create_base_and_connect):
-    company = await Company.fetch_one(Company.id == 1)
-    [company] = await Company.fetch_related([company], [[Company.employees, Employee.company]])
+async def test_fetch_nested_relationship(db):
+    company = await db.fetch_one(Company, f(Company.id) == 1)
+    [company] = await db.fetch_related(Company, [company], [[Company.employees, Employee.company]])
 
     assert len(company.employees) == 5
 
@@ -51,12 +106,198 @@ async def test_fetch_nested_relationship(create_base_and_connect):
 
 
 @pytest.mark.asyncio
-async def test_fetch_multiple_relationships(create_base_and_connect):
-    org_rel = await OrgChart.fetch_one(OrgChart.id == 1)
+async def test_fetch_multiple_relationships(db):
+    org_rel = await db.fetch_one(OrgChart, f(OrgChart.id) == 1)
 
-    [org_rel] = await OrgChart.fetch_related([org_rel], [[OrgChart.report], [OrgChart.manager]])
-    employee_1 = await Employee.fetch_one(Employee.id == 1)
-    employee_2 = await Employee.fetch_one(Employee.id == 2)
+    [org_rel] = await db.fetch_related(OrgChart, [org_rel], [[OrgChart.report], [OrgChart.manager]])
+    employee_1 = await db.fetch_one(Employee, f(Employee.id) == 1)
+    employee_2 = await db.fetch_one(Employee, f(Employee.id) == 2)
 
     assert org_rel.manager == employee_1
     assert org_rel.report == employee_2
+
+
+@pytest.mark.asyncio
+async def test_fetch_related_reloads_loaded_relationships(db):
+    company = await db.fetch_one(Company, f(Company.id) == 1, prefetch=[[Company.employees]])
+    await db.insert_one(Employee, Employee(name="Person 7", company_id=1))
+
+    await db.fetch_related(Company, [company], [[Company.employees]])
+
+    assert len(company.employees) == 6
+
+
+@pytest.mark.asyncio
+async def test_fetch_related_reloads_loaded_relationships_with_identity_map(db):
+    async with db.transaction(identity_map=True) as tx:
+        company = await tx.fetch_one(Company, f(Company.id) == 1, prefetch=[[Company.employees]])
+        await tx.insert_one(Employee, Employee(name="Person 7", company_id=1))
+
+        await tx.fetch_related(Company, [company], [[Company.employees]])
+
+        assert "Person 7" in [employee.name for employee in company.employees]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("strategy", [PrefetchStrategy.select, PrefetchStrategy.join])
+async def test_prefetch_reloads_rows_the_identity_map_holds_from_a_projected_select(db, strategy):
+    async with db.transaction(identity_map=True) as tx:
+        [company] = await tx.fetch_all(Company, f(Company.id) == 1, only=[f(Company.id)])
+
+        employee = await tx.fetch_one(
+            Employee, f(Employee.id) == 1, prefetch=[[Employee.company]], prefetch_strategy=strategy
+        )
+
+        assert employee.company is company
+        assert company.name == "Company 1"
+
+
+@pytest.mark.asyncio
+async def test_fetch_related_loads_items_shared_by_paths(dsn):
+    driver = Postgres(tables=[Company, Employee, OrgChart])
+    await driver.connect_pool(**dsn)
+
+    try:
+        # employee 3 reports to 1 and manages 4 and 5, both paths load its company
+        charts = await driver.fetch_all(
+            OrgChart,
+            prefetch=[
+                [OrgChart.manager, Employee.company],
+                [OrgChart.report, Employee.company],
+            ],
+        )
+    finally:
+        await driver.disconnect()
+
+    assert all(chart.manager.company.id == 1 and chart.report.company.id == 1 for chart in charts)
+    [shared] = {id(chart.manager) for chart in charts} & {id(chart.report) for chart in charts}
+
+
+@pytest.mark.asyncio
+async def test_prefetch_strategies_load_the_same_rows(dsn):
+    driver = Postgres(tables=[ProfiledCompany, Profile])
+    await driver.connect(**dsn)
+
+    try:
+        await driver.execute_raw(
+            "CREATE TABLE profile (id SERIAL PRIMARY KEY, company_id int NOT NULL, settings jsonb, tags json, "
+            "members uuid[], scores numeric[])"
+        )
+        # two profiles for company 1, the one with the lowest key is loaded
+        await driver.execute_raw(
+            """INSERT INTO profile (company_id, settings, tags, members, scores) VALUES """
+            """(1, '{"theme": "dark"}', '["a", "b"]', '{6e5c4b0e-6f2e-4bd4-9a3c-1f0f6a2b7c11,NULL}', '{0.1,2.50}'), """
+            """(1, '{"theme": "light"}', '[]', '{}', '{}'), (2, '{}', 'null', NULL, NULL)"""
+        )
+
+        by_strategy = [
+            await driver.fetch_all(
+                ProfiledCompany,
+                by=f(ProfiledCompany.id),
+                prefetch=[[ProfiledCompany.profile]],
+                prefetch_strategy=strategy,
+            )
+            for strategy in (PrefetchStrategy.select, PrefetchStrategy.join)
+        ]
+    finally:
+        await driver.disconnect()
+
+    selected, joined = [[(company.id, company.profile) for company in companies] for companies in by_strategy]
+
+    assert selected == joined
+    assert selected[0][1].settings == '{"theme": "dark"}'
+    assert selected[0][1].tags == '["a", "b"]'
+    assert joined[0][1].members == [UUID("6e5c4b0e-6f2e-4bd4-9a3c-1f0f6a2b7c11"), None]
+    assert joined[0][1].scores == [Decimal("0.1"), Decimal("2.50")]
+
+
+@pytest.mark.asyncio
+async def test_join_prefetch_takes_rows_a_jsonb_codec_already_decoded(dsn):
+    async def init(connection: asyncpg.Connection) -> None:
+        await connection.set_type_codec("jsonb", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+
+    driver = Postgres(tables=[Company, Employee])
+    await driver.connect(**dsn, init=init)
+
+    try:
+        by_strategy = [
+            await driver.fetch_all(
+                Company, by=f(Company.id), prefetch=[[Company.employees]], prefetch_strategy=strategy
+            )
+            for strategy in (PrefetchStrategy.select, PrefetchStrategy.join)
+        ]
+
+        async with driver.batch() as batch:
+            batched = batch.fetch_all(Employee, f(Employee.id) == 1)
+
+        batched = await batched
+    finally:
+        await driver.disconnect()
+
+    selected, joined = [[(company, company.employees) for company in companies] for companies in by_strategy]
+
+    assert selected == joined
+    assert [employee.id for employee in batched] == [1]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_prefetch_error_stops_every_path(dsn):
+    driver = Postgres(tables=[Company, FailingEmployee, FailingChart])
+    await driver.connect_pool(**dsn, min_size=3, max_size=3)
+
+    try:
+        # employee 3 is on both paths, one of them loads its company and the other waits on that
+        with pytest.raises(asyncpg.DivisionByZeroError):
+            await asyncio.wait_for(
+                driver.fetch_all(
+                    FailingChart,
+                    prefetch=[
+                        [FailingChart.manager, FailingEmployee.company],
+                        [FailingChart.report, FailingEmployee.company],
+                    ],
+                ),
+                timeout=5,
+            )
+
+        # the other path has stopped by the time the error is raised, only the pool may still be taking its
+        # connection back
+        releasing = asyncio.all_tasks() - {asyncio.current_task()}
+        assert {task.get_coro().__qualname__ for task in releasing} <= {"PoolConnectionHolder.release"}
+
+        await asyncio.gather(*releasing)
+        assert driver.pool.get_idle_size() == 3
+    finally:
+        await driver.disconnect()
+
+
+def test_related_query_binds_keys_as_one_array():
+    sql, args = _related_query(Widget, Part.red_widget)
+
+    assert sql == 'SELECT * FROM "widget" WHERE "id"=ANY($1) AND "color"=$2'
+    assert args == ["red"]
+
+
+def test_related_json_subqueries_follow_the_criterion_arguments():
+    Part.__memo__.queries.clear()
+
+    sql, args = compile_select(
+        Part, f(Part.id) == 1, limit=5, related=prefetch_tree([[Part.red_widget], [Part.red_widget]])
+    )
+
+    row = json_row(Widget, '"_p3orm_1"')
+
+    assert sql == (
+        f'SELECT *,(SELECT {row} FROM "widget" "_p3orm_1" '
+        'WHERE "_p3orm_1"."id"="part"."widget_id" AND "color"=$2 LIMIT 1) "_p3orm.red_widget" '
+        'FROM "part" WHERE "id"=$1 LIMIT $3'
+    )
+    assert args == [1, "red", 5]
+
+
+def test_prefetch_plan_merges_paths_and_is_cached():
+    relations = [[Part.red_widget], [Part.red_widget]]
+
+    plan = prefetch_plan(Part, relations)
+
+    assert plan == {Part.red_widget: {}}
+    assert prefetch_plan(Part, [list(path) for path in relations]) is plan
@@ -1,108 +1,516 @@
 from __future__ import annotations
 
 from datetime import datetime
+from enum import Enum
 
 import asyncpg
 import pytest
-from pydantic import ValidationError
 
-from test.fixtures.tables import Company, Employee
-from test.postgres.fixtures.helpers import create_base_and_connect
+from p3orm import CacheConfig, Column, InsertMode, Postgres, Table, f
+from p3orm.drivers.postgres import OnConflict, _encode_rows, _group_by_generated, _insert_vals, _returning_columns
+from p3orm.exceptions import P3ormException
+from p3orm.fields import DEFAULT
+from p3orm.table import DB_GENERATED
+
+from test.postgres.fixtures.database import Company, Employee, db, dsn
+from test.postgres.fixtures.models import Kind, Settings, Thing, Widget
+
+
+class CachedCompany(Table):
+    __tablename__ = "company"
+    __cache__ = CacheConfig()
+
+    id: int = Column(pk=True)
+    name: str = Column()
+    some_property: str | None = Column(column_name="column_name")
+
+
+class Shade(str, Enum):
+    light = "LIGHT"
+    dark = "DARK"
+
+
+class Paint(Table):
+    __tablename__ = "paint"
+
+    id: int = Column(pk=True, db_gen=True)
+    shade: Shade = Column()
+
+
+class Tagged(Table):
+    __tablename__ = "tagged"
+
+    id: int = Column(pk=True, db_gen=True)
+    tags: list[str] = Column()
 
 
 @pytest.mark.asyncio
-async def test_insert_one(create_base_and_connect):
+async def test_insert_one(db):
     to_insert = Company(name="Company 5")
 
-    created = await Company.insert_one(to_insert)
-    fetched = await Company.fetch_one(Company.name == "Company 5")
+    created = await db.insert_one(Company, to_insert)
+    fetched = await db.fetch_one(Company, f(Company.name) == "Company 5")
 
     assert created == fetched
 
 
 @pytest.mark.asyncio
-async def test_insert_one_fails_null(create_base_and_connect):
-    with pytest.raises(ValidationError):
+async def test_insert_one_fails_null(db):
+    with pytest.raises(TypeError):
         to_insert = Company()
 
     with pytest.raises(asyncpg.exceptions.NotNullViolationError):
         to_insert = Company(name="ok")
         to_insert.name = None
-        await Company.insert_one(to_insert)
+        await db.insert_one(Company, to_insert)
 
 
 @pytest.mark.asyncio
-async def test_insert_one_ignores_autogen(create_base_and_connect):
-    to_insert = Company(id=999, name="Company 5", created_at=datetime.utcnow())
+async def test_insert_one_fills_db_generated_columns(db):
+    to_insert = Company(name="Company 5")
+
+    created = await db.insert_one(Company, to_insert)
+    fetched = await db.fetch_one(Company, f(Company.name) == "Company 5")
+
+    assert created.id == fetched.id == 5
+    assert isinstance(created.created_at, datetime)
+    assert created.created_at == fetched.created_at
+
+
+@pytest.mark.asyncio
+async def test_insert_one_minimal_sets_generated_columns_on_the_item(db):
+    to_insert = Company(name="Company 5")
 
-    await Company.insert_one(to_insert)
-    fetched = await Company.fetch_one(Company.name == "Company 5")
+    created = await db.insert_one(Company, to_insert, returning="minimal")
+    fetched = await db.fetch_one(Company, f(Company.name) == "Company 5")
 
-    assert to_insert.name == fetched.name
-    assert to_insert.id != fetched.id
-    assert to_insert.created_at != fetched.created_at
+    assert created is to_insert
+    assert created.id == fetched.id == 5
+    assert created.created_at == fetched.created_at
 
 
 @pytest.mark.asyncio
-async def test_insert_many(create_base_and_connect):
+async def test_insert_one_without_returning_counts_and_leaves_the_item(db):
+    to_insert = Company(name="Company 5")
+
+    assert await db.insert_one(Company, to_insert, returning=False) == 1
+
+    assert isinstance(to_insert.id, DB_GENERATED)
+    assert isinstance(to_insert.created_at, DB_GENERATED)
+    assert (await db.fetch_one(Company, f(Company.name) == "Company 5")).id == 5
+
+
+@pytest.mark.asyncio
+async def test_insert_many(db):
     to_insert = [Company(name="Company 5"), Company(name="Company 6"), Company(name="Company 7")]
 
-    created = await Company.insert_many(to_insert)
-    fetched = await Company.fetch_all(Company.id.isin([5, 6, 7]))
+    created = await db.insert_many(Company, to_insert)
+    fetched = await db.fetch_all(Company, f(Company.id).isin([5, 6, 7]), by=f(Company.id))
 
     assert created == fetched
 
 
 @pytest.mark.asyncio
-async def test_insert_many_fails_null(create_base_and_connect):
+async def test_insert_many_fails_null(db):
     with pytest.raises(asyncpg.exceptions.NotNullViolationError):
         to_insert = [Company(name="ok"), Company(name="ok2")]
         to_insert[0].name = None
-        await Company.insert_many(to_insert)
+        await db.insert_many(Company, to_insert)
 
 
 @pytest.mark.asyncio
-async def test_insert_many_ignores_autogen(create_base_and_connect):
-    to_insert = [
-        Company(id=998, name="Company 5", created_at=datetime.utcnow()),
-        Company(id=999, name="Company 5", created_at=datetime.utcnow()),
-    ]
-
-    created = await Company.insert_many(to_insert)
+async def test_insert_many_fills_db_generated_columns(db):
+    to_insert = [Company(name="Company 5"), Company(name="Company 6")]
 
-    assert to_insert[0].id != created[0].id
-    assert to_insert[1].id != created[1].id
+    created = await db.insert_many(Company, to_insert)
 
-    assert to_insert[0].created_at != created[0].created_at
-    assert to_insert[1].created_at != created[1].created_at
-
-    assert to_insert[0].name == created[0].name
-    assert to_insert[1].name == created[1].name
+    assert [c.id for c in created] == [5, 6]
+    assert [isinstance(c.created_at, datetime) for c in created] == [True] * 2
+    assert [c.name for c in created] == ["Company 5", "Company 6"]
 
 
 @pytest.mark.asyncio
-async def test_insert_one_prefetch(create_base_and_connect):
-    company = await Company.fetch_one(Company.id == 1)
+async def test_insert_one_prefetch(db):
+    company = await db.fetch_one(Company, f(Company.id) == 1)
     to_insert = Employee(name="Person", company_id=company.id)
 
-    created = await Employee.insert_one(to_insert, prefetch=[[Employee.company]])
+    created = await db.insert_one(Employee, to_insert, prefetch=[[Employee.company]])
 
     assert created.company == company
 
 
 @pytest.mark.asyncio
-async def test_insert_many_prefetch(create_base_and_connect):
-    company = await Company.fetch_one(Company.id == 1)
+async def test_insert_many_minimal_sets_generated_columns_on_the_items(db):
+    to_insert = [Company(name="Company 5"), Company(name="Company 6", some_property="six")]
+
+    created = await db.insert_many(Company, to_insert, returning="minimal")
+    fetched = await db.fetch_all(Company, f(Company.id) > 4, by=f(Company.id))
+
+    assert created == to_insert
+    assert all(company is item for company, item in zip(created, to_insert))
+    assert [company.id for company in created] == [5, 6]
+    assert [company.created_at for company in created] == [company.created_at for company in fetched]
+
+
+@pytest.mark.asyncio
+async def test_insert_many_without_returning_counts_and_leaves_the_items(db):
+    to_insert = [Company(name="Company 5"), Company(name="Company 6")]
+
+    assert await db.insert_many(Company, to_insert, returning=False) == 2
+
+    assert all(isinstance(company.id, DB_GENERATED) for company in to_insert)
+    assert await db.count(Company) == 6
+
+
+@pytest.mark.asyncio
+async def test_insert_many_prefetch(db):
+    company = await db.fetch_one(Company, f(Company.id) == 1)
     to_insert = [Employee(name="Person", company_id=company.id), Employee(name="Person", company_id=company.id)]
 
-    created = await Employee.insert_many(to_insert, prefetch=[[Employee.company]])
+    created = await db.insert_many(Employee, to_insert, prefetch=[[Employee.company]])
 
     for employee in created:
         assert employee.company == company
 
 
 @pytest.mark.asyncio
-async def test_insert_many_empty_list(create_base_and_connect):
-    created = await Employee.insert_many([])
+async def test_insert_many_empty_list(db):
+    created = await db.insert_many(Employee, [])
 
     assert created == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("returning", [True, False])
+async def test_insert_many_chunks_values_above_the_parameter_limit(db, monkeypatch, returning):
+    queries: list[str] = []
+    fetch, execute = db._fetch, db._execute
+
+    async def spy_fetch(connection, query, query_args):
+        queries.append(query)
+        return await fetch(connection, query, query_args)
+
+    async def spy_execute(connection, query, query_args):
+        queries.append(query)
+        return await execute(connection, query, query_args)
+
+    monkeypatch.setattr(db, "_fetch", spy_fetch)
+    monkeypatch.setattr(db, "_execute", spy_execute)
+    # room for two rows of the company table's four columns
+    monkeypatch.setattr("p3orm.drivers.postgres.MAX_QUERY_ARGS", 8)
+
+    to_insert = [Company(name=f"Company {i}", some_property="x") for i in range(5, 10)]
+    inserted = await db.insert_many(Company, to_insert, returning=returning)
+
+    assert [query.count("),(") + 1 for query in queries if query.startswith("INSERT")] == [2, 2, 1]
+    if returning:
+        assert [company.name for company in inserted] == [f"Company {i}" for i in range(5, 10)]
+    else:
+        assert inserted == 5
+    assert [company.name for company in await db.fetch_all(Company, f(Company.id) > 4, by=f(Company.id))] == [
+        f"Company {i}" for i in range(5, 10)
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("returning", [True, False])
+async def test_insert_many_values_chunks_roll_back_together(db, returning):
+    to_insert = [Company(name=f"Company {i}") for i in range(5, 9)]
+    to_insert[3].name = None
+
+    with pytest.raises(asyncpg.NotNullViolationError):
+        await db.insert_many(Company, to_insert, chunk_size=2, returning=returning)
+
+    assert await db.count(Company) == 4
+
+
+@pytest.mark.asyncio
+async def test_upsert_many_merges_items_with_the_same_conflict_fields(db):
+    await db.execute_raw("CREATE UNIQUE INDEX ON company (name)")
+    to_upsert = [
+        Company(name="Company 5", some_property="first"),
+        Company(name="Company 1", some_property="updated"),
+        Company(name="Company 5", some_property="last"),
+    ]
+
+    upserted = await db.upsert_many(Company, to_upsert, conflict=[Company.name])
+
+    assert [(company.name, company.some_property) for company in upserted] == [
+        ("Company 5", "last"),
+        ("Company 1", "updated"),
+    ]
+    assert upserted[1].id == 1
+    assert await db.count(Company, f(Company.name) == "Company 5") == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("returning", [True, "minimal"])
+async def test_upsert_many_do_nothing_returns_the_inserted_items(db, returning):
+    await db.execute_raw("CREATE UNIQUE INDEX ON company (name)")
+    to_upsert = [
+        Company(name="Company 1", some_property="skipped"),
+        Company(name="Company 5", some_property="five"),
+        Company(name="Company 2", some_property="skipped"),
+        Company(name="Company 6", some_property="six"),
+    ]
+
+    upserted = await db.upsert_many(Company, to_upsert, conflict=[Company.name], update=[], returning=returning)
+
+    assert [(company.name, company.some_property) for company in upserted] == [
+        ("Company 5", "five"),
+        ("Company 6", "six"),
+    ]
+    for company in upserted:
+        fetched = await db.fetch_one(Company, f(Company.id) == company.id)
+        assert fetched.name == company.name
+
+    assert (await db.fetch_one(Company, f(Company.id) == 1)).some_property == "yeet"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", [InsertMode.values, InsertMode.unnest, InsertMode.copy])
+@pytest.mark.parametrize("returning", [True, "minimal"])
+async def test_upsert_many_do_nothing_mixes_generated_keys_with_skipped_rows(db, mode, returning):
+    to_upsert = [
+        Company(name="Company 5"),
+        Company(id=1, name="skipped"),
+        Company(name="Company 6"),
+        Company(id=2, name="skipped"),
+    ]
+
+    upserted = await db.upsert_many(
+        Company, to_upsert, conflict=[Company.id], update=[], mode=mode, returning=returning
+    )
+
+    assert [(company.id, company.name) for company in upserted] == [(5, "Company 5"), (6, "Company 6")]
+    assert (await db.fetch_one(Company, f(Company.id) == 1)).name == "Company 1"
+
+
+@pytest.mark.asyncio
+async def test_upsert_many_do_nothing_matches_enum_conflict_values(dsn):
+    paints = Postgres(tables=[Paint])
+    await paints.connect(**dsn)
+
+    try:
+        await paints.execute_raw("CREATE TABLE paint (id SERIAL PRIMARY KEY, shade text UNIQUE NOT NULL)")
+        await paints.insert_one(Paint, Paint(shade=Shade.light))
+
+        upserted = await paints.upsert_many(
+            Paint, [Paint(shade=Shade.light), Paint(shade=Shade.dark)], conflict=[Paint.shade], update=[]
+        )
+        stored = await paints.fetch_all(Paint, by=f(Paint.id))
+    finally:
+        await paints.disconnect()
+
+    assert upserted == [stored[1]]
+    assert upserted[0].shade == Shade.dark
+
+
+@pytest.mark.asyncio
+async def test_upsert_many_without_returning_invalidates_rows_updated_through_another_column(dsn):
+    cached = Postgres(tables=[CachedCompany])
+    await cached.connect(**dsn)
+    await cached.execute_raw("CREATE UNIQUE INDEX ON company (name)")
+
+    try:
+        assert (await cached.fetch_one(CachedCompany, f(CachedCompany.id) == 1)).some_property == "yeet"
+
+        # the key sent isn't the key of the row the conflict updates
+        count = await cached.upsert_many(
+            CachedCompany,
+            [CachedCompany(id=99, name="Company 1", some_property="updated")],
+            conflict=[CachedCompany.name],
+            returning=False,
+        )
+
+        assert count == 1
+        assert (await cached.fetch_one(CachedCompany, f(CachedCompany.id) == 1)).some_property == "updated"
+    finally:
+        await cached.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_insert_rejects_items_missing_deferred_columns(db):
+    [company] = await db.fetch_all(Company, f(Company.id) == 1, only=[f(Company.name)])
+
+    with pytest.raises(P3ormException, match="some_property"):
+        await db.insert_one(Company, company)
+
+    with pytest.raises(P3ormException, match="some_property"):
+        await db.insert_many(Company, [company])
+
+
+@pytest.mark.asyncio
+async def test_insert_many_unnest(db):
+    to_insert = [
+        Company(name="Company 5", some_property="five"),
+        Company(name="Company 6"),
+        Company(name="Company 7", some_property="seven"),
+    ]
+
+    created = await db.insert_many(Company, to_insert, mode=InsertMode.unnest)
+    fetched = await db.fetch_all(Company, f(Company.id) > 4, by=f(Company.id))
+
+    assert [(company.name, company.some_property) for company in created] == [
+        ("Company 5", "five"),
+        ("Company 6", None),
+        ("Company 7", "seven"),
+    ]
+    assert created == fetched
+
+
+@pytest.mark.asyncio
+async def test_insert_many_unnest_sql_does_not_depend_on_the_row_count(db, monkeypatch):
+    queries: list[str] = []
+    fetch = db._fetch
+
+    async def spy(connection, query, query_args):
+        queries.append(query)
+        return await fetch(connection, query, query_args)
+
+    monkeypatch.setattr(db, "_fetch", spy)
+
+    for size in (2, 5):
+        to_insert = [Company(name=f"Company {size}.{i}", some_property="x") for i in range(size)]
+        await db.insert_many(Company, to_insert, mode=InsertMode.unnest)
+
+    [inserted_two, inserted_five] = [query for query in queries if query.startswith("INSERT")]
+    assert inserted_two == inserted_five
+    assert await db.count(Company) == 11
+
+
+@pytest.mark.asyncio
+async def test_insert_many_unnest_chunks_roll_back_together(db):
+    to_insert = [Company(name=f"Company {i}") for i in range(5, 9)]
+    to_insert[3].name = None
+
+    with pytest.raises(asyncpg.NotNullViolationError):
+        await db.insert_many(Company, to_insert, mode=InsertMode.unnest, chunk_size=2)
+
+    assert await db.count(Company) == 4
+
+
+@pytest.mark.asyncio
+async def test_insert_many_unnest_rejects_array_columns(dsn):
+    driver = Postgres(tables=[Tagged])
+    await driver.connect(**dsn)
+
+    try:
+        await driver.execute_raw("CREATE TABLE tagged (id SERIAL PRIMARY KEY, tags text[] NOT NULL)")
+
+        with pytest.raises(P3ormException, match="array columns"):
+            await driver.insert_many(Tagged, [Tagged(tags=["a"])], mode=InsertMode.unnest)
+    finally:
+        await driver.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("returning", [True, "minimal"])
+async def test_insert_many_copy(db, returning):
+    to_insert = [
+        Company(name="Company 5", some_property="five"),
+        Company(id=10, name="Company 10"),
+        Company(name="Company 6"),
+    ]
+
+    # the rows with a generated id and the one without are copied separately, and come back in input order
+    created = await db.insert_many(Company, to_insert, mode=InsertMode.copy, returning=returning)
+    fetched = await db.fetch_all(Company, f(Company.id) > 4, by=f(Company.id))
+
+    assert [(company.id, company.name, company.some_property) for company in created] == [
+        (5, "Company 5", "five"),
+        (10, "Company 10", None),
+        (6, "Company 6", None),
+    ]
+    assert sorted(created, key=lambda company: company.id) == fetched
+
+
+@pytest.mark.asyncio
+async def test_insert_many_copy_without_returning(db):
+    to_insert = [Company(name="Company 5"), Company(id=10, name="Company 10")]
+
+    assert await db.insert_many(Company, to_insert, mode=InsertMode.copy, returning=False) == 2
+    assert [c.name for c in await db.fetch_all(Company, f(Company.id) > 4, by=f(Company.id))] == [
+        "Company 5",
+        "Company 10",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_insert_many_copy_rolls_back_every_group(db):
+    to_insert = [Company(name="Company 5"), Company(id=10, name="Company 10"), Company(id=1, name="Company 1")]
+
+    with pytest.raises(asyncpg.UniqueViolationError):
+        await db.insert_many(Company, to_insert, mode=InsertMode.copy)
+
+    assert await db.count(Company) == 4
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("returning", [True, "minimal"])
+async def test_upsert_many_copy_updates_conflicting_rows(db, returning):
+    # run twice on one connection, the staging table is dropped after every statement
+    for name in ("Company 5", "Company 6"):
+        to_upsert = [
+            Company(name=name, some_property="new"),
+            Company(id=1, name="Company 1", some_property="updated"),
+        ]
+        upserted = await db.upsert_many(
+            Company, to_upsert, conflict=[Company.id], mode=InsertMode.copy, returning=returning
+        )
+
+    assert [(company.id, company.some_property) for company in upserted] == [(6, "new"), (1, "updated")]
+    assert (await db.fetch_one(Company, f(Company.id) == 1)).some_property == "updated"
+
+
+@pytest.mark.asyncio
+async def test_upsert_many_copy_without_returning_counts_written_rows(db):
+    await db.execute_raw("CREATE UNIQUE INDEX ON company (name)")
+    to_upsert = [Company(name="Company 1", some_property="skipped"), Company(name="Company 5")]
+
+    assert (
+        await db.upsert_many(
+            Company, to_upsert, conflict=[Company.name], update=[], mode=InsertMode.copy, returning=False
+        )
+        == 1
+    )
+    assert (await db.fetch_one(Company, f(Company.id) == 1)).some_property == "yeet"
+
+
+def test_insert_vals_encodes_fields_and_skips_db_generated():
+    things = [
+        Thing(kind=Kind.one, settings=Settings(retries=1), label="a"),
+        Thing(id=5, kind=Kind.two, settings=None),
+    ]
+
+    columns, params, args = _insert_vals(Thing, things)
+
+    assert columns == ["id", "kind", "settings", "label_column"]
+    assert params[0][0] is DEFAULT
+    assert [p.get_sql() for p in params[0][1:]] == ["$1", "$2", "$3"]
+    assert [p.get_sql() for p in params[1]] == ["$4", "$5", "$6", "$7"]
+    assert args == [Kind.one, '{"retries":1}', "a", 5, Kind.two, None, None]
+
+
+def test_rows_are_grouped_by_generated_columns():
+    things = [
+        Thing(kind=Kind.one),
+        Thing(id=5, kind=Kind.two),
+        Thing(kind=Kind.two, label="b"),
+    ]
+
+    assert _group_by_generated(_encode_rows(Thing, things)) == {
+        (True, False, False, False): [0, 2],
+        (False, False, False, False): [1],
+    }
+
+
+def test_on_conflict_updates_the_given_columns_or_does_nothing():
+    assert OnConflict(["name"], ["color"]).sql() == ' ON CONFLICT ("name") DO UPDATE SET "color" = EXCLUDED."color"'
+    assert OnConflict(["id", "name"], []).sql() == ' ON CONFLICT ("id", "name") DO NOTHING'
+
+
+def test_minimal_returning_reads_back_keys_and_generated_columns():
+    assert _returning_columns(Widget, True) == "*"
+    assert _returning_columns(Widget, "minimal") == '"id"'
+    assert _returning_columns(Widget, "minimal", OnConflict(["name"], [])) == '"id", "name"'
@@ -1,12 +1,18 @@
 import pytest
+from pypika import Order
+from pypika.terms import Tuple
 
-from test.fixtures.tables import Company
-from test.postgres.fixtures.helpers import create_base_and_connect
+from p3orm import Bind, f
+from p3orm.exceptions import P3ormException
+from p3orm.query import _bind, compile_select
+
+from test.postgres.fixtures.database import Company, db, dsn
+from test.postgres.fixtures.models import Widget, models
 
 
 @pytest.mark.asyncio
-async def test_between(create_base_and_connect):
-    companies = await Company.fetch_all(Company.id.between(1, 3))
+async def test_between(db):
+    companies = await db.fetch_all(Company, f(Company.id).between(1, 3), by=f(Company.id))
 
     assert len(companies) == 3
     assert companies[0].id == 1
@@ -15,9 +21,69 @@ async def test_between(create_base_and_connect):
 
 
 @pytest.mark.asyncio
-async def test_isin(create_base_and_connect):
-    companies = await Company.fetch_all(Company.name.isin(["Company 1", "Company 2"]))
+async def test_isin(db):
+    companies = await db.fetch_all(Company, f(Company.name).isin(["Company 1", "Company 2"]), by=f(Company.id))
 
     assert len(companies) == 2
     assert companies[0].id == 1
     assert companies[1].id == 2
+
+
+def test_compile_select_reuses_sql_for_same_shape():
+    Widget.__memo__.queries.clear()
+
+    first_sql, first_args = compile_select(
+        Widget, (f(Widget.id) == 1) & f(Widget.color).isin(["red", "blue"]), by=f(Widget.id), order=Order.desc, limit=10
+    )
+    second_sql, second_args = compile_select(
+        Widget,
+        (f(Widget.id) == 2) & f(Widget.color).isin(["green", "pink"]),
+        by=f(Widget.id),
+        order=Order.desc,
+        limit=5,
+    )
+
+    assert first_sql == second_sql
+    assert first_sql == 'SELECT * FROM "widget" WHERE "id"=$1 AND "color" IN ($2, $3) ORDER BY "id" DESC LIMIT $4'
+    assert first_args == [1, "red", "blue", 10]
+    assert second_args == [2, "green", "pink", 5]
+    assert len(Widget.__memo__.queries) == 1
+
+
+def test_compile_select_separates_different_shapes():
+    Widget.__memo__.queries.clear()
+
+    compile_select(Widget, f(Widget.color).isin(["red"]))
+    compile_select(Widget, f(Widget.color).isin(["red", "blue"]))
+    compile_select(Widget, f(Widget.name) == "red")
+    compile_select(Widget, f(Widget.name) == "red", count=True)
+
+    assert len(Widget.__memo__.queries) == 4
+
+
+def test_nested_criterion_placeholders_are_numbered_in_order():
+    sql, args = compile_select(Widget, (f(Widget.id) == 1) & ((f(Widget.name) == "a") & (f(Widget.color) == "b")))
+
+    assert sql == 'SELECT * FROM "widget" WHERE "id"=$1 AND "name"=$2 AND "color"=$3'
+    assert args == [1, "a", "b"]
+
+
+def test_row_value_criterion_is_parameterized():
+    sql, args = compile_select(
+        Widget, Tuple(f(Widget.name), f(Widget.id)) > Tuple("a", 3), by=[f(Widget.name), f(Widget.id)], limit=11
+    )
+
+    assert sql == 'SELECT * FROM "widget" WHERE ("name","id")>($1,$2) ORDER BY "name","id" LIMIT $3'
+    assert args == ["a", 3, 11]
+
+
+def test_prepared_query_binds_slots():
+    query = models.prepare(Widget, (f(Widget.name) == Bind("name")) & (f(Widget.id) > 3), limit=Bind("limit"))
+
+    sql, query_args = query._all
+
+    assert sql == 'SELECT * FROM "widget" WHERE "name"=$1 AND "id">$2 LIMIT $3'
+    assert _bind(query_args, {"name": "yeet", "limit": 20}) == ["yeet", 3, 20]
+
+    with pytest.raises(P3ormException):
+        _bind(query_args, {"name": "yeet"})
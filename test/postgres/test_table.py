@@ -1,61 +1,98 @@
 import pytest
-from pydantic import ValidationError
 
-from p3orm import Column, Table
+from p3orm import Column, Postgres, Table, f
 from p3orm.exceptions import MissingTablename
 
-from test.fixtures.tables import Company
-from test.postgres.fixtures.helpers import create_base_and_connect
+from test.postgres.fixtures.database import Company, db, dsn
+from test.postgres.fixtures.models import Kind, Settings, Thing
 
 
 def test_table_has_tablename():
     with pytest.raises(MissingTablename):
 
         class MyTable(Table):
-            id = Column(int, "id", pk=True, autogen=True)
+            id: int = Column(pk=True, db_gen=True)
 
 
 @pytest.mark.asyncio
-async def test_table_different_field_from_column(create_base_and_connect):
-    company = await Company.fetch_one(Company.id == 1)
+async def test_table_different_field_from_column(db):
+    company = await db.fetch_one(Company, f(Company.id) == 1)
     assert company.some_property == "yeet"
 
-    company = await Company.fetch_one(Company.id == 2)
+    company = await db.fetch_one(Company, f(Company.id) == 2)
     assert company.some_property == None
 
-    company = await Company.fetch_one(Company.some_property == "yeet")
+    company = await db.fetch_one(Company, f(Company.some_property) == "yeet")
     assert company.some_property == "yeet"
     assert company.id == 1
 
 
-@pytest.mark.asyncio
-async def test_table_fails_on_required_property(create_base_and_connect):
+def test_table_fails_on_required_property():
     class _Company(Table):
         __tablename__ = "company"
-        id = Column(int, pk=True, autogen=True)
-        column_name = Column(str)
 
-    with pytest.raises(ValidationError):
-        await _Company.fetch_one(_Company.id == 2)
+        id: int = Column(pk=True, db_gen=True)
+        column_name: str = Column()
+
+    Postgres(tables=[_Company])
 
-    with pytest.raises(ValidationError):
+    with pytest.raises(TypeError):
         _Company(id=1)
 
 
 def test_meta_table_no_tablename():
     class MyMetaTable(Table):
-        class Meta:
-            meta_table = True
+        __meta__ = True
 
-        id = Column(int, "id", pk=True, autogen=True)
+        id: int = Column(pk=True, db_gen=True)
 
 
 def test_table_can_have_pk_on_parent():
     class Entity(Table):
-        class Meta:
-            meta_table = True
+        __meta__ = True
 
-        id = Column(int, "id", pk=True, autogen=True)
+        id: int = Column(pk=True, db_gen=True)
 
     class MyTable(Entity):
         __tablename__ = "my_table"
+
+    Postgres(tables=[MyTable])
+
+    assert [field.column_name for field in MyTable.__memo__.pk] == ["id"]
+
+
+def test_record_decoder_converts_fields():
+    decode = Thing.__memo__.record_decoder(["id", "kind", "settings", "label_column"])
+
+    thing = decode({"id": 1, "kind": "two", "settings": '{"retries": 3}', "label_column": "yeet"})
+
+    assert thing.id == 1
+    assert thing.kind == Kind.two
+    assert thing.settings == Settings(retries=3)
+    assert thing.label == "yeet"
+
+
+def test_record_decoder_skips_unknown_columns_and_nulls():
+    decode = Thing.__memo__.record_decoder(["extra", "id", "kind", "settings", "label_column"])
+
+    thing = decode({"extra": 1, "id": 2, "kind": "one", "settings": None, "label_column": None})
+
+    assert thing.id == 2
+    assert thing.kind == Kind.one
+    assert thing.settings is None
+    assert thing.label is None
+
+
+def test_record_decoder_is_cached_per_shape():
+    columns = ("id", "kind", "settings", "label_column")
+
+    assert Thing.__memo__.record_decoder(columns) is Thing.__memo__.record_decoder(list(columns))
+    assert Thing.__memo__.record_decoder(columns) is not Thing.__memo__.record_decoder(reversed(columns))
+
+
+def test_json_decoder_converts_fields():
+    thing = Thing.__memo__.json_decoder({"id": 1, "kind": "one", "settings": {"retries": 2}, "label_column": None})
+
+    assert thing.kind == Kind.one
+    assert thing.settings == Settings(retries=2)
+    assert thing.label is None
@@ -1,18 +1,34 @@
 from __future__ import annotations
 
+from uuid import UUID, uuid4
+
 import pytest
+from pypika import Field
+
+from p3orm import CacheConfig, Column, Postgres, Table, f
+from p3orm.drivers.postgres import _update_query
+from p3orm.table import _changed_fields
+from p3orm.utils import parameterize_term
+
+from test.postgres.fixtures.database import Company, Employee, db, dsn
+from test.postgres.fixtures.models import Kind, Thing, Widget
+
 
-from test.fixtures.tables import Company, Employee
-from test.postgres.fixtures.helpers import create_base_and_connect
+class Token(Table):
+    __tablename__ = "token"
+    __cache__ = CacheConfig()
+
+    id: UUID = Column(pk=True)
+    name: str = Column()
 
 
 @pytest.mark.asyncio
-async def test_update_one(create_base_and_connect):
-    fetched = await Company.fetch_one(Company.id == 1)
+async def test_update_one(db):
+    fetched = await db.fetch_one(Company, f(Company.id) == 1)
 
     fetched.name = "Company Name Changed"
 
-    updated = await Company.update_one(fetched)
+    updated = await db.update_one(Company, fetched)
 
     assert updated == fetched
     assert updated.name == "Company Name Changed"
@@ -23,16 +39,168 @@ async def test_update_one(create_base_and_connect):
 
 
 @pytest.mark.asyncio
-async def test_update_one_prefetch(create_base_and_connect):
-    employee = await Employee.fetch_one(Employee.id == 1)
+async def test_update_one_prefetch(db):
+    employee = await db.fetch_one(Employee, f(Employee.id) == 1)
 
-    company_one = await Company.fetch_one(Company.id == 1)
-    company_two = await Company.fetch_one(Company.id == 2)
+    company_one = await db.fetch_one(Company, f(Company.id) == 1)
+    company_two = await db.fetch_one(Company, f(Company.id) == 2)
 
     assert employee.company_id == company_one.id
 
     employee.company_id = company_two.id
 
-    employee = await Employee.update_one(employee, prefetch=[[Employee.company]])
+    employee = await db.update_one(Employee, employee, prefetch=[[Employee.company]])
 
     assert employee.company == company_two
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("returning", [True, "minimal", False])
+async def test_update_one_writes_a_change_reverted_after_an_update(db, returning):
+    company = await db.fetch_one(Company, f(Company.id) == 1)
+
+    company.name = "Changed"
+    await db.update_one(Company, company, returning=returning)
+
+    company.name = "Company 1"
+    await db.update_one(Company, company, returning=returning)
+
+    assert (await db.fetch_one(Company, f(Company.id) == 1)).name == "Company 1"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("returning", [True, False])
+async def test_update_many_writes_a_change_reverted_after_an_update(db, returning):
+    companies = await db.fetch_all(Company, f(Company.id) < 3)
+
+    for company in companies:
+        company.name = "Changed"
+
+    await db.update_many(Company, companies, returning=returning)
+
+    for company in companies:
+        company.name = f"Company {company.id}"
+
+    await db.update_many(Company, companies, [Company.name], returning=returning)
+
+    stored = await db.fetch_all(Company, f(Company.id) < 3, by=f(Company.id))
+    assert [c.name for c in stored] == ["Company 1", "Company 2"]
+
+
+@pytest.mark.asyncio
+async def test_update_many_keeps_fields_left_out_changed(db):
+    [company] = await db.fetch_all(Company, f(Company.id) == 1)
+
+    company.name = "Changed"
+    company.some_property = "changed"
+    await db.update_many(Company, [company], [Company.name])
+    await db.update_many(Company, [company])
+
+    stored = await db.fetch_one(Company, f(Company.id) == 1)
+    assert (stored.name, stored.some_property) == ("Changed", "changed")
+
+
+@pytest.mark.asyncio
+async def test_update_where_updates_matching_rows(db):
+    count = await db.update_where(Company, f(Company.id) < 3, {Company.some_property: "renamed"})
+
+    stored = await db.fetch_all(Company, by=f(Company.id))
+
+    assert count == 2
+    assert [company.some_property for company in stored] == ["renamed", "renamed", None, None]
+
+
+@pytest.mark.asyncio
+async def test_update_where_binds_expressions_before_the_criterion(db, monkeypatch):
+    queries: list[tuple[str, list]] = []
+    fetch = db._fetch
+
+    async def spy(connection, query, query_args):
+        queries.append((query, query_args))
+        return await fetch(connection, query, query_args)
+
+    monkeypatch.setattr(db, "_fetch", spy)
+
+    updated = await db.update_where(
+        Employee,
+        f(Employee.id).between(2, 3),
+        {Employee.name: "Moved", Employee.company_id: f(Employee.company_id) + 2},
+        returning=True,
+    )
+
+    [(sql, query_args)] = queries
+    assert sql.startswith('UPDATE "employee" SET "name"=$1,"company_id"="company_id"+$2 WHERE "id" BETWEEN $3 AND $4')
+    assert query_args == ["Moved", 2, 2, 3]
+
+    stored = await db.fetch_all(Employee, f(Employee.id) <= 4, by=f(Employee.id))
+
+    assert sorted((employee.id, employee.name, employee.company_id) for employee in updated) == [
+        (2, "Moved", 3),
+        (3, "Moved", 3),
+    ]
+    assert [(employee.name, employee.company_id) for employee in stored] == [
+        ("Person 1", 1),
+        ("Moved", 3),
+        ("Moved", 3),
+        ("Person 4", 1),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_update_drops_rows_cached_through_a_string_key(dsn):
+    tokens = Postgres(tables=[Token])
+    await tokens.connect(**dsn)
+    key = uuid4()
+
+    try:
+        await tokens.execute_raw("CREATE TABLE token (id uuid PRIMARY KEY, name text NOT NULL)")
+        await tokens.insert_one(Token, Token(id=key, name="before"))
+
+        # cached under the uuid the string stands for, which is the key the update drops
+        token = await tokens.fetch_one(Token, f(Token.id) == str(key))
+        token.name = "after"
+        await tokens.update_one(Token, token)
+
+        refetched = await tokens.fetch_one(Token, f(Token.id) == str(key))
+    finally:
+        await tokens.disconnect()
+
+    assert refetched.name == "after"
+
+
+def test_update_query_locks_rows_in_key_order_before_updating():
+    types = {"id": "integer", "name": "text", "color": "text"}
+
+    sql = _update_query(Widget, ["id"], ["name"], ["color"], types, None)
+
+    assert sql == (
+        'WITH _p3orm_rows ("id", "name") AS (SELECT * FROM unnest($1::integer[], $2::text[])), '
+        '_p3orm_locked AS MATERIALIZED (SELECT "id" FROM "widget" WHERE ("id") IN (SELECT "id" FROM _p3orm_rows) '
+        'ORDER BY "id" FOR UPDATE) UPDATE "widget" SET "name" = _p3orm_rows."name", "color" = DEFAULT '
+        'FROM _p3orm_rows JOIN _p3orm_locked USING ("id") WHERE "widget"."id" = _p3orm_rows."id"'
+    )
+    assert "VALUES ($1::integer, $2::text), ($3::integer, $4::text)" in _update_query(
+        Widget, ["id"], ["name"], [], types, 2
+    )
+
+
+def test_expressions_bind_their_values_after_the_ones_collected_so_far():
+    query_args = ["a"]
+
+    term = parameterize_term((Field("visits") + 1) * Field("weight") - 2, query_args)
+
+    assert term.get_sql(quote_char='"') == '("visits"+$2)*"weight"-$3'
+    assert query_args == ["a", 1, 2]
+
+
+def test_changed_fields_compares_against_the_loaded_values():
+    decode = Thing.__memo__.record_decoder(["id", "kind", "settings", "label_column"])
+    thing = decode({"id": 1, "kind": "two", "settings": '{"retries": 3}', "label_column": "yeet"})
+
+    assert _changed_fields(Thing, thing) == set()
+
+    thing.settings.retries = 4
+    thing.kind = Kind.two
+    assert _changed_fields(Thing, thing) == {"settings"}
+
+    assert _changed_fields(Thing, Thing(kind=Kind.one)) is None
@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+from pydantic import BaseModel
+
+from p3orm import CacheConfig, Column, Driver, Table
+from p3orm.cache import CacheStats, LRUCache
+from p3orm.table import _copy_instance
+
+
+class Settings(BaseModel):
+    retries: int
+
+
+class Account(Table):
+    __tablename__ = "account"
+    __cache__ = CacheConfig()
+
+    id: int = Column(pk=True)
+    tags: list[str] = Column()
+    settings: Settings | None = Column()
+
+
+Driver(tables=[Account])
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache: LRUCache[str, int] = LRUCache(2)
+
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+
+    cache.put("c", 3)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert cache.stats == CacheStats(hits=1, misses=0, evictions=1)
+
+
+def test_lru_cache_counts_misses():
+    cache: LRUCache[str, int] = LRUCache(2)
+
+    assert cache.get("missing") is None
+    assert cache.stats.misses == 1
+
+
+def test_lru_caches_share_stats():
+    stats = CacheStats()
+    first: LRUCache[str, int] = LRUCache(1, stats=stats)
+    second: LRUCache[str, int] = LRUCache(1, stats=stats)
+
+    first.put("a", 1)
+    first.get("a")
+    second.get("a")
+
+    assert stats == CacheStats(hits=1, misses=1, evictions=0)
+
+
+def test_lru_cache_expires_entries_after_ttl(monkeypatch):
+    now = 100.0
+    monkeypatch.setattr("p3orm.cache.monotonic", lambda: now)
+    cache: LRUCache[str, int] = LRUCache(2, ttl=10)
+
+    cache.put("a", 1)
+    now = 109.0
+    assert cache.get("a") == 1
+
+    now = 110.0
+    assert cache.get("a") is None
+    assert "a" not in cache
+    assert cache.stats == CacheStats(hits=1, misses=1, evictions=1)
+
+
+def test_lru_cache_skips_values_read_before_an_invalidation():
+    cache: LRUCache[str, int] = LRUCache(2)
+
+    generation = cache.generation("a")
+    cache.pop("a")
+    cache.put("a", 1, generation)
+    assert "a" not in cache
+
+    generation = cache.generation("a")
+    cache.put("a", 2, generation)
+    assert cache.get("a") == 2
+
+    generation = cache.generation("b")
+    cache.clear()
+    cache.put("b", 3, generation)
+    assert "b" not in cache
+
+
+def test_lru_cache_generations_stay_past_forgotten_keys():
+    cache: LRUCache[str, int] = LRUCache(1)
+
+    generation = cache.generation("a")
+    cache.pop("a")
+    # remembering b's generation forgets a's
+    cache.pop("b")
+    cache.put("a", 1, generation)
+
+    assert "a" not in cache
+
+
+def test_copied_instances_share_no_containers_or_models():
+    account = Account(id=1, tags=["a"], settings=Settings(retries=1))
+
+    copied = _copy_instance(Account, account)
+    copied.tags.append("b")
+    copied.settings.retries = 2
+
+    assert account.tags == ["a"]
+    assert account.settings == Settings(retries=1)
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from p3orm import Column, Table
+from p3orm.hedge import MIN_SAMPLES, HedgeConfig, HedgeStats, LatencyWindow
+
+from test.postgres.fixtures.pools import FakePool, replicated
+
+
+class Reading(Table):
+    __tablename__ = "reading"
+
+    id: int = Column(pk=True)
+
+
+def test_delay_is_the_max_until_enough_reads_are_seen():
+    window = LatencyWindow(HedgeConfig(max_delay=0.5))
+
+    for _ in range(MIN_SAMPLES - 1):
+        window.record(0.01)
+
+    assert window.delay() == 0.5
+
+
+def test_delay_follows_the_percentile_within_bounds():
+    window = LatencyWindow(HedgeConfig(percentile=0.9, min_delay=0.001, max_delay=0.5, window=100))
+
+    for i in range(100):
+        window.record(i / 1000)
+
+    # worked out again every tenth of the window
+    assert 0.08 <= window.delay() <= 0.09
+
+    for _ in range(100):
+        window.record(0.0001)
+
+    assert window.delay() == 0.001
+
+
+def test_hedge_rate():
+    assert HedgeStats().rate == 0.0
+    assert HedgeStats(reads=4, hedged=1, wins=1).rate == 0.25
+
+
+# round robin sends the first read to the second replica, and its hedge to the first
+HEDGE = HedgeConfig(max_delay=0.01)
+
+
+@pytest.mark.asyncio
+async def test_fast_reads_are_not_hedged():
+    peer, replica = FakePool([{"count": 1}]), FakePool([{"count": 2}])
+    db = replicated([Reading], FakePool(), peer, replica, hedge=HEDGE)
+
+    assert await db.count(Reading) == 2
+    assert peer.queries == []
+    assert db.hedge_stats() == HedgeStats(reads=1, hedged=0, wins=0)
+
+
+@pytest.mark.asyncio
+async def test_slow_reads_are_hedged_and_the_loser_cancelled():
+    peer, replica = FakePool([{"count": 1}]), FakePool([{"count": 2}], delay=1)
+    db = replicated([Reading], FakePool(), peer, replica, hedge=HEDGE)
+
+    assert await db.count(Reading) == 1
+    assert db.hedge_stats() == HedgeStats(reads=1, hedged=1, wins=1)
+
+    # the loser finishes cancelling in the background
+    await asyncio.sleep(0.01)
+
+    assert replica.cancelled == 1
+    assert not db._losers
+    # the cancelled attempt counts as a sample too, as long as it ran
+    assert len(db._hedge._samples) == 2
+    assert max(db._hedge._samples) >= 0.01
+
+
+@pytest.mark.asyncio
+async def test_a_failed_attempt_leaves_the_read_to_the_other():
+    peer = FakePool([{"count": 1}], delay=0.05)
+    replica = FakePool(delay=0.02, error=ConnectionResetError("replica went away"))
+    db = replicated([Reading], FakePool(), peer, replica, hedge=HEDGE)
+
+    assert await db.count(Reading) == 1
+    assert db.hedge_stats() == HedgeStats(reads=1, hedged=1, wins=1)
+
+
+@pytest.mark.asyncio
+async def test_the_first_error_is_raised_when_both_attempts_fail():
+    peer = FakePool(delay=0.03, error=ConnectionResetError("peer went away"))
+    replica = FakePool(delay=0.02, error=ConnectionResetError("replica went away"))
+    db = replicated([Reading], FakePool(), peer, replica, hedge=HEDGE)
+
+    with pytest.raises(ConnectionResetError, match="replica"):
+        await db.count(Reading)